@@ -8,10 +8,22 @@ from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import JWTManager
 
-# For the database
-db = SQLAlchemy()
+# For the database, with queries timed for the Server-Timing header, see app/utils/timing.py
+from app.utils.timing import TimedQuery, init_request_timing
+db = SQLAlchemy(query_class=TimedQuery)
 migrate = Migrate()
 
+# For caching public responses, see app/utils/responsecache.py
+from app.utils.responsecache import ResponseCache
+response_cache = ResponseCache()
+
+# For delivering notifications in the background, see app/utils/delivery.py
+from app.utils.delivery import DeliveryQueue
+delivery_queue = DeliveryQueue()
+
+# For the Prometheus metrics at /metrics, see app/utils/metrics.py
+from app.utils.metrics import init_metrics
+
 def create_app(config):
     app = Flask(__name__)
 
@@ -20,6 +32,10 @@ def create_app(config):
 
     db.init_app(app)
     migrate.init_app(app, db)
+    response_cache.init_app(app)
+    delivery_queue.init_app(app)
+    init_request_timing(app)
+    init_metrics(app)
     
     # setup flask_jwt_extended for authentication
     app.config['JWT_SECRET_KEY'] = app.config['SECRET_KEY']
@@ -1,69 +1,223 @@
-from collections import defaultdict
 import datetime
 
-from app.models.data import CoreData, Batch
+from app.models.data import CoreData, CoreDataRecord, Batch, LatestBatch, State
 from app import db
 
-from sqlalchemy import func, and_
+from sqlalchemy import func, and_, literal, null, select, tuple_
 from sqlalchemy.sql import label
 
 
-# grabbed this solution from:
-# https://stackoverflow.com/questions/45775724/sqlalchemy-group-by-and-return-max-date?rq=1
-#
+# Batch types served by default, and the additional types served in "research" mode
+DAILY_BATCH_TYPES = ['daily', 'edit']
+RESEARCH_BATCH_TYPES = DAILY_BATCH_TYPES + ['research', 'research-edit']
+
+# namespace of the transaction level advisory locks taken on the LatestBatch rows of each state
+LATEST_BATCHES_LOCK = 1
+
+# last date served outside of "research" mode
+RESEARCH_CUTOFF_DATE = datetime.date(2021, 3, 7)
+
+
+def update_latest_batches(batch_id):
+    """Recompute the LatestBatch rows for every state/date touched by the given batch.
+
+    For each (state, date) with a CoreData row in ``batch_id``, the latest batch is recomputed for
+    the published and preview views, with and without research batches. This must be called after
+    a batch's CoreData rows are flushed and after its ``isPublished`` flag changes, and before the
+    session is committed.
+
+    Concurrent updates of the same states would conflict on the LatestBatch primary key, or compute the
+    latest batches without each other's rows, so this takes a lock on each touched state until the end
+    of the transaction, in state order so that transactions can't deadlock each other. Once it has the
+    locks, the following statements see the rows of every transaction that held them before.
+
+    Args:
+        batch_id (int): ID of the batch that was pushed, published or edited
+    """
+    states = db.session.query(CoreData.state).filter(
+        CoreData.batchId == batch_id).distinct().order_by(CoreData.state)
+    for (state,) in states.all():
+        db.session.execute(select([func.pg_advisory_xact_lock(LATEST_BATCHES_LOCK, func.hashtext(state))]))
+
+    touched = db.session.query(CoreData.state, CoreData.date).filter(
+        CoreData.batchId == batch_id).distinct().subquery('touched')
+
+    db.session.query(LatestBatch).filter(
+        tuple_(LatestBatch.state, LatestBatch.date).in_(
+            db.session.query(touched.c.state, touched.c.date))
+    ).delete(synchronize_session=False)
+
+    # grabbed this solution from:
+    # https://stackoverflow.com/questions/45775724/sqlalchemy-group-by-and-return-max-date?rq=1
+    def latest_batches(batch_types, research):
+        return db.session.query(
+            Batch.isPublished, literal(research), CoreData.state, CoreData.date,
+            func.max(CoreData.batchId)
+        ).join(Batch).join(
+            touched, and_(CoreData.state == touched.c.state, CoreData.date == touched.c.date)
+        ).filter(Batch.dataEntryType.in_(batch_types)).group_by(
+            Batch.isPublished, CoreData.state, CoreData.date)
+
+    latest = latest_batches(DAILY_BATCH_TYPES, False).union_all(
+        latest_batches(RESEARCH_BATCH_TYPES, True))
+    db.session.execute(LatestBatch.__table__.insert().from_select(
+        ['isPublished', 'research', 'state', 'date', 'batchId'], latest.statement))
+
+
+def parse_date_range(args):
+    """Parses the optional ``start`` and ``end`` (YYYY-MM-DD) arguments of a request
+
+    Returns:
+        tuple: the (start, end) dates, either of which is None if not given
+
+    Raises:
+        ValueError: if a date is not valid or the range is empty
+    """
+    dates = []
+    for name in ('start', 'end'):
+        value = args.get(name)
+        if not value:
+            dates.append(None)
+            continue
+        try:
+            dates.append(datetime.datetime.strptime(value, '%Y-%m-%d').date())
+        except ValueError:
+            raise ValueError("Invalid '%s' date, expected YYYY-MM-DD: %s" % (name, value))
+
+    start, end = dates
+    if start is not None and end is not None and start > end:
+        raise ValueError("'start' date %s is after 'end' date %s" % (start, end))
+    return start, end
+
+
+def parse_fields(args, valid_fields):
+    """Parses the optional comma separated ``fields`` argument of a request
+
+    Returns:
+        frozenset: the requested field names, or None if all fields are requested
+
+    Raises:
+        ValueError: if a field is not one of `valid_fields`, or no field is given
+    """
+    value = args.get('fields')
+    if not value:
+        return None
+    fields = frozenset(field.strip() for field in value.split(',') if field.strip())
+    if not fields:
+        raise ValueError("No fields given")
+    unknown = fields - set(valid_fields)
+    if unknown:
+        raise ValueError("Unknown field(s): %s" % ', '.join(sorted(unknown)))
+    return fields
+
+
 # Returns a SQLAlchemy BaseQuery object. If input state is not None, will return daily data only
 # for the input state. If research is False (default), this will serve data through March 7, 2021.
-def states_daily_query(state=None, preview=False, limit=None, research=False):
-    # first retrieve latest published batch per state. If we're in "research" mode, also serve
-    # "research" batches.
-    allowed_batch_types = ['daily', 'edit']
-    if research:
-        allowed_batch_types.append('research')
-        allowed_batch_types.append('research-edit')
-    filter_list = [Batch.dataEntryType.in_(allowed_batch_types)]
-    
+# If start and/or end dates are given, only data within that (inclusive) date range is returned, and
+# a limit counts the latest dates within the range.
+def states_daily_query(state=None, preview=False, limit=None, research=False, start=None, end=None):
+    # the latest batch per state and date is maintained in LatestBatch, separately for the
+    # published and preview data, with and without "research" batches
+    filter_list = [LatestBatch.isPublished == (not preview), LatestBatch.research == research]
+
     if state is not None:
         if isinstance(state, str):
             state = [state]
-        filter_list.append(CoreData.state.in_(state))
+        filter_list.append(LatestBatch.state.in_(state))
 
-    if preview:
-        filter_list.append(Batch.isPublished == False)
+    # the date range is applied to LatestBatch, so it's scanned through its indexes instead of
+    # reading and joining the whole history
+    if start is not None:
+        filter_list.append(LatestBatch.date >= start)
+    if end is not None:
+        filter_list.append(LatestBatch.date <= end)
+
+    if limit is None:
+        latest_daily_data_query = db.session.query(CoreData).join(
+            LatestBatch,
+            and_(
+                CoreData.batchId == LatestBatch.batchId,
+                CoreData.state == LatestBatch.state,
+                CoreData.date == LatestBatch.date
+            ))
     else:
-        filter_list.append(Batch.isPublished == True)
-
-    # The query here uses a window function using over/partition-by, the specific window
-    # function that's used is row_number, because we want at most $limit number of
-    # newest rows for each state. So we partition by state and order by date desc, assing
-    # row_number, and then filter by this row number
-    latest_state_daily_batches = db.session.query(
-        CoreData.state, CoreData.date, func.max(CoreData.batchId).label('maxBid'),
-        func.row_number().over(
-            partition_by=CoreData.state, order_by=CoreData.date.desc()).label('row')
-    ).join(Batch).filter(*filter_list).group_by(
-        CoreData.date, CoreData.state
-    ).order_by(CoreData.date.desc(), CoreData.state).subquery('latest_state_daily_batches')
-
-    filter_list = []
-    if limit is not None:
+        # The query here uses a window function using over/partition-by, the specific window
+        # function that's used is row_number, because we want at most $limit number of
+        # newest rows for each state. So we partition by state and order by date desc, assing
+        # row_number, and then filter by this row number
+        latest_state_daily_batches = db.session.query(
+            LatestBatch.state, LatestBatch.date, LatestBatch.batchId,
+            func.row_number().over(
+                partition_by=LatestBatch.state, order_by=LatestBatch.date.desc()).label('row')
+        ).filter(*filter_list).subquery('latest_state_daily_batches')
+
+        latest_daily_data_query = db.session.query(CoreData).join(
+            latest_state_daily_batches,
+            and_(
+                CoreData.batchId == latest_state_daily_batches.c.batchId,
+                CoreData.state == latest_state_daily_batches.c.state,
+                CoreData.date == latest_state_daily_batches.c.date
+            ))
         filter_list = [latest_state_daily_batches.c.row <= limit]
 
+    # we don't serve data past March 7, 2021
     if not research:
-        filter_list.append(CoreData.date <= datetime.date(2021, 3, 7))
+        filter_list.append(CoreData.date <= RESEARCH_CUTOFF_DATE)
 
-    # we don't serve data past March 7, 2021
-    latest_daily_data_query = db.session.query(CoreData).join(
-        latest_state_daily_batches,
-        and_(
-            CoreData.batchId == latest_state_daily_batches.c.maxBid,
-            CoreData.state == latest_state_daily_batches.c.state,
-            CoreData.date == latest_state_daily_batches.c.date
-        )).filter(*filter_list).order_by(CoreData.date.desc()).order_by(CoreData.state)
+    latest_daily_data_query = latest_daily_data_query.filter(*filter_list).order_by(
+        CoreData.date.desc()).order_by(CoreData.state)
 
     return latest_daily_data_query
 
 
-def us_daily_query(preview=False, date_format='%Y-%m-%d', limit=None, research=False):
+def total_test_results_sources():
+    """Returns a dict of each state's totalTestResultsFieldDbColumn"""
+    return dict(db.session.query(State.state, State.totalTestResultsFieldDbColumn))
+
+
+def states_daily_records(state=None, preview=False, limit=None, research=False, start=None, end=None,
+                         fields=None, chunk_size=None):
+    """Returns the rows of `states_daily_query` as `CoreDataRecord` tuples instead of CoreData objects.
+
+    The rows are read without the ORM, and each state's totalTestResultsFieldDbColumn is looked up once
+    instead of being loaded for every row.
+
+    Args:
+        fields (iterable, optional): if given, only the columns needed to output these fields (and the
+            state and date) are read, the other columns are selected as NULL
+        chunk_size (int, optional): if given, rows are fetched from a server side cursor ``chunk_size``
+            rows at a time, and an iterator over the records is returned instead of a list
+    """
+    sources = total_test_results_sources()
+    columns = list(CoreData.__table__.columns)
+    if fields is not None:
+        needed = CoreData.columns_for_fields(fields, sources.values()) | {'state', 'date'}
+        columns = [column if column.name in needed else null().label(column.name) for column in columns]
+    statement = states_daily_query(
+        state=state, preview=preview, limit=limit, research=research, start=start, end=end).with_entities(
+        *columns).statement
+
+    if chunk_size is None:
+        return [CoreDataRecord(*row, sources.get(row.state)) for row in db.session.execute(statement)]
+
+    def iter_records():
+        result = db.session.execute(statement.execution_options(stream_results=True))
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                return
+            for row in rows:
+                yield CoreDataRecord(*row, sources.get(row.state))
+    return iter_records()
+
+
+def us_daily_fields():
+    """Returns the names of the fields in the output of `us_daily_query`"""
+    return CoreData.numeric_fields() + ['date', 'dateChecked', 'states', 'totalTestResults']
+
+
+def us_daily_query(preview=False, date_format='%Y-%m-%d', limit=None, research=False, start=None, end=None,
+                   fields=None):
     """Query US Daily Data
 
     Sums up the numeric columns from the data for all states to provide an aggregate for the whole
@@ -76,45 +230,47 @@ def us_daily_query(preview=False, date_format='%Y-%m-%d', limit=None, research=F
             If provided, the `date` property of the output will be formatted in the specified
             fashion (default '%Y-%m-%d')
         research: (bool, optional) If False (default), will serve data only through March 7, 2021.
+        start, end: (date, optional) If provided, only dates within this inclusive range are summed up.
+        fields: (iterable, optional) If provided, only these fields are summed up and output.
 
     Returns:
         dict: Dictionary of US daily data, one row per date
     """
     states_daily = states_daily_query(
-        preview=preview, limit=limit, research=research).subquery('states_daily')
+        preview=preview, limit=limit, research=research, start=start, end=end).subquery('states_daily')
 
     # get a list of columns to aggregate, sum over those from the states_daily subquery
     colnames = CoreData.numeric_fields()
+    if fields is not None:
+        colnames = [colname for colname in colnames if colname in fields]
     col_list = [label(colname, func.sum(getattr(states_daily.c, colname))) for colname in colnames]
     # Add a column to count the records contributing to this date. That should
     # correspond to the number of states, assuming `states_daily` returns
     # only a single row per state.
     col_list.append(label('states', func.count()))
+    # totalTestResults depends on each state's source column, so it's summed from a CASE over the
+    # state's totalTestResultsFieldDbColumn. Dates where no state has a value report 0.
+    if fields is None or 'totalTestResults' in fields:
+        total_test_results = CoreData.total_test_results_expression(
+            states_daily.c, State.totalTestResultsFieldDbColumn)
+        col_list.append(label('totalTestResults', func.coalesce(func.sum(total_test_results), 0)))
     us_daily = db.session.query(
         states_daily.c.date, *col_list
+        ).join(State, State.state == states_daily.c.state
         ).group_by(states_daily.c.date
         ).order_by(states_daily.c.date.desc()
         ).all()
 
-    # short term hack: we need to get totalTestResults as an aggregate, but since it's a hybrid
-    # property, this is difficult without complex sql. Instead, getting states daily results as
-    # CoreData objects, and going to do aggregation in Python.
-    date_total_results_dict = defaultdict(int)
-    states_daily_full_results = states_daily_query(preview=preview, research=research).all()
-    for result in states_daily_full_results:
-        if result.totalTestResults is not None:
-            date_total_results_dict[result.date] += result.totalTestResults
-
     us_data_by_date = []
     for day in us_daily:
         result_dict = day._asdict()
-        # grab totalTestResults from the aggregation-by-date dict we just computed, and update
-        # date object formats
+        # update date object formats
         result_dict.update({
-            'totalTestResults': date_total_results_dict[day.date],
             'dateChecked': day.date.isoformat(),
             'date': day.date.strftime(date_format),
         })
+        if fields is not None:
+            result_dict = {key: value for key, value in result_dict.items() if key in fields}
         us_data_by_date.append(result_dict)
 
     return us_data_by_date
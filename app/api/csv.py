@@ -4,14 +4,15 @@ from io import StringIO
 
 import flask
 from dateutil import tz
-from flask import make_response, request
+from flask import Response, make_response, request, stream_with_context
 from flask_restful import inputs
 
 from app.api import api
-from app.api.common import us_daily_query, states_daily_query
+from app.api.common import parse_date_range, parse_fields, us_daily_query, states_daily_records
 from app.api.csv_columns import CSVColumn, select, \
     STATES_CURRENT, STATES_DAILY, US_CURRENT_COLUMNS, US_DAILY_COLUMNS
 from app.models.data import State, CoreData
+from app.utils.responsecache import cached_response
 
 """Represents the recipe to generate a column of CSV output data.
 
@@ -23,8 +24,11 @@ Columns that have ``blank=True`` will always be blank in the CSV output, used fo
 Example: ``CSVColumn(label="State", model_column=None, blank=True)``
 """
 
+# number of rows fetched from the database and written out at a time when streaming CSV output
+CSV_CHUNK_ROWS = 1000
 
-def make_csv_response(columns, data):
+
+def make_csv_response(columns, data, stream=False):
     """Generate a Flask response containing CSV data from `data` using the column definitions in ``columns``
 
     Outputs a header row, containing each column identified by the column's label in the order provided, followed by
@@ -33,9 +37,22 @@ def make_csv_response(columns, data):
     Args:
         columns: A list of `CSVColumn` definitions. The output will contain each column in the given order
         data: SQLAlchemy query results or a dict to be output in CSV format
+        stream: If True, ``data`` is consumed while the response is sent, and the output is written out every
+            ``CSV_CHUNK_ROWS`` rows, so only one chunk of CSV output is held in memory at a time
 
     Returns: Flask response in ``text/csv`` format
     """
+    if stream:
+        output = Response(stream_with_context(generate_csv(columns, data)))
+    else:
+        output = make_response("".join(generate_csv(columns, data)))
+    output.headers["Content-type"] = "text/csv"
+
+    return output
+
+
+def generate_csv(columns, data):
+    """Yields the CSV output of `make_csv_response` in chunks of ``CSV_CHUNK_ROWS`` rows"""
     si = StringIO()
     writer = csv.writer(si)
 
@@ -52,15 +69,17 @@ def make_csv_response(columns, data):
             return datum.__getattribute__(key)
 
     # write data rows
-    for datum in data:
+    for i, datum in enumerate(data, 1):
         writer.writerow([get_data(datum, column.model_column, column.blank) for column in columns])
-    output = make_response(si.getvalue())
-    output.headers["Content-type"] = "text/csv"
-
-    return output
+        if i % CSV_CHUNK_ROWS == 0:
+            yield si.getvalue()
+            si.seek(0)
+            si.truncate()
+    yield si.getvalue()
 
 
 @api.route('/v1/public/states/info.csv', methods=['GET'])
+@cached_response
 def get_states_csv():
     states = State.query.order_by(State.state.asc()).all()
     columns = [CSVColumn(label="State", model_column="state"),
@@ -79,14 +98,28 @@ def get_states_csv():
     return make_csv_response(columns, states)
 
 
-def get_states_daily_data(preview, limit):
-    latest_daily_data = states_daily_query(preview=preview, limit=limit).all()
+def select_fields(columns):
+    """Returns the `columns` of the request's ``fields`` argument, in their usual order, and the requested
+    fields (None if all of the columns are requested)
+
+    Raises:
+        ValueError: if a field is not the model column of one of `columns`
+    """
+    fields = parse_fields(request.args, [column.model_column for column in columns if column.model_column])
+    if fields is None:
+        return columns, None
+    return [column for column in columns if column.model_column in fields], fields
+
+
+def get_states_daily_data(preview, limit, start=None, end=None, fields=None):
+    """Yields the states daily rows as dicts, reading them from the database in chunks with a server side cursor"""
+    latest_daily_data = states_daily_records(
+        preview=preview, limit=limit, start=start, end=end, fields=fields, chunk_size=CSV_CHUNK_ROWS)
 
     # rewrite date formats to match the old public sheet
-    reformatted_data = []
     eastern_time = tz.gettz('EST')
     for data in latest_daily_data:
-        result_dict = data.to_dict()
+        result_dict = data.to_dict(fields)
         result_dict.update({
             'date': data.date.strftime("%Y%m%d"),
             # due to DST issues, this time needs to be advanced forward one hour to match the old output
@@ -94,55 +127,74 @@ def get_states_daily_data(preview, limit):
                 "%-m/%d/%Y %H:%M") if data.dateChecked else ""
         })
 
-        # add the row to the output
-        reformatted_data.append(result_dict)
-    return reformatted_data
+        yield result_dict
 
 
 @api.route('/v1/internal/states/daily.csv', methods=['GET'], endpoint='states_latest')
+@cached_response
 def get_latest_states_daily_csv():
     preview = request.args.get('preview', default=False, type=inputs.boolean)
     days = request.args.get('days', default=1, type=inputs.positive)
     flask.current_app.logger.info('Retrieving US daily for {} days with preview = {}'.format(
         days, preview))
 
-    states_data = get_states_daily_data(preview, limit=days)
-
     # need to return all columns, with their db names
     columns = [CSVColumn(label=c.name, model_column=c.name) for c in CoreData.__table__.columns]
-    return make_csv_response(columns, states_data)
+    try:
+        columns, fields = select_fields(columns)
+    except ValueError as e:
+        return Response(str(e), status=400)
+
+    states_data = get_states_daily_data(preview, limit=days, fields=fields)
+    return make_csv_response(columns, states_data, stream=True)
 
 
 @api.route('/v1/public/states/daily.csv', methods=['GET'], endpoint='states_daily')
 @api.route('/v1/public/states/current.csv', methods=['GET'], endpoint='states_current')
+@cached_response
 def get_states_daily_csv():
     flask.current_app.logger.info('Retrieving States Daily')
     include_preview = request.args.get('preview', default=False, type=inputs.boolean)
     days = request.args.get('days', default=0, type=inputs.positive)
 
-    if request.endpoint == 'api.states_current':
-        days = 1
-    limit = None if days == 0 else days
-    states_data = get_states_daily_data(include_preview, limit)
-
     columns = STATES_CURRENT
     if request.endpoint == 'api.states_daily':
         columns = STATES_DAILY
     columns = select(columns)
 
-    return make_csv_response(columns, states_data)
+    try:
+        start, end = parse_date_range(request.args)
+        columns, fields = select_fields(columns)
+    except ValueError as e:
+        return Response(str(e), status=400)
+
+    if request.endpoint == 'api.states_current':
+        days = 1
+    limit = None if days == 0 else days
+    states_data = get_states_daily_data(include_preview, limit, start, end, fields)
+
+    return make_csv_response(columns, states_data, stream=True)
 
 
 @api.route('/v1/public/us/daily.csv', methods=['GET'], endpoint='us_daily')
 @api.route('/v1/public/us/current.csv', methods=['GET'], endpoint='us_current')
+@cached_response
 def get_us_daily_csv():
     flask.current_app.logger.info('Retrieving US Daily')
     include_preview = request.args.get('preview', default=False, type=inputs.boolean)
-    limit = 1 if request.endpoint == 'api.us_current' else None
-    us_data_by_date = us_daily_query(preview=include_preview, date_format="%Y%m%d", limit=limit)
 
     columns = US_CURRENT_COLUMNS
     if request.endpoint == 'api.us_daily':
         columns = US_DAILY_COLUMNS
     columns = select(columns)
+
+    try:
+        start, end = parse_date_range(request.args)
+        columns, fields = select_fields(columns)
+    except ValueError as e:
+        return Response(str(e), status=400)
+    limit = 1 if request.endpoint == 'api.us_current' else None
+    us_data_by_date = us_daily_query(
+        preview=include_preview, date_format="%Y%m%d", limit=limit, start=start, end=end, fields=fields)
+
     return make_csv_response(columns, us_data_by_date)
@@ -2,19 +2,27 @@
 
 from collections import defaultdict
 from datetime import datetime
+import time
 
+from dateutil import parser
 import flask
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask_restful import inputs
+import pytz
 from sqlalchemy import func, and_
+from sqlalchemy.orm import selectinload
 
 from app import db
 from app.api import api
-from app.api.common import states_daily_query
+from app.api.common import states_daily_query, update_latest_batches
 from app.models.data import Batch, CoreData, State
 from app.utils.editdiff import EditDiff, ChangedValue, ChangedRow
+from app.utils.metrics import record_ingested_rows
+from app.utils.responsecache import bump_data_version, PREVIEW, PUBLISHED
 from app.utils.slacknotifier import notify_slack, notify_slack_error, exceptions_to_slack
+from app.utils.snapshot import snapshot_on_publish
 from app.utils.validation import validate_core_data_payload, validate_edit_data_payload
-from app.utils.webhook import notify_webhook
+from app.utils.webhook import notify_webhook, record_webhook_changes
 
 
 ##############################################################################################
@@ -37,14 +45,115 @@ def test_auth():
 ##############################################################################################
 
 
+# batches returned per page of /v1/batches, and the largest page that can be requested
+BATCHES_PAGE_SIZE = 100
+MAX_BATCHES_PAGE_SIZE = 1000
+
+
+def parse_timestamp(value):
+    """Parses an ISO 8601 date or timestamp argument, timestamps without a timezone are in UTC"""
+    timestamp = parser.isoparse(value)
+    if timestamp.tzinfo is None:
+        timestamp = pytz.utc.localize(timestamp)
+    return timestamp
+
+
+def batches_query(args):
+    """Returns the Batch query for the filters of a /v1/batches request, newest (highest batchId) first
+
+    Filters:
+        dataEntryType: one or more comma separated types
+        isPublished: true or false
+        state: batches with coreData rows for the state
+        createdAfter, createdBefore: ISO 8601 timestamps, batches created at or after / before them
+
+    Raises:
+        ValueError: if a filter is not valid
+    """
+    query = Batch.query
+
+    data_entry_types = [t for arg in args.getlist('dataEntryType') for t in arg.split(',') if t]
+    if data_entry_types:
+        query = query.filter(Batch.dataEntryType.in_(data_entry_types))
+
+    if 'isPublished' in args:
+        query = query.filter(Batch.isPublished == inputs.boolean(args['isPublished']))
+
+    state = args.get('state')
+    if state:
+        # an EXISTS over the coreData (state, date, batchId) index
+        query = query.filter(Batch.coreData.any(CoreData.state == state.upper()))
+
+    for name, op in [('createdAfter', Batch.createdAt.__ge__), ('createdBefore', Batch.createdAt.__lt__)]:
+        if args.get(name):
+            try:
+                query = query.filter(op(parse_timestamp(args[name])))
+            except ValueError:
+                raise ValueError("Invalid '%s' timestamp: %s" % (name, args[name]))
+
+    return query.order_by(Batch.batchId.desc())
+
+
+def batches_without_core_data(batches):
+    """Returns the dicts of `batches` without their coreData rows.
+
+    The changed date range of each batch is computed in SQL from the coreData batchId index, instead of
+    loading the batch's rows.
+    """
+    date_ranges = {}
+    if batches:
+        date_ranges = {row[0]: row[1:] for row in db.session.query(
+            CoreData.batchId, func.min(CoreData.date), func.max(CoreData.date)
+        ).filter(CoreData.batchId.in_([batch.batchId for batch in batches])).group_by(CoreData.batchId)}
+
+    to_dict = Batch.to_dict_function(Batch.__table__.columns.keys())
+    batch_dicts = []
+    for batch in batches:
+        d = to_dict(batch)
+        min_date, max_date = date_ranges.get(batch.batchId, (None, None))
+        d['changedDatesMin'] = str(min_date) if min_date is not None else None
+        d['changedDatesMax'] = str(max_date) if max_date is not None else None
+        batch_dicts.append(d)
+    return batch_dicts
+
+
 @api.route('/v1/batches', methods=['GET'])
 def get_batches():
-    flask.current_app.logger.info('Retrieving all batches')
-    batches = Batch.query.all()
-    # for each batch, attach its coreData rows
+    """Lists the batches newest first (by descending batchId), a page at a time.
 
+    The batches are returned without their coreData rows, unless ``include=coreData`` is given. Pages
+    have up to ``limit`` batches (default BATCHES_PAGE_SIZE), and ``nextCursor`` is the ``cursor``
+    argument for the next page of older batches, or null on the last page. See `batches_query` for the
+    filters.
+    """
+    args = flask.request.args
+    try:
+        cursor = int(args['cursor']) if 'cursor' in args else None
+        limit = int(args.get('limit', BATCHES_PAGE_SIZE))
+        if limit < 1 or limit > MAX_BATCHES_PAGE_SIZE:
+            raise ValueError('limit must be between 1 and %d' % MAX_BATCHES_PAGE_SIZE)
+        query = batches_query(args)
+    except ValueError as e:
+        return str(e), 400
+    include_core_data = 'coreData' in args.get('include', '').split(',')
+    flask.current_app.logger.info('Retrieving batches before %s' % cursor)
+
+    if include_core_data:
+        query = query.options(selectinload(Batch.coreData))
+    if cursor is not None:
+        query = query.filter(Batch.batchId < cursor)
+    # one extra batch tells if there's a next page
+    batches = query.limit(limit + 1).all()
+    next_cursor = batches[limit - 1].batchId if len(batches) > limit else None
+    batches = batches[:limit]
+
+    if include_core_data:
+        batch_dicts = [batch.to_dict() for batch in batches]
+    else:
+        batch_dicts = batches_without_core_data(batches)
     return flask.jsonify({
-        'batches': [batch.to_dict() for batch in batches]
+        'batches': batch_dicts,
+        'nextCursor': next_cursor,
     })
 
 
@@ -58,6 +167,7 @@ def get_batch_by_id(id):
 @api.route('/v1/batches/<int:id>/publish', methods=['POST'])
 @jwt_required
 @notify_webhook
+@snapshot_on_publish
 @exceptions_to_slack
 def publish_batch(id):
     flask.current_app.logger.info('Received request to publish batch %d' % id)
@@ -70,10 +180,16 @@ def publish_batch(id):
     batch.isPublished = True
     batch.publishedAt = datetime.utcnow()   # set publish time to now
     db.session.add(batch)
+    db.session.flush()
+    update_latest_batches(batch.batchId)
+    bump_data_version(PUBLISHED, PREVIEW)
     db.session.commit()
 
     notify_slack(f"*Published batch #{id}* (button 2 pressed) (type: {batch.dataEntryType})\n"
                  f"{batch.batchNote}")
+    record_webhook_changes(states={core_data.state for core_data in batch.coreData},
+                           dates={core_data.date for core_data in batch.coreData},
+                           batch_ids=[batch.batchId])
 
     return flask.jsonify(batch.to_dict()), 201
 
@@ -86,6 +202,7 @@ def publish_batch(id):
 @api.route('/v1/states/edit', methods=['POST'])
 @jwt_required
 @notify_webhook
+@snapshot_on_publish
 @exceptions_to_slack
 def edit_state_metadata():
     payload = flask.request.json
@@ -123,7 +240,9 @@ def edit_state_metadata():
         'states': [state.to_dict() for state in state_objects],
     }
 
+    bump_data_version(PUBLISHED, PREVIEW)
     db.session.commit()
+    record_webhook_changes(states=[state.state for state in state_objects])
 
     # this returns a tuple of flask response and status code: (flask.Response, int)
     return flask.jsonify(json_to_return), 201
@@ -171,17 +290,25 @@ def post_core_data_json(payload):
 
         db.session.flush()
 
-    # add all core data rows
-    core_data_dicts = payload['coreData']
-    core_data_objects = []
-    for core_data_dict in core_data_dicts:
-        flask.current_app.logger.info('Creating new core data row: %s' % core_data_dict)
-        core_data_dict['batchId'] = batch.batchId
-        core_data = CoreData(**core_data_dict)
-        db.session.add(core_data)
-        core_data_objects.append(core_data)
-
-    db.session.flush()
+    # add all core data rows in bulk, then load them back in the order they were pushed
+    start = time.perf_counter()
+    core_data_dicts = [dict(core_data_dict, batchId=batch.batchId)
+                       for core_data_dict in payload['coreData']]
+    rows = CoreData.insert_rows(core_data_dicts)
+    elapsed = time.perf_counter() - start
+    flask.current_app.logger.info('Created %d core data rows in %.3fs (%.0f rows/sec)' % (
+        len(rows), elapsed, len(rows) / elapsed if elapsed else 0))
+
+    row_order = {(row['state'], row['date']): i for i, row in enumerate(rows)}
+    core_data_objects = sorted(CoreData.query.filter_by(batchId=batch.batchId),
+                               key=lambda core_data: row_order[(core_data.state, core_data.date)])
+
+    update_latest_batches(batch.batchId)
+    # a new batch is only in the preview data until it's published, but state changes apply to both
+    if state_dicts:
+        bump_data_version(PUBLISHED, PREVIEW)
+    else:
+        bump_data_version(PREVIEW)
 
     # construct the JSON before committing the session, since sqlalchemy objects behave weirdly
     # once the session has been committed
@@ -192,6 +319,7 @@ def post_core_data_json(payload):
     }
 
     db.session.commit()
+    record_ingested_rows('push', len(rows))
 
     # this returns a tuple of flask response and status code: (flask.Response, int)
     return flask.jsonify(json_to_return), 201
@@ -230,6 +358,7 @@ def any_existing_rows(state, date):
 @api.route('/v1/batches/edit_states_daily', methods=['POST'])
 @jwt_required
 @notify_webhook
+@snapshot_on_publish
 @exceptions_to_slack
 def edit_core_data_from_states_daily():
     payload = flask.request.json
@@ -261,10 +390,10 @@ def edit_core_data_from_states_daily():
     for state_daily_data in latest_daily_data_for_state:
         key_to_date[state_daily_data.state][state_daily_data.date] = state_daily_data
 
-    # keep track of all our changes as we go
-    core_data_objects = []
+    # diff every edited row against the published rows, then insert all the changed rows at once
     changed_rows = []
-    new_rows = []
+    new_row_keys = set()
+    edited_core_data_dicts = []
 
     # check each core data row that the corresponding date/state already exists in published form
     for core_data_dict in payload['coreData']:
@@ -280,7 +409,6 @@ def edit_core_data_from_states_daily():
         date = CoreData.parse_str_to_date(core_data_dict['date'])
         data_for_date = key_to_date.get(state, {}).get(date)
         core_data_dict['batchId'] = batch.batchId
-        edited_core_data = None
 
         if not data_for_date:
             # this is a new row: we treat this as a changed date
@@ -291,27 +419,27 @@ def edit_core_data_from_states_daily():
             # return flask.jsonify(error), 400
 
             flask.current_app.logger.info('Row for date not found, making new edit row: %s' % date)
-            edited_core_data = CoreData(**core_data_dict)
-            new_rows.append(edited_core_data)
+            new_row_keys.add((state, date))
+            edited_core_data_dicts.append(core_data_dict)
         else:
             # this row already exists, check each property to see if anything changed.
             changed_for_date = data_for_date.field_diffs(core_data_dict)
             if changed_for_date:
+                # if any value in the row is different, store the changes
                 changed_rows.append(changed_for_date)
-                edited_core_data = data_for_date.copy_with_updates(**core_data_dict)
-
-        # if any value in the row is different, make an edit batch
-        if edited_core_data:
-            # store the changes
-            db.session.add(edited_core_data)
-            core_data_objects.append(edited_core_data)
-            db.session.flush()
-            flask.current_app.logger.info('Adding new edit row: %s' % edited_core_data.to_dict())
-        else:
-            # there were no changes
-            flask.current_app.logger.info('All values are the same for date %s, ignoring' % date)
-
-    db.session.flush()
+                edited_core_data_dicts.append(data_for_date.dict_with_updates(**core_data_dict))
+            else:
+                # there were no changes
+                flask.current_app.logger.info('All values are the same for date %s, ignoring' % date)
+
+    rows = CoreData.insert_rows(edited_core_data_dicts)
+    row_order = {(row['state'], row['date']): i for i, row in enumerate(rows)}
+    core_data_objects = sorted(CoreData.query.filter_by(batchId=batch.batchId),
+                               key=lambda core_data: row_order[(core_data.state, core_data.date)])
+    for core_data in core_data_objects:
+        flask.current_app.logger.info('Adding new edit row: %s' % core_data.to_dict())
+    new_rows = [core_data for core_data in core_data_objects
+                if (core_data.state, core_data.date) in new_row_keys]
 
     diffs = EditDiff(changed_rows, new_rows)
     if diffs.is_empty():
@@ -325,6 +453,8 @@ def edit_core_data_from_states_daily():
     batch.changedFields = diffs.changed_fields
     batch.numRowsEdited = diffs.size()
     db.session.flush()
+    update_latest_batches(batch.batchId)
+    bump_data_version(PUBLISHED)
 
     # TODO: change consumer of this response to use the changedFields, changedDates, numRowsEdited
     # from the "batch" object, then remove those keys from the JSON response
@@ -338,6 +468,7 @@ def edit_core_data_from_states_daily():
     }
 
     db.session.commit()
+    record_ingested_rows('edit', len(core_data_objects))
 
     # collect all the diffs for the edits we've made and format them for a slack notification
     diffs_for_slack = diffs.plain_text_format()
@@ -345,6 +476,8 @@ def edit_core_data_from_states_daily():
     notify_slack(
         f"*Pushed and published {batch.dataEntryType} batch #{batch.batchId}*. state: {state_to_edit}. (user: {batch.shiftLead})\n"
         f"{batch.batchNote}", diffs_for_slack)
+    record_webhook_changes(states=[state_to_edit], dates=diffs.changed_dates,
+                           batch_ids=[batch.batchId])
 
     return flask.jsonify(json_to_return), 201
 
@@ -5,11 +5,14 @@ from flask import request
 from flask_restful import inputs
 
 from app.api import api
-from app.api.common import states_daily_query, us_daily_query
+from app.api.common import parse_date_range, parse_fields, states_daily_records, us_daily_fields, \
+    us_daily_query
 from app.models.data import *
+from app.utils.responsecache import cached_response
 
 
 @api.route('/v1/public/states/info', methods=['GET'])
+@cached_response
 def get_states():
     states = State.query.order_by(State.state.asc()).all()
     return flask.jsonify(
@@ -18,33 +21,55 @@ def get_states():
 
 
 @api.route('/v1/public/states/daily', methods=['GET'])
+@cached_response
 def get_states_daily():
     flask.current_app.logger.info('Retrieving States Daily')
     include_preview = request.args.get('preview', default=False, type=inputs.boolean)
     research = request.args.get('research', default=False, type=inputs.boolean)
-    latest_daily_data = states_daily_query(preview=include_preview, research=research).all()
-    return flask.jsonify([x.to_dict() for x in latest_daily_data])
+    try:
+        start, end = parse_date_range(request.args)
+        fields = parse_fields(request.args, CoreData.output_fields())
+    except ValueError as e:
+        return flask.Response(str(e), status=400)
+    latest_daily_data = states_daily_records(
+        preview=include_preview, research=research, start=start, end=end, fields=fields)
+    return flask.jsonify([x.to_dict(fields) for x in latest_daily_data])
 
 
 @api.route('/v1/public/states/<string:state>/daily', methods=['GET'])
+@cached_response
 def get_states_daily_for_state(state):
     flask.current_app.logger.info('Retrieving States Daily for state %s' % state)
     include_preview = request.args.get('preview', default=False, type=inputs.boolean)
     research = request.args.get('research', default=False, type=inputs.boolean)
-    latest_daily_data_for_state = states_daily_query(
-        state=state.upper(), preview=include_preview, research=research).all()
-    if len(latest_daily_data_for_state) == 0:
+    try:
+        start, end = parse_date_range(request.args)
+        fields = parse_fields(request.args, CoreData.output_fields())
+    except ValueError as e:
+        return flask.Response(str(e), status=400)
+    latest_daily_data_for_state = states_daily_records(
+        state=state.upper(), preview=include_preview, research=research, start=start, end=end, fields=fields)
+    # a date range may well have no data, so an empty response for one is only a 404 for an unknown state
+    if len(latest_daily_data_for_state) == 0 and (
+            (start is None and end is None) or State.query.get(state.upper()) is None):
         # likely state not found
         return flask.Response("States Daily data unavailable for state %s" % state, status=404)
 
-    return flask.jsonify([x.to_dict() for x in latest_daily_data_for_state])
+    return flask.jsonify([x.to_dict(fields) for x in latest_daily_data_for_state])
 
 
 @api.route('/v1/public/us/daily', methods=['GET'])
+@cached_response
 def get_us_daily():
     flask.current_app.logger.info('Retrieving US Daily')
     include_preview = request.args.get('preview', default=False, type=inputs.boolean)
     research = request.args.get('research', default=False, type=inputs.boolean)
-    us_data_by_date = us_daily_query(preview=include_preview, research=research)
+    try:
+        start, end = parse_date_range(request.args)
+        fields = parse_fields(request.args, us_daily_fields())
+    except ValueError as e:
+        return flask.Response(str(e), status=400)
+    us_data_by_date = us_daily_query(
+        preview=include_preview, research=research, start=start, end=end, fields=fields)
 
     return flask.jsonify(us_data_by_date)
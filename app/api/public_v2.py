@@ -3,17 +3,21 @@
 from collections import defaultdict
 import copy
 from datetime import timedelta
+import functools
 from itertools import filterfalse
 
 import flask
 from flask import json, request
+import numpy as np
 from flask_restful import inputs
 from time import perf_counter
 
 from app.api import api
-from app.api.common import states_daily_query, us_daily_query
+from app.api.common import RESEARCH_CUTOFF_DATE, parse_date_range, states_daily_query, states_daily_records, \
+    us_daily_query
 from app.models.data import *
 from app.api.mappings_v2 import _MAPPING, _US_MAPPING, _STATE_INFO_MAPPING
+from app.utils.responsecache import cached_response
 
 
 ##############################################################################################
@@ -22,7 +26,7 @@ from app.api.mappings_v2 import _MAPPING, _US_MAPPING, _STATE_INFO_MAPPING
 
 
 def get_value(data, field_name):
-    if isinstance(data, CoreData) or isinstance(data, State):
+    if isinstance(data, (CoreData, CoreDataRecord, State)):
         return getattr(data, field_name)
     elif isinstance(data, dict):
         return data.get(field_name)
@@ -168,21 +172,158 @@ class ValuesCalculator(object):
 
         return computed_values
 
+    def row_calculator(self, core_data):
+        """Returns a function computing calculate_values(core_data, field_name) from a field name,
+        for computing all the fields of one core data entry"""
+        return functools.partial(self.calculate_values, core_data)
+
+
+class ArrayValuesCalculator(ValuesCalculator):
+    """ValuesCalculator computing the derived values with NumPy.
+
+    Each state's history is laid out as a dense, date-indexed array per field (NaN for missing
+    dates and empty values), and the derived series for all of a state's dates are computed at
+    once with shifted differences and rolling sums, the first time a field is requested, along
+    with the calculated values dict of every date. Rows are found by their (state, date)
+    position in these arrays. The results, including None handling and rounding, match the
+    per-value ValuesCalculator methods.
+    """
+    def __init__(self, daily_data):
+        super(ArrayValuesCalculator, self).__init__(daily_data)
+
+        # state -> ordinal of the first date with data, the index 0 of the state's arrays, and
+        # the length of the state's arrays, the state's rows and their positions in the arrays
+        self.first_ordinal = {}
+        self.num_days = {}
+        self.state_rows = {}
+        for state, date_to_data in self.key_to_date.items():
+            self.first_ordinal[state] = min(date_to_data).toordinal()
+            self.num_days[state] = max(date_to_data).toordinal() - self.first_ordinal[state] + 1
+            positions = np.array([date.toordinal() - self.first_ordinal[state]
+                                  for date in date_to_data], dtype=int)
+            self.state_rows[state] = (list(date_to_data.values()), positions)
+
+        # field -> state -> (population_percent, change_from_prior_day, seven_day_change_percent,
+        # seven_day_average)
+        self.derived_values = {}
+        # field -> state -> calculated values dict for each position, or None if not calculated
+        self.calculated_values = {}
+
+    def get_position(self, core_data):
+        """Returns the (state, index) position of the core_data entry in the state's arrays"""
+        state = get_value(core_data, 'state') or 'US'
+        date = ValuesCalculator.get_date(core_data)
+        return state, date.toordinal() - self.first_ordinal[state]
+
+    @staticmethod
+    def shift(values, days):
+        shifted = np.full_like(values, np.nan)
+        shifted[days:] = values[:len(values) - days]
+        return shifted
+
+    @staticmethod
+    def derive_series(values, population):
+        """Computes the derived value lists for one state's dense array of field values"""
+        num_days = len(values)
+        present = ~np.isnan(values)
+
+        population_pct = values / population * 100
+
+        change = values - ArrayValuesCalculator.shift(values, 1)
+
+        week_ago = ArrayValuesCalculator.shift(values, 7)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pct_change = np.where(week_ago > 0, (values - week_ago) / week_ago * 100, np.nan)
+
+        # rolling 7-day sums and counts of the non-empty values, from cumulative sums
+        sums = np.concatenate(([0], np.cumsum(np.where(present, values, 0))))
+        counts = np.concatenate(([0], np.cumsum(present)))
+        window_start = np.maximum(np.arange(num_days) - 6, 0)
+        window_sums = sums[1:] - sums[window_start]
+        window_counts = counts[1:] - counts[window_start]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            average = np.where(present, window_sums / window_counts, np.nan)
+
+        # NaN is the only value not equal to itself: convert those to None
+        return (
+            [None if x != x else round(x, 4) for x in population_pct.tolist()],
+            [None if x != x else int(x) for x in change.tolist()],
+            [None if x != x else round(x, 1) for x in pct_change.tolist()],
+            [None if x != x else round(x) for x in average.tolist()],
+        )
+
+    def get_derived_values(self, field_name):
+        if field_name not in self.derived_values:
+            derived_for_field = {}
+            for state, (rows, positions) in self.state_rows.items():
+                values = np.full(self.num_days[state], np.nan)
+                # converting to a float array turns the empty values into NaN
+                values[positions] = np.array([get_value(data_for_day, field_name)
+                                              for data_for_day in rows], dtype=float)
+                derived_for_field[state] = ArrayValuesCalculator.derive_series(
+                    values, population_lookup(state))
+            self.derived_values[field_name] = derived_for_field
+        return self.derived_values[field_name]
+
+    def get_calculated_values(self, field_name):
+        """Returns state -> the calculated values dict for each position in the state's arrays,
+        or None if the field is not calculated"""
+        if field_name not in self.calculated_values:
+            calculated_for_field = None
+            if field_name not in self.do_not_calculate_fields:
+                keys = ['population_percent', 'change_from_prior_day', 'seven_day_change_percent',
+                        'seven_day_average']
+                if field_name in self.omit_7_day_average:
+                    keys = keys[:3]
+                calculated_for_field = {
+                    state: [dict(zip(keys, values)) for values in zip(*series)]
+                    for state, series in self.get_derived_values(field_name).items()}
+            self.calculated_values[field_name] = calculated_for_field
+        return self.calculated_values[field_name]
+
+    def population_percent(self, core_data, field_name):
+        state, index = self.get_position(core_data)
+        return self.get_derived_values(field_name)[state][0][index]
+
+    def change_from_prior_day(self, core_data, field_name):
+        state, index = self.get_position(core_data)
+        return self.get_derived_values(field_name)[state][1][index]
+
+    def seven_day_change_percent(self, core_data, field_name):
+        state, index = self.get_position(core_data)
+        return self.get_derived_values(field_name)[state][2][index]
+
+    def seven_day_average(self, core_data, field_name):
+        state, index = self.get_position(core_data)
+        return self.get_derived_values(field_name)[state][3][index]
+
+    def calculate_values(self, core_data, field_name):
+        return self.row_calculator(core_data)(field_name)
+
+    def row_calculator(self, core_data):
+        state, index = self.get_position(core_data)
+
+        def calculate_values(field_name):
+            calculated_for_field = self.get_calculated_values(field_name)
+            return calculated_for_field and calculated_for_field[state][index]
+        return calculate_values
+
 
 ##############################################################################################
-##############################       Recursive tree helpers      #############################
+##############################       Mapping tree helpers      ###############################
 ##############################################################################################
 
 
 def recursive_tree_to_output(tree, core_data, calculator=None):
-    # walk through the data tree recursively and populate the fields from core_data
+    # walk through a copy of the data tree recursively and populate the fields from core_data.
+    # The endpoints use the equivalent, faster CompiledMapping below.
     if isinstance(tree, list):
         for v in tree:
             recursive_tree_to_output(v, core_data, calculator)
     else:  # tree is a dict
         for k, v in tree.items():
             # if k is 'label', it's a string literal field and should be left unchanged
-            if k is 'label':
+            if k == 'label':
                 tree[k] = v
             # if v is a string, we're at a leaf, need to replace v with actual value from core_data
             elif isinstance(v, str):
@@ -200,39 +341,100 @@ def recursive_tree_to_output(tree, core_data, calculator=None):
                 recursive_tree_to_output(v, core_data, calculator)
 
 
+class CompiledMapping(object):
+    """A v2 mapping tree compiled into a flat plan that builds output dicts directly.
+
+    The plan is a list of ``(kind, parent, key, arg)`` steps in the order of the mapping tree, so
+    the output keys come out in the same order as with ``recursive_tree_to_output``. ``parent`` is
+    the index of the container (dict or list) the step writes into, and ``arg`` is the source
+    field for ``LEAF`` steps, the literal value for ``LITERAL`` steps and the index of the new
+    container for ``DICT`` and ``LIST`` steps. Steps writing into a list have a ``None`` key.
+    """
+    LEAF, LITERAL, DICT, LIST = range(4)
+
+    def __init__(self, mapping):
+        self.is_list = isinstance(mapping, list)
+        self.plan = []
+        self.num_containers = 1
+        self.compile(mapping, 0)
+
+    def compile(self, tree, index):
+        items = [(None, v) for v in tree] if isinstance(tree, list) else tree.items()
+        for k, v in items:
+            if k == 'label':
+                # 'label' values are string literals that should be left unchanged
+                self.plan.append((self.LITERAL, index, k, v))
+            elif isinstance(v, str):
+                self.plan.append((self.LEAF, index, k, v))
+            else:
+                child_index = self.num_containers
+                self.num_containers += 1
+                kind = self.LIST if isinstance(v, list) else self.DICT
+                self.plan.append((kind, index, k, child_index))
+                self.compile(v, child_index)
+
+    def to_output(self, data, calculator=None):
+        """Builds the output for ``data`` (a CoreData, State or dict), with derived values if a
+        calculator is given"""
+        if isinstance(data, dict):
+            value_of = data.get
+        else:
+            value_of = functools.partial(getattr, data)
+
+        if calculator:
+            calculate_values = calculator.row_calculator(data)
+
+        containers = [None] * self.num_containers
+        output = containers[0] = [] if self.is_list else {}
+        for kind, parent, key, arg in self.plan:
+            if kind == self.LEAF:
+                value = value_of(arg)
+                if calculator:  # need to compute values for the "full" output
+                    value = {'value': value}
+                    calculated_values = calculate_values(arg)
+                    if calculated_values is not None:
+                        value['calculated'] = calculated_values
+            elif kind == self.LITERAL:
+                value = arg
+            else:
+                value = containers[arg] = [] if kind == self.LIST else {}
+
+            if key is None:
+                containers[parent].append(value)
+            else:
+                containers[parent][key] = value
+        return output
+
+
+_COMPILED_MAPPING = CompiledMapping(_MAPPING)
+_COMPILED_US_MAPPING = CompiledMapping(_US_MAPPING)
+_COMPILED_STATE_INFO_MAPPING = CompiledMapping(_STATE_INFO_MAPPING)
+
+
 def convert_state_core_data_to_simple_output(core_data):
-    core_data_copy = copy.deepcopy(_MAPPING)
-    recursive_tree_to_output(core_data_copy, core_data)
-    return core_data_copy
+    return _COMPILED_MAPPING.to_output(core_data)
 
 
 def convert_us_core_data_to_simple_output(core_data):
-    core_data_copy = copy.deepcopy(_US_MAPPING)
-    recursive_tree_to_output(core_data_copy, core_data)
-    return core_data_copy
+    return _COMPILED_US_MAPPING.to_output(core_data)
 
 
 def convert_state_core_data_to_full_output(core_data, calculator):
-    core_data_copy = copy.deepcopy(_MAPPING)
-    recursive_tree_to_output(core_data_copy, core_data, calculator)
-    return core_data_copy
+    return _COMPILED_MAPPING.to_output(core_data, calculator)
 
 
 def convert_us_core_data_to_full_output(core_data, calculator):
-    core_data_copy = copy.deepcopy(_US_MAPPING)
-    recursive_tree_to_output(core_data_copy, core_data, calculator)
-    return core_data_copy
+    return _COMPILED_US_MAPPING.to_output(core_data, calculator)
 
 
 def convert_state_info_to_output(state_data):
-    state_data_copy = copy.deepcopy(_STATE_INFO_MAPPING)
-    recursive_tree_to_output(state_data_copy, state_data)
+    state_data_output = _COMPILED_STATE_INFO_MAPPING.to_output(state_data)
 
     # remove all sites that do not have a url defined
-    state_data_copy['sites'][:] = filterfalse(
-        lambda site: site['url'] is None, state_data_copy['sites'])
+    state_data_output['sites'][:] = filterfalse(
+        lambda site: site['url'] is None, state_data_output['sites'])
 
-    return state_data_copy
+    return state_data_output
 
 
 ##############################################################################################
@@ -240,6 +442,57 @@ def convert_state_info_to_output(state_data):
 ##############################################################################################
 
 
+# days of data before a window needed for its derived values: the change from the prior day, and the
+# 7-day change and average
+DERIVED_VALUES_LOOKBACK_DAYS = 7
+
+
+def window_args():
+    """Returns the (days, start, end) window of the request, each of which is None if not given.
+
+    Raises:
+        ValueError: if the start or end date is not valid
+    """
+    days = request.args.get('days', default=None, type=inputs.positive)
+    start, end = parse_date_range(request.args)
+    return days, start, end
+
+
+def lookback_window(days, start, end, lookback):
+    """The (limit, start, end) to fetch for a window of `days` latest rows per state since `start`, with
+    `lookback` days of data before the window.
+
+    Each row fetched before the window covers at least a day, so `lookback` extra rows per state reach
+    at least `lookback` days back.
+    """
+    limit = days + lookback if days is not None else None
+    start = start - timedelta(days=lookback) if start is not None else None
+    if limit is not None:
+        # the limit counts the rows past the research cutoff, which aren't served here
+        end = min(end, RESEARCH_CUTOFF_DATE) if end is not None else RESEARCH_CUTOFF_DATE
+    return limit, start, end
+
+
+def rows_in_window(daily_data, days, start):
+    """Drops the lookback rows from `daily_data`, sorted by date descending: only the `days` latest rows
+    per state since `start` are kept"""
+    if days is None and start is None:
+        return daily_data
+
+    rows_per_state = defaultdict(int)
+    window = []
+    for data_for_day in daily_data:
+        if start is not None and ValuesCalculator.get_date(data_for_day) < start:
+            continue
+        if days is not None:
+            state = get_value(data_for_day, 'state') or 'US'
+            if rows_per_state[state] == days:
+                continue
+            rows_per_state[state] += 1
+        window.append(data_for_day)
+    return window
+
+
 def output_with_metadata(data, link):
     out = {'links': {'self': link},
            'meta': {
@@ -252,16 +505,24 @@ def output_with_metadata(data, link):
     return out
 
 
-def get_us_daily_v2_internal(include_preview=False, simple=False):
-    latest_daily_data = us_daily_query(preview=include_preview)
-    if len(latest_daily_data) == 0:
+def get_us_daily_v2_internal(include_preview=False, simple=False, days=None, start=None, end=None):
+    # the derived values of the window need the days before it
+    limit, query_start, query_end = lookback_window(
+        days, start, end, 0 if simple else DERIVED_VALUES_LOOKBACK_DAYS)
+    # the US sum of a date in the window is complete with a per state limit: every state has fewer
+    # than `days` rows on later dates
+    latest_daily_data = us_daily_query(preview=include_preview, limit=limit, start=query_start, end=query_end)
+    # a window may well have no data, so only check if there's any data at all
+    if len(latest_daily_data) == 0 and (
+            (days is None and start is None and end is None) or
+            states_daily_query(preview=include_preview, limit=1).first() is None):
         # data not found
         return flask.Response('US Daily data unavailable')
 
     # only do the caching/precomputation of calculated data if we need to
-    calculator = None if simple else ValuesCalculator(latest_daily_data)
+    calculator = None if simple else ArrayValuesCalculator(latest_daily_data)
     out_data = []
-    for core_data in latest_daily_data:
+    for core_data in rows_in_window(latest_daily_data, days, start):
         # sometimes we have empty rows that only have date and state set but no actual data
         if len(core_data) == 0:
             continue
@@ -287,18 +548,26 @@ def get_us_daily_v2_internal(include_preview=False, simple=False):
     return response
 
 
-def get_states_daily_v2_internal(state=None, include_preview=False, simple=False):
-    latest_daily_data = states_daily_query(
-        state=state.upper() if state else None, preview=include_preview).all()
-    if len(latest_daily_data) == 0:
+def get_states_daily_v2_internal(state=None, include_preview=False, simple=False, days=None, start=None,
+                                 end=None):
+    # the derived values of the window need the days before it
+    limit, query_start, query_end = lookback_window(
+        days, start, end, 0 if simple else DERIVED_VALUES_LOOKBACK_DAYS)
+    latest_daily_data = states_daily_records(
+        state=state.upper() if state else None, preview=include_preview, limit=limit, start=query_start,
+        end=query_end)
+    # a window may well have no data, so only check if the state is known
+    if len(latest_daily_data) == 0 and (
+            (days is None and start is None and end is None) or
+            (state and State.query.get(state.upper()) is None)):
         # likely state not found
         return flask.Response(
             'States Daily data unavailable for state %s' % state if state else 'all')
 
     # only do the caching/precomputation of calculated data if we need to
-    calculator = None if simple else ValuesCalculator(latest_daily_data)
+    calculator = None if simple else ArrayValuesCalculator(latest_daily_data)
     out_data = []
-    for core_data in latest_daily_data:
+    for core_data in rows_in_window(latest_daily_data, days, start):
         # this and the "meta" definition are only relevant for states, not US
         last_update_time = get_value(core_data, 'lastUpdateTime')
         if last_update_time is not None:
@@ -335,12 +604,18 @@ def get_states_daily_v2_internal(state=None, include_preview=False, simple=False
 
 @api.route('/v2/public/states/<string:state>/daily/simple', methods=['GET'])
 @api.route('/v2/public/states/daily/simple', methods=['GET'])
+@cached_response
 def get_states_daily_simple_v2(state=None):
     t1 = perf_counter()
     flask.current_app.logger.info(
         'Retrieving simple States Daily v2 for state %s' % (state if state else 'all'))
     include_preview = request.args.get('preview', default=False, type=inputs.boolean)
-    resp = get_states_daily_v2_internal(state=state, include_preview=include_preview, simple=True)
+    try:
+        days, start, end = window_args()
+    except ValueError as e:
+        return flask.Response(str(e), status=400)
+    resp = get_states_daily_v2_internal(state=state, include_preview=include_preview, simple=True,
+                                        days=days, start=start, end=end)
     t2 = perf_counter()
     flask.current_app.logger.info(
         'Simple States Daily v2 for state %s took %.1f sec' % (state if state else 'all', t2 - t1))
@@ -349,12 +624,18 @@ def get_states_daily_simple_v2(state=None):
 
 @api.route('/v2/public/states/<string:state>/daily', methods=['GET'])
 @api.route('/v2/public/states/daily', methods=['GET'])
+@cached_response
 def get_states_daily_v2(state=None):
     t1 = perf_counter()
     flask.current_app.logger.info(
         'Retrieving States Daily v2 for state %s' % (state if state else 'all'))
     include_preview = request.args.get('preview', default=False, type=inputs.boolean)
-    resp = get_states_daily_v2_internal(state=state, include_preview=include_preview, simple=False)
+    try:
+        days, start, end = window_args()
+    except ValueError as e:
+        return flask.Response(str(e), status=400)
+    resp = get_states_daily_v2_internal(state=state, include_preview=include_preview, simple=False,
+                                        days=days, start=start, end=end)
     t2 = perf_counter()
     flask.current_app.logger.info(
         'States Daily v2 for state %s took %.1f sec' % (state if state else 'all', t2 - t1))
@@ -362,6 +643,7 @@ def get_states_daily_v2(state=None):
 
 
 @api.route('/v2/public/states', methods=['GET'])
+@cached_response
 def get_state_v2():
     states = State.query.order_by(State.state.asc()).all()
     out_data = []
@@ -377,22 +659,34 @@ def get_state_v2():
 
 
 @api.route('/v2/public/us/daily/simple', methods=['GET'])
+@cached_response
 def get_us_daily_simple_v2():
     t1 = perf_counter()
     flask.current_app.logger.info('Retrieving simple US Daily v2')
     include_preview = request.args.get('preview', default=False, type=inputs.boolean)
-    resp = get_us_daily_v2_internal(include_preview=include_preview, simple=True)
+    try:
+        days, start, end = window_args()
+    except ValueError as e:
+        return flask.Response(str(e), status=400)
+    resp = get_us_daily_v2_internal(include_preview=include_preview, simple=True,
+                                    days=days, start=start, end=end)
     t2 = perf_counter()
     flask.current_app.logger.info('Simple US Daily v2 took %.1f sec' % (t2 - t1))
     return resp
 
 
 @api.route('/v2/public/us/daily', methods=['GET'])
+@cached_response
 def get_us_daily_v2():
     t1 = perf_counter()
     flask.current_app.logger.info('Retrieving US Daily v2')
     include_preview = request.args.get('preview', default=False, type=inputs.boolean)
-    resp = get_us_daily_v2_internal(include_preview=include_preview, simple=False)
+    try:
+        days, start, end = window_args()
+    except ValueError as e:
+        return flask.Response(str(e), status=400)
+    resp = get_us_daily_v2_internal(include_preview=include_preview, simple=False,
+                                    days=days, start=start, end=end)
     t2 = perf_counter()
     flask.current_app.logger.info('US Daily v2 took %.1f sec' % (t2 - t1))
     return resp
@@ -1,6 +1,8 @@
+from collections import namedtuple
 import csv
 from datetime import datetime, date
 from dateutil import parser
+import functools
 import os
 import pytz
 
@@ -8,30 +10,53 @@ from app import db
 from app.utils.editdiff import EditDiff, ChangedValue, ChangedRow
 import logging
 
+from sqlalchemy import case, func
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import class_mapper, relationship, validates
 
 
-class DataMixin(object):
+# the fields come from requests, so only the functions of the most recently used sets of fields are kept
+@functools.lru_cache(maxsize=64)
+def compile_to_dict(cls, fields=None):
+    """Builds the ``to_dict`` function of a model class.
+
+    The output has the non-null column attributes, converted by the "repr" function in the column's info if
+    there's one, followed by the derived fields (hybrid_property), in the order of the table and the mapper.
+    The columns, repr functions and derived fields are looked up here once, instead of for every row.
+    If `fields` (a frozenset) is given, the output only has those of the fields.
+    """
+    columns = [(column.name, column.info.get("repr")) for column in cls.__table__.columns
+               if fields is None or column.name in fields]
+    derived = [key for key, prop in inspect(cls).all_orm_descriptors.items()
+               if isinstance(prop, hybrid_property) and (fields is None or key in fields)]
 
     def to_dict(self):
         d = {}
         # get column attributes, skip any nulls
-        for column in self.__table__.columns:
-            repr_fn = column.info.get("repr")
-            attr = getattr(self, column.name)
+        for name, repr_fn in columns:
+            attr = getattr(self, name)
             if attr is not None:
                 if repr_fn is not None:
                     attr = repr_fn(attr)
-                d[column.name] = attr
+                d[name] = attr
         # get derived fields (hybrid_property)
-        for key, prop in inspect(self.__class__).all_orm_descriptors.items():
-            if isinstance(prop, hybrid_property):
-                d[key] = getattr(self, key)
-
+        for key in derived:
+            d[key] = getattr(self, key)
         return d
 
+    return to_dict
+
+
+class DataMixin(object):
+
+    @classmethod
+    def to_dict_function(cls, fields=None):
+        return compile_to_dict(cls, frozenset(fields) if fields is not None else None)
+
+    def to_dict(self, fields=None):
+        return self.to_dict_function(fields)(self)
+
 
 class Batch(db.Model, DataMixin):
     __tablename__ = 'batches'
@@ -183,6 +208,13 @@ class State(db.Model, DataMixin):
 
 class CoreData(db.Model, DataMixin):
     __tablename__ = 'coreData'
+    __table_args__ = (
+        # state/date lookups across batches (state date history, existing rows, edits), also
+        # covering the batchId so the latest batch can be found from the index alone
+        db.Index('ix_coreData_state_date_batchId', 'state', 'date', 'batchId'),
+        # all rows of a single batch (batch details, maintaining latestBatches)
+        db.Index('ix_coreData_batchId', 'batchId'),
+    )
 
     # composite PK: state_name, batch_id, date
     state = db.Column(db.String, db.ForeignKey('states.state'),
@@ -269,6 +301,31 @@ class CoreData(db.Model, DataMixin):
 
         return colnames
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def output_fields():
+        """Returns the names of the fields ``to_dict`` can output: the columns and the derived fields"""
+        return frozenset(CoreData.__table__.columns.keys()) | frozenset(
+            key for key, prop in inspect(CoreData).all_orm_descriptors.items() if isinstance(prop, hybrid_property))
+
+    @staticmethod
+    def columns_for_fields(fields, total_test_results_sources=()):
+        """Returns the names of the columns needed to output `fields`, including the columns the derived
+        fields are computed from.
+
+        Args:
+            fields: output field names
+            total_test_results_sources: the totalTestResultsFieldDbColumn of the states being output,
+                needed for totalTestResults
+        """
+        columns = set(fields) & set(CoreData.__table__.columns.keys())
+        if 'lastUpdateEt' in fields:
+            columns.add('lastUpdateTime')
+        if 'totalTestResults' in fields:
+            columns.update(['positive', 'negative'])
+            columns.update(source for source in total_test_results_sources if source and source != 'posNeg')
+        return columns
+
     @staticmethod
     def stringify(timestamp):
         return timestamp.astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -307,6 +364,19 @@ class CoreData(db.Model, DataMixin):
             value = getattr(self, column)
             return value
 
+    @classmethod
+    def total_test_results_expression(cls, columns, source):
+        """SQL expression equivalent to the totalTestResults property, for use in aggregate queries
+
+        Args:
+            columns: column collection of a CoreData query or subquery, e.g. ``subquery.c``
+            source: column holding the state's totalTestResultsFieldDbColumn
+        """
+        pos_neg = func.coalesce(columns.positive, 0) + func.coalesce(columns.negative, 0)
+        whens = [(source == 'posNeg', pos_neg)]
+        whens.extend((source == colname, columns[colname]) for colname in cls.numeric_fields())
+        return case(whens)
+
     # Converts the input to a string and returns parsed datetime.date object
     @staticmethod
     def parse_str_to_date(date_input):
@@ -324,16 +394,21 @@ class CoreData(db.Model, DataMixin):
         In the valid fields, we exclude state, date and batchId because these are the
         primary keys for the record, and all keys without values make it a dull record
         '''
-        mapper = class_mapper(CoreData)
-        keys = mapper.attrs.keys()
+        key_set, primary_key_set = CoreData.mapper_fields()
 
         candidate_set = set(candidates)
-        key_set = set(keys)
         unknowns = candidate_set - key_set
         valid = candidate_set & key_set
-        valid = valid - {x.name for x in mapper.primary_key}
+        valid = valid - primary_key_set
         return (valid, unknowns)
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def mapper_fields():
+        """Returns the sets of the names of all the mapped attributes and of the primary key columns"""
+        mapper = class_mapper(CoreData)
+        return frozenset(mapper.attrs.keys()), frozenset(x.name for x in mapper.primary_key)
+
     def field_diffs(self, dict_other):
         ''' Return the list of fields that dict_other would modify if applied
         on this row.
@@ -347,7 +422,7 @@ class CoreData(db.Model, DataMixin):
             return None
 
         # we want to compare after all parsing is done
-        other = CoreData(**dict_other)
+        other = CoreData._cleanup_kwargs(dict_other)
 
         # special casing for date aliases
         # TODO: define the ordering of expected date fields, and expectations
@@ -362,9 +437,9 @@ class CoreData(db.Model, DataMixin):
             if field == 'batchId':
                 continue
             # for any other field, compare away
-            if field in dict_other and getattr(other, field) != getattr(self, field):
+            if field in dict_other and other.get(field) != getattr(self, field):
                 old = getattr(self, field)
-                new = getattr(other, field)
+                new = other.get(field)
                 diffs.append(ChangedValue(field=field, old=old, new=new))
 
         if diffs:
@@ -400,17 +475,96 @@ class CoreData(db.Model, DataMixin):
             kwargs['date'] = date.today()
         return kwargs
 
-    def copy_with_updates(self, **kwargs):
+    def dict_with_updates(self, **kwargs):
+        """Returns the kwargs of a copy of this row with the updates in `kwargs`, see `copy_with_updates`"""
         kwargs = self._cleanup_date_kwargs(kwargs)
         self_props = self.to_dict()
         self_props.update(kwargs)
-        return CoreData(**self_props)
+        return self_props
 
-    def __init__(self, **kwargs):
+    def copy_with_updates(self, **kwargs):
+        return CoreData(**self.dict_with_updates(**kwargs))
+
+    @staticmethod
+    def _cleanup_kwargs(kwargs):
         # strip any empty string fields from kwargs
         kwargs = {k: v for k, v in kwargs.items() if v is not None and v != ""}
-        kwargs = self._cleanup_date_kwargs(kwargs)
+        return CoreData._cleanup_date_kwargs(kwargs)
+
+    @classmethod
+    def insert_rows(cls, kwargs_list, chunk_size=1000):
+        """Insert a CoreData row for each dict in `kwargs_list`, without going through the session's unit of work.
+
+        The dicts are cleaned up the same way as the kwargs of ``CoreData(**kwargs)``: empty fields are stripped,
+        times and dates are parsed, and unknown fields are ignored. Rows are inserted with one multi-row INSERT per
+        `chunk_size` rows, in the current transaction.
+        """
+        columns = cls.__table__.columns.keys()
+        rows = []
+        for kwargs in kwargs_list:
+            kwargs = cls._cleanup_kwargs(kwargs)
+            rows.append({column: kwargs.get(column) for column in columns})
+
+        for i in range(0, len(rows), chunk_size):
+            db.session.execute(cls.__table__.insert().values(rows[i:i + chunk_size]))
+        return rows
+
+    def __init__(self, **kwargs):
+        kwargs = self._cleanup_kwargs(kwargs)
 
         mapper = class_mapper(CoreData)
         relevant_kwargs = {k: v for k, v in kwargs.items() if k in mapper.attrs.keys()}
         super(CoreData, self).__init__(**relevant_kwargs)
+
+
+class CoreDataRecord(namedtuple('CoreDataRecord', CoreData.__table__.columns.keys() + ['totalTestResultsSource'])):
+    """A read-only CoreData row as a plain tuple, for serving rows without the cost of ORM objects.
+
+    Has the columns of CoreData, and the state's totalTestResultsFieldDbColumn in place of the ``state_obj``
+    relationship. The derived fields and ``to_dict`` are the same as CoreData's.
+    """
+    __slots__ = ()
+
+    lastUpdateEt = property(CoreData.__dict__['lastUpdateEt'].fget)
+    totalTestResults = property(CoreData.__dict__['totalTestResults'].fget)
+
+    def to_dict(self, fields=None):
+        return CoreData.to_dict_function(fields)(self)
+
+
+class LatestBatch(db.Model):
+    """Maps each state/date to the batch whose CoreData row is currently served for it.
+
+    There is one row per (isPublished, research, state, date): ``isPublished`` is False for the
+    preview view of the data, and ``research`` is True for the view that also includes "research"
+    and "research-edit" batches. This table is maintained by ``update_latest_batches`` whenever a
+    batch is pushed, published or edited, so reads don't need to aggregate over every batch.
+    """
+    __tablename__ = 'latestBatches'
+    __table_args__ = (
+        # date ranges across all states
+        db.Index('ix_latestBatches_date', 'isPublished', 'research', 'date'),
+    )
+
+    # the primary key index is ordered to serve the published/preview and research filters first
+    isPublished = db.Column(db.Boolean, nullable=False, primary_key=True)
+    research = db.Column(db.Boolean, nullable=False, primary_key=True)
+    state = db.Column(db.String, db.ForeignKey('states.state'),
+        nullable=False, primary_key=True)
+    date = db.Column(db.Date, nullable=False, primary_key=True)
+
+    batchId = db.Column(db.Integer, db.ForeignKey('batches.batchId'), nullable=False)
+
+
+class DataVersion(db.Model):
+    """A counter that is incremented whenever the data served by the public endpoints changes.
+
+    There is one row per scope: "published" for the public data, "preview" for the data served
+    with ``preview=true``. Cached public responses are keyed by the version of their scope, and
+    the version and its update time are used as the responses' ETag and Last-Modified.
+    """
+    __tablename__ = 'dataVersions'
+
+    scope = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    updatedAt = db.Column(db.DateTime(timezone=True))
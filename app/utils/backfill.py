@@ -6,30 +6,45 @@ import flask
 import json
 
 from app import db
-from app.models.data import Batch, CoreData, State
+from app.api.common import update_latest_batches
+from app.models.data import Batch, CoreData, LatestBatch, State
+from app.utils.responsecache import bump_data_version
+from app.utils.validation import validate_core_data_payload
 
 
 def backfill(input_file):
     flask.current_app.logger.info('Backfilling core data from %s' % input_file)
 
+    with open(input_file) as f:
+        payload_json = json.load(f)
+
+    # report every problem with the input before anything is deleted
+    try:
+        validate_core_data_payload(payload_json, collect_all=True)
+    except ValueError as e:
+        flask.current_app.logger.error('Backfill input failed validation:\n%s' % str(e))
+        raise
+
     # blow away all core data, states, batches
+    LatestBatch.query.delete()
     CoreData.query.delete()
     State.query.delete()
     Batch.query.delete()
 
     db.session.commit()
 
-    with open(input_file) as f:
-        payload_json = json.load(f)
-        json_out = app.api.data.post_core_data_json(payload_json)
-
-        # publish backfill batch
-        batch_id = json_out[0].json['batch']['batchId']
-        flask.current_app.logger.info('Publishing batch %s' % batch_id)
-        batch = Batch.query.get_or_404(batch_id)
-        batch.isPublished = True
-        batch.publishedAt = datetime.utcnow()   # set publish time to now
-        db.session.add(batch)
-        db.session.commit()
+    json_out = app.api.data.post_core_data_json(payload_json)
+
+    # publish backfill batch
+    batch_id = json_out[0].json['batch']['batchId']
+    flask.current_app.logger.info('Publishing batch %s' % batch_id)
+    batch = Batch.query.get_or_404(batch_id)
+    batch.isPublished = True
+    batch.publishedAt = datetime.utcnow()   # set publish time to now
+    db.session.add(batch)
+    db.session.flush()
+    update_latest_batches(batch_id)
+    bump_data_version()
+    db.session.commit()
 
     flask.current_app.logger.info('Backfilling complete!')
@@ -0,0 +1,181 @@
+"""Delivers notifications (Slack messages, the build webhook) from a background worker thread.
+
+Notifications are put on a bounded in-process queue and delivered outside of the request, so
+responses don't wait on Slack or the webhook. Each delivery is retried with exponential backoff,
+and each destination has a circuit breaker: after too many consecutive failures, deliveries to it
+are dropped until it has been left alone for a while.
+
+Configured with:
+    DELIVERY_BACKGROUND: deliver from a background thread. If False, notifications are queued until
+        `DeliveryQueue.drain` is called, which tests use to deliver them deterministically
+    DELIVERY_QUEUE_SIZE: max number of queued notifications, further notifications are dropped
+    DELIVERY_TIMEOUT: timeout in seconds for a single delivery attempt
+    DELIVERY_RETRIES: number of retries after a failed attempt
+    DELIVERY_BACKOFF: seconds to wait before the first retry, doubled for each following retry
+    DELIVERY_BREAKER_THRESHOLD: consecutive failures that open a destination's circuit breaker
+    DELIVERY_BREAKER_RESET: seconds before an open circuit breaker lets a delivery through again
+"""
+import os
+import queue
+import threading
+import time
+
+from flask import current_app
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """Counts consecutive failures of a destination, and rejects deliveries while it's open"""
+
+    def __init__(self, threshold, reset_timeout, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        # once the reset timeout has passed, let deliveries through again until the next failure
+        return self.opened_at is None or self.clock() - self.opened_at >= self.reset_timeout
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = self.clock()
+
+
+class Delivery(object):
+    """A queued call of `func(*args)` delivering a notification to `destination`"""
+
+    def __init__(self, app, destination, func, args, on_failure=None):
+        self.app = app
+        self.destination = destination
+        self.func = func
+        self.args = args
+        self.on_failure = on_failure
+
+
+class DeliveryQueue(object):
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DELIVERY_BACKGROUND', True)
+        app.config.setdefault('DELIVERY_QUEUE_SIZE', 100)
+        app.config.setdefault('DELIVERY_TIMEOUT', 10)
+        app.config.setdefault('DELIVERY_RETRIES', 3)
+        app.config.setdefault('DELIVERY_BACKOFF', 1)
+        app.config.setdefault('DELIVERY_BREAKER_THRESHOLD', 5)
+        app.config.setdefault('DELIVERY_BREAKER_RESET', 60)
+        app.extensions['delivery_queue'] = self
+
+        self.config = app.config
+        self.queue = queue.Queue(maxsize=app.config['DELIVERY_QUEUE_SIZE'])
+        self.breakers = {}
+        self.lock = threading.Lock()
+        self.worker = None
+        self.worker_pid = None
+
+    def enqueue(self, destination, func, *args, on_failure=None):
+        """Queue a call of `func(*args)` in an app context, returns False if the queue is full.
+
+        `on_failure` is called with the last exception if all the delivery attempts fail.
+        """
+        app = current_app._get_current_object()
+        try:
+            self.queue.put_nowait(Delivery(app, destination, func, args, on_failure))
+        except queue.Full:
+            app.logger.error('Delivery queue is full, dropping %s notification' % destination)
+            return False
+
+        if self.config['DELIVERY_BACKGROUND']:
+            self.ensure_worker()
+        return True
+
+    def ensure_worker(self):
+        # the worker thread doesn't survive forking, so start one in each process
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive() or self.worker_pid != os.getpid():
+                self.worker = threading.Thread(target=self.run, name='delivery-queue', daemon=True)
+                self.worker_pid = os.getpid()
+                self.worker.start()
+
+    def run(self):
+        while True:
+            delivery = self.queue.get()
+            try:
+                self.deliver(delivery)
+            finally:
+                self.queue.task_done()
+
+    def drain(self):
+        """Deliver every queued notification in the calling thread, including ones queued while draining"""
+        while True:
+            try:
+                delivery = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self.deliver(delivery)
+            finally:
+                self.queue.task_done()
+
+    def breaker(self, destination):
+        with self.lock:
+            if destination not in self.breakers:
+                self.breakers[destination] = CircuitBreaker(
+                    self.config['DELIVERY_BREAKER_THRESHOLD'], self.config['DELIVERY_BREAKER_RESET'])
+            return self.breakers[destination]
+
+    def deliver(self, delivery):
+        """Make the delivery attempts of `delivery`, returns True if one succeeded"""
+        breaker = self.breaker(delivery.destination)
+        with delivery.app.app_context():
+            logger = delivery.app.logger
+            error = None
+            for attempt in range(self.config['DELIVERY_RETRIES'] + 1):
+                if attempt > 0:
+                    time.sleep(self.config['DELIVERY_BACKOFF'] * 2 ** (attempt - 1))
+                if not breaker.allow():
+                    error = CircuitOpenError('Circuit breaker for %s is open' % delivery.destination)
+                    break
+
+                try:
+                    delivery.func(*delivery.args)
+                except Exception as e:
+                    breaker.record_failure()
+                    error = e
+                    logger.warning('Delivery to %s failed (attempt %d): %s' % (
+                        delivery.destination, attempt + 1, str(e)))
+                    continue
+
+                breaker.record_success()
+                return True
+
+            logger.error('Delivery to %s failed: %s' % (delivery.destination, str(error)))
+            if delivery.on_failure is not None:
+                try:
+                    delivery.on_failure(error)
+                except Exception as e:
+                    logger.error('Handling failed delivery to %s failed: %s' % (delivery.destination, str(e)))
+            return False
+
+
+def deliver_now(destination, func, *args, on_failure=None):
+    """Make the delivery attempts of a call of `func(*args)` in the calling thread, see `DeliveryQueue.deliver`"""
+    app = current_app._get_current_object()
+    return app.extensions['delivery_queue'].deliver(Delivery(app, destination, func, args, on_failure))
+
+
+def deliver_in_background(destination, func, *args, on_failure=None):
+    """Queue a call of `func(*args)` on the app's delivery queue, see `DeliveryQueue.enqueue`"""
+    return current_app.extensions['delivery_queue'].enqueue(destination, func, *args, on_failure=on_failure)
@@ -56,14 +56,18 @@ class EditDiff:
 
         return list(res)
 
+    @property
+    def changed_dates(self):
+        '''The sorted dates changed in this diff'''
+        return sorted([c.date for c in self.changed_rows or []] + [c.date for c in self.new_rows or []])
+
     @property
     def changed_dates_str(self):
         '''Which dates changed in this diff'''
         if self.is_empty():
             return ""
 
-        changed_dates = [c.date for c in self.changed_rows] + [c.date for c in self.new_rows]
-        changed_dates = sorted(changed_dates)
+        changed_dates = self.changed_dates
         start = changed_dates[0].strftime('%-m/%-d/%y')
         end = changed_dates[-1].strftime('%-m/%-d/%y')
         changed_dates_str = start if start == end else '%s - %s' % (start, end)
@@ -0,0 +1,105 @@
+"""Prometheus metrics for the API, served at /metrics.
+
+These are collected per route (the URL rule, e.g. ``/api/v1/public/states/<string:state>/daily``):
+    api_requests_total: requests, by method, route and status code
+    api_request_duration_seconds: request latency, by method and route
+    api_response_size_bytes: response sizes, by route, except for streamed responses
+and for the app as a whole:
+    api_db_pool_checkout_seconds: time spent waiting for a database connection from the pool
+    api_response_cache_total: public responses served from the response cache or not, by result
+    api_ingested_rows_total: core data rows written by pushed and edited batches, by batch kind
+
+Under gunicorn every worker has its own metrics. To serve the metrics of all the workers, set the
+``prometheus_multiproc_dir`` environment variable to an empty directory shared by the workers before
+starting the server (see boot.sh): the workers then write their metrics there, and /metrics aggregates
+them. The ``METRICS`` config turns the collection of request metrics and the endpoint on and off.
+
+/metrics isn't authenticated, so the reverse proxy must not serve it publicly (see nginx/nginx.conf):
+scrape it from the app directly.
+"""
+import os
+from time import perf_counter
+
+from flask import Response, current_app, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, \
+    generate_latest, multiprocess
+from sqlalchemy.pool import QueuePool
+
+
+REQUEST_COUNT = Counter(
+    'api_requests_total', 'Requests handled', ['method', 'route', 'status'])
+REQUEST_LATENCY = Histogram(
+    'api_request_duration_seconds', 'Request latency', ['method', 'route'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60))
+RESPONSE_SIZE = Histogram(
+    'api_response_size_bytes', 'Response body size of responses that are not streamed', ['route'],
+    buckets=(100, 1000, 10000, 100000, 1000000, 10000000, 100000000))
+POOL_CHECKOUT = Histogram(
+    'api_db_pool_checkout_seconds', 'Time spent checking out a database connection from the pool',
+    buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, 30))
+RESPONSE_CACHE = Counter(
+    'api_response_cache_total', 'Public responses by response cache result', ['result'])
+INGESTED_ROWS = Counter(
+    'api_ingested_rows_total', 'Core data rows written by batches', ['kind'])
+
+# the label of requests that don't match any route, so unknown URLs don't create new series
+UNMATCHED_ROUTE = '<unmatched>'
+
+
+class MeteredQueuePool(QueuePool):
+    """A connection pool recording how long checking out each connection takes"""
+
+    def connect(self):
+        start = perf_counter()
+        try:
+            return super(MeteredQueuePool, self).connect()
+        finally:
+            POOL_CHECKOUT.observe(perf_counter() - start)
+
+
+def record_cache_result(result):
+    """Record a response cache result: "hit", "miss" or "not_modified" for conditional GETs"""
+    RESPONSE_CACHE.labels(result).inc()
+
+
+def record_ingested_rows(kind, count):
+    INGESTED_ROWS.labels(kind).inc(count)
+
+
+def metrics_registry():
+    """The registry to serve: the metrics of all the workers in multiprocess mode, otherwise this process'"""
+    if 'prometheus_multiproc_dir' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def init_metrics(app):
+    app.config.setdefault('METRICS', True)
+    # time pool checkouts, unless the config asks for another pool
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {}).setdefault('poolclass', MeteredQueuePool)
+
+    @app.before_request
+    def start_request_metrics():
+        if app.config['METRICS']:
+            g.metrics_start = perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+
+        route = request.url_rule.rule if request.url_rule is not None else UNMATCHED_ROUTE
+        REQUEST_COUNT.labels(request.method, route, str(response.status_code)).inc()
+        REQUEST_LATENCY.labels(request.method, route).observe(perf_counter() - start)
+        if not response.is_streamed:
+            RESPONSE_SIZE.labels(route).observe(response.calculate_content_length() or 0)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        if not current_app.config['METRICS']:
+            return 'Not found', 404
+        return Response(generate_latest(metrics_registry()), content_type=CONTENT_TYPE_LATEST)
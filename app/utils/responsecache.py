@@ -0,0 +1,421 @@
+"""Caches the public read endpoint responses until the data they are built from changes.
+
+Responses are keyed by endpoint, view arguments, query arguments and the current data version of
+the scope they read from (published or preview data). Data writes bump the version in the same
+transaction as the data change, so the version is shared by all app processes and cached
+responses built from older data are never served again.
+
+The data version also answers conditional GETs: responses carry an ETag made from the scope, the
+version and a digest of the cache key, and a Last-Modified from the version's update time. Requests
+with a matching If-None-Match or a recent enough If-Modified-Since get a 304 without building the
+response once it's known to be successful for the data version: responses too big to cache are still
+recorded as successful, without their body.
+
+Clients that accept gzip get a gzip body, which is compressed once per cached response and kept
+alongside the uncompressed body.
+
+The in-process cache is bounded by the bytes of the bodies it holds. Responses bigger than its max
+entry size are cached in files of the cache directory instead (set in the config with
+"RESPONSE_CACHE_DIR"), named after their scope, data version and key, so every app process can serve
+them and they are built and compressed once per data version. Files of older data versions are
+removed as newer ones are stored. Without a cache directory, their bodies aren't cached.
+
+Streamed responses are passed through as they are generated, and cached once they are complete. Past
+the max entry size, they are buffered in a temporary file of the cache directory, or without one stop
+being buffered, so their memory use stays bounded."""
+from collections import OrderedDict
+from datetime import timezone
+import functools
+import hashlib
+import os
+import tempfile
+import threading
+import zlib
+
+from flask import current_app, json, request
+from flask_restful import inputs
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
+
+from app import db
+from app.models.data import DataVersion
+from app.utils.metrics import record_cache_result
+
+PUBLISHED = 'published'
+PREVIEW = 'preview'
+
+# chunk size to read files of the cache directory with
+FILE_CHUNK_SIZE = 64 * 1024
+
+# rough bytes taken by the key, headers and bookkeeping of a cache entry, so entries without a body count
+# towards the size bound too
+ENTRY_OVERHEAD = 1024
+
+
+def bump_data_version(*scopes):
+    """Increment the data version of `scopes` (default: all scopes) in the current transaction.
+
+    Must be called before committing any change to the data served by the public endpoints.
+    """
+    for scope in scopes or (PUBLISHED, PREVIEW):
+        stmt = insert(DataVersion).values(scope=scope, version=1, updatedAt=func.now())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[DataVersion.scope],
+            set_={'version': DataVersion.version + 1, 'updatedAt': func.now()})
+        db.session.execute(stmt)
+
+
+def get_data_version(scope):
+    """Returns the (version, updatedAt) of the data in `scope`, (0, None) if never bumped"""
+    data_version = db.session.query(
+        DataVersion.version, DataVersion.updatedAt).filter_by(scope=scope).first()
+    return tuple(data_version) if data_version is not None else (0, None)
+
+
+def request_scope():
+    """The data version scope read by the current request"""
+    preview = request.args.get('preview', default=False, type=inputs.boolean)
+    return PREVIEW if preview else PUBLISHED
+
+
+def key_digest(key):
+    """A short digest of the endpoint, view arguments and query arguments of a cache key, the same in
+    every app process"""
+    return hashlib.sha1(repr(key[:3]).encode()).hexdigest()[:16]
+
+
+def accepts_gzip():
+    return request.accept_encodings['gzip'] > 0
+
+
+def gzip_compressor():
+    # a gzip header without a timestamp, so all app processes serve the same bytes for an ETag
+    return zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzip_body(body):
+    compressor = gzip_compressor()
+    return compressor.compress(body) + compressor.flush()
+
+
+def temporary_file(directory):
+    """A new file to write a cache file in, to be renamed into place once it's complete"""
+    os.makedirs(directory, exist_ok=True)
+    return tempfile.NamedTemporaryFile(dir=directory, prefix='.tmp-', delete=False)
+
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def gzip_file(path, gzip_path):
+    """Writes the gzip of the file at `path` to `gzip_path`"""
+    compressor = gzip_compressor()
+    with open(path, 'rb') as f, temporary_file(os.path.dirname(gzip_path)) as out:
+        for chunk in iter(functools.partial(f.read, FILE_CHUNK_SIZE), b''):
+            out.write(compressor.compress(chunk))
+        out.write(compressor.flush())
+    os.replace(out.name, gzip_path)
+
+
+def stream_body(chunks, use_gzip, store=None, max_bytes=None, spill_dir=None):
+    """Yields the `chunks` of a streamed response body, gzipped if `use_gzip`.
+
+    If `store` is given, it's called with the cache entry for the whole body once it's been sent. If the
+    entry gets bigger than `max_bytes`, the body is written to temporary files in `spill_dir`, whose
+    paths are in the entry as "body_file" and "gzip_file". Without a `spill_dir`, the body then stops
+    being buffered and the entry has no body.
+    """
+    compressor = gzip_compressor() if use_gzip else None
+    names = ['body', 'gzip'] if use_gzip else ['body']
+    buffers = {name: [] for name in names} if store is not None else None
+    files = None
+    buffered_bytes = 0
+    try:
+        for chunk in chunks:
+            parts = {'body': chunk}
+            if compressor is not None:
+                chunk = parts['gzip'] = compressor.compress(chunk)
+            if files is not None:
+                for name, part in parts.items():
+                    files[name].write(part)
+            elif buffers is not None:
+                for name, part in parts.items():
+                    buffers[name].append(part)
+                    buffered_bytes += len(part)
+                if max_bytes is not None and buffered_bytes > max_bytes:
+                    # too big to cache in memory
+                    if spill_dir:
+                        files = {name: temporary_file(spill_dir) for name in names}
+                        for name in names:
+                            files[name].writelines(buffers[name])
+                    buffers = None
+            if chunk:
+                yield chunk
+
+        if compressor is not None:
+            chunk = compressor.flush()
+            if files is not None:
+                files['gzip'].write(chunk)
+            elif buffers is not None:
+                buffers['gzip'].append(chunk)
+            yield chunk
+
+        if store is not None:
+            entry = {}
+            if files is not None:
+                for name, f in files.items():
+                    f.close()
+                    entry[name + '_file'] = f.name
+                files = None
+            elif buffers is not None:
+                for name in names:
+                    entry[name] = b''.join(buffers[name])
+            store(entry)
+    finally:
+        # the body wasn't sent completely
+        if files is not None:
+            for f in files.values():
+                f.close()
+            remove_files(f.name for f in files.values())
+
+
+def entry_response(entry, use_gzip):
+    """A response for a cache entry, compressing its body the first time it's needed gzipped.
+    Returns None if the files of the entry have been removed."""
+    if 'path' in entry:
+        return file_entry_response(entry, use_gzip)
+
+    if not use_gzip:
+        return current_app.response_class(entry['body'], headers=entry['headers'])
+
+    if 'gzip' not in entry:
+        entry['gzip'] = gzip_body(entry['body'])
+    response = current_app.response_class(entry['gzip'], headers=entry['headers'])
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def file_entry_response(entry, use_gzip):
+    path = entry['path']
+    try:
+        if use_gzip:
+            if not os.path.exists(path + '.gz'):
+                gzip_file(path, path + '.gz')
+            path += '.gz'
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+
+    response = current_app.response_class(
+        wrap_file(request.environ, f, FILE_CHUNK_SIZE), headers=entry['headers'], direct_passthrough=True)
+    response.content_length = os.fstat(f.fileno()).st_size
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def entry_size(entry):
+    return ENTRY_OVERHEAD + len(entry.get('body', b'')) + len(entry.get('gzip', b''))
+
+
+class ResponseCache(object):
+    """An in-process cache of response bodies, bounded by their total size, least recently used first out"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_BYTES', 128 * 1024 * 1024)
+        app.config.setdefault('RESPONSE_CACHE_MAX_ENTRY_BYTES', 16 * 1024 * 1024)
+        app.config.setdefault('RESPONSE_CACHE_DIR', '')
+        app.extensions['response_cache'] = self
+        self.max_bytes = app.config['RESPONSE_CACHE_BYTES']
+        self.max_entry_bytes = min(app.config['RESPONSE_CACHE_MAX_ENTRY_BYTES'], self.max_bytes)
+        self.directory = app.config['RESPONSE_CACHE_DIR']
+        # key -> (entry, size of the entry when it was stored)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key):
+        """Returns the entry of `key`, from memory or else from the cache directory, None if there's none"""
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None:
+                self.entries.move_to_end(key)
+                return item[0]
+        if not self.directory:
+            return None
+
+        # another process may have stored it, the headers file is written last
+        path = self.file_path(key)
+        try:
+            with open(path + '.json', 'rb') as f:
+                headers = [tuple(header) for header in json.loads(f.read())]
+        except FileNotFoundError:
+            return None
+        entry = {'headers': headers, 'path': path}
+        self.set(key, entry)
+        return entry
+
+    def set(self, key, entry):
+        """Stores `entry`, or updates its size if its gzip body was added since it was stored.
+
+        Entries bigger than the max entry size, or with their body in temporary files, are stored in the
+        cache directory. Without one, they are stored without their body: they only record that the
+        response was successful, to answer conditional GETs for it.
+        """
+        size = entry_size(entry)
+        if 'path' not in entry and (size > self.max_entry_bytes or 'body_file' in entry):
+            entry = self.store_files(key, entry)
+            size = entry_size(entry)
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.entries[key] = (entry, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def file_path(self, key):
+        """The path of the body file of `key` in the cache directory, the same in every app process"""
+        scope, version = key[3:]
+        return os.path.join(self.directory, '%s-%d-%s' % (scope, version, key_digest(key)))
+
+    def store_files(self, key, entry):
+        """Moves the body and gzip body of `entry` to files of the cache directory, and returns the entry
+        for them. Returns an entry without a body if there's no cache directory or body."""
+        temporary_paths = [entry[name] for name in ['body_file', 'gzip_file'] if name in entry]
+        if not self.directory or not ('body' in entry or 'body_file' in entry):
+            remove_files(temporary_paths)
+            return {'headers': entry.get('headers')}
+
+        path = self.file_path(key)
+        try:
+            for name, file_path in [('body', path), ('gzip', path + '.gz')]:
+                if name in entry:
+                    with temporary_file(self.directory) as f:
+                        f.write(entry[name])
+                    temporary_paths.append(f.name)
+                    os.replace(f.name, file_path)
+                elif name + '_file' in entry:
+                    os.replace(entry[name + '_file'], file_path)
+            with temporary_file(self.directory) as f:
+                f.write(json.dumps(entry['headers']).encode())
+            temporary_paths.append(f.name)
+            os.replace(f.name, path + '.json')
+        finally:
+            remove_files(temporary_paths)
+
+        self.remove_older_files(key)
+        return {'headers': entry['headers'], 'path': path}
+
+    def remove_older_files(self, key):
+        """Removes the files of the scope of `key` for older data versions from the cache directory"""
+        scope, version = key[3:]
+        prefix = scope + '-'
+        for name in os.listdir(self.directory):
+            file_version = name[len(prefix):].split('-', 1)[0]
+            if name.startswith(prefix) and file_version.isdigit() and int(file_version) < version:
+                remove_files([os.path.join(self.directory, name)])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def cached_response(func):
+    """Caches the successful responses of the public read endpoint it wraps, per data version,
+    answers conditional GETs for them and serves them gzipped to clients that accept it"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        cache = current_app.extensions['response_cache']
+        scope = request_scope()
+        version, updated_at = get_data_version(scope)
+        if updated_at is not None:
+            # werkzeug compares naive UTC datetimes
+            updated_at = updated_at.astimezone(timezone.utc).replace(tzinfo=None)
+
+        key = (request.endpoint, tuple(sorted(request.view_args.items())),
+               tuple(sorted(request.args.items(multi=True))), scope, version)
+        use_gzip = accepts_gzip()
+        # each encoding is a different representation, so it needs its own strong ETag
+        etag = '%s-%d-%s%s' % (scope, version, key_digest(key), '-gzip' if use_gzip else '')
+        not_modified = not is_resource_modified(request.environ, etag=etag, last_modified=updated_at)
+
+        # only successful responses are cached, so a cached key can be answered with a 304 right away,
+        # even if its body was too big to keep
+        entry = cache.get(key) if cache.enabled else None
+        response = None
+        if entry is not None and not_modified:
+            response = current_app.response_class(status=304)
+            record_cache_result('not_modified')
+        elif entry is not None and ('body' in entry or 'path' in entry):
+            compressed = 'gzip' in entry
+            response = entry_response(entry, use_gzip)
+            if 'gzip' in entry and not compressed:
+                # account for the gzip body
+                cache.set(key, entry)
+            if response is not None:
+                record_cache_result('hit')
+
+        if response is None:
+            record_cache_result('miss')
+            response = current_app.make_response(func(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+            headers = list(response.headers)
+            app = current_app._get_current_object()
+
+            def store(entry):
+                # only cache if the data didn't change while the response was built. For a streamed
+                # response this runs once the body has been sent, when the view's app context may
+                # already have been popped, so push one for the version lookup
+                with app.app_context():
+                    if get_data_version(scope)[0] == version:
+                        entry['headers'] = headers
+                        cache.set(key, entry)
+                    else:
+                        remove_files(entry[name] for name in ['body_file', 'gzip_file'] if name in entry)
+
+            if not_modified:
+                response.close()
+                response = current_app.response_class(status=304)
+                # the next conditional GET is answered without building the response
+                if cache.enabled:
+                    store({})
+            else:
+                if response.is_streamed:
+                    response.response = stream_body(
+                        response.iter_encoded(), use_gzip, store if cache.enabled else None,
+                        cache.max_entry_bytes, cache.directory)
+                    if use_gzip:
+                        response.headers['Content-Encoding'] = 'gzip'
+                else:
+                    entry = {'body': response.get_data(), 'headers': headers}
+                    response = entry_response(entry, use_gzip)
+                    if cache.enabled:
+                        store(entry)
+
+        response.vary.add('Accept-Encoding')
+        response.set_etag(etag)
+        if updated_at is not None:
+            response.last_modified = updated_at
+        return response
+    return wrapper
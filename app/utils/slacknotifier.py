@@ -1,15 +1,17 @@
-"""Notify Slack about errors and publishing events"""
+"""Notify Slack about errors and publishing events. Messages are delivered in the background, see
+app/utils/delivery.py"""
 import traceback
 
 from slack import WebClient
-from slack.errors import SlackApiError
 from flask import current_app
 import functools
 
+from app.utils.delivery import deliver_in_background
+
 
 def client():
     token = current_app.config["SLACK_API_TOKEN"]
-    return WebClient(token=token)
+    return WebClient(token=token, timeout=current_app.config["DELIVERY_TIMEOUT"])
 
 
 def channel():
@@ -27,26 +29,31 @@ def notify_slack(message, file_attachment=None):
         message (str): message to be sent to Slack
         file_attachment (str): optional file to be attached to the message inside a thread
     """
-    try:
-        if should_call_slack():
-            response = client().chat_postMessage(
-                channel=channel(),
-                text=message
-            )
-
-            # send the attachment, if present, as a thread to the initial message
-            if file_attachment is not None and response.validate() and response.get("ts") is not None:
-                client().files_upload(
-                    channels=channel(),
-                    thread_ts=response.get("ts"),
-                    content=file_attachment,
-                    filetype='text',
-                    title='Changes',
-                    initial_comment=f":ctp-eye:"
-                )
-    except SlackApiError as e:
-        # just log Slack failures but don't break on them
-        current_app.logger.error(e.response["error"])
+    if should_call_slack():
+        deliver_in_background('slack', post_slack_message, message, file_attachment)
+
+
+def post_slack_message(message, file_attachment=None):
+    response = client().chat_postMessage(
+        channel=channel(),
+        text=message
+    )
+
+    # send the attachment, if present, as a thread to the initial message. This is a separate
+    # delivery so that retrying it doesn't repeat the message
+    if file_attachment is not None and response.validate() and response.get("ts") is not None:
+        deliver_in_background('slack', upload_slack_attachment, response.get("ts"), file_attachment)
+
+
+def upload_slack_attachment(thread_ts, file_attachment):
+    client().files_upload(
+        channels=channel(),
+        thread_ts=thread_ts,
+        content=file_attachment,
+        filetype='text',
+        title='Changes',
+        initial_comment=f":ctp-eye:"
+    )
 
 
 def notify_slack_error(message, source):
@@ -57,17 +64,18 @@ def notify_slack_error(message, source):
         message (str): Error message
         source (str): The operation or API endpoint causing the error (e.g. `post_core_data`)
     """
-    try:
-        if should_call_slack():
-            client().files_upload(
-                channels=channel(),
-                content=message,
-                filetype='text',
-                title='Error details',
-                initial_comment=f"*:rotating_light: Error in {source}*"
-            )
-    except SlackApiError as slack_error:
-        current_app.logger.error(slack_error.response["error"])
+    if should_call_slack():
+        deliver_in_background('slack', upload_slack_error, message, source)
+
+
+def upload_slack_error(message, source):
+    client().files_upload(
+        channels=channel(),
+        content=message,
+        filetype='text',
+        title='Error details',
+        initial_comment=f"*:rotating_light: Error in {source}*"
+    )
 
 
 def exceptions_to_slack(function):
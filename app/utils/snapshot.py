@@ -0,0 +1,189 @@
+"""Renders every public endpoint into a static snapshot on local disk.
+
+Each snapshot is written to a new directory named after the published data version under the
+snapshot directory (set in the config with "SNAPSHOT_DIR"), then a ``current`` symlink is swapped to
+it atomically, so the files can be served statically with the dynamic endpoints as a fallback. The
+swap is done under a lock file shared by all processes, and never moves ``current`` to an older
+version.
+Paths mirror the endpoint URLs without the ``/api`` prefix, and responses without a file extension
+get ``.json``: e.g. ``current/v2/public/states/ny/daily.json``.
+"""
+from contextlib import contextmanager
+import fcntl
+import functools
+import os
+import shutil
+import tempfile
+import threading
+
+from flask import current_app
+
+from app.models.data import State
+from app.utils.responsecache import get_data_version, PUBLISHED
+
+CURRENT = 'current'
+LOCK = '.lock'
+# number of snapshot directories kept, including the current one
+KEEP_SNAPSHOTS = 3
+
+
+def snapshot_urls(app):
+    """Lists the URLs of every public endpoint, with one URL per state for the single state ones"""
+    states = [state.state.lower() for state in State.query.order_by(State.state.asc())]
+    urls = []
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+        if 'GET' not in rule.methods or not rule.rule.startswith(('/api/v1/public/', '/api/v2/public/')):
+            continue
+        if rule.arguments == {'state'}:
+            urls.extend(rule.rule.replace('<string:state>', state) for state in states)
+        elif not rule.arguments:
+            urls.append(rule.rule)
+    return urls
+
+
+def snapshot_path(url):
+    path = url[len('/api/'):]
+    if not os.path.splitext(path)[1]:
+        path += '.json'
+    return path
+
+
+def take_snapshot(snapshot_dir=None):
+    """Renders every public endpoint into a new snapshot directory and makes it the current snapshot.
+
+    Returns the path of the current snapshot directory, or None if the published data changed while the
+    snapshot was rendered, in which case the snapshot is discarded.
+    """
+    app = current_app._get_current_object()
+    snapshot_dir = snapshot_dir or app.config['SNAPSHOT_DIR']
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    version = get_data_version(PUBLISHED)[0]
+    name = 'v%d' % version
+    path = os.path.join(snapshot_dir, name)
+    if not os.path.isdir(path):
+        tmp_path = tempfile.mkdtemp(prefix='.%s-' % name, dir=snapshot_dir)
+        try:
+            render_snapshot(app, tmp_path)
+            if get_data_version(PUBLISHED)[0] != version:
+                app.logger.warning('Published data changed while rendering snapshot %s, discarding it' % name)
+                return None
+            os.chmod(tmp_path, 0o755)
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process already finished this version's snapshot
+            if not os.path.isdir(path):
+                raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    with snapshot_lock(snapshot_dir):
+        # another process may have made a newer snapshot current while this one was rendered
+        link = os.path.join(snapshot_dir, CURRENT)
+        current_name = current_snapshot(snapshot_dir)
+        if current_name is not None and int(current_name[1:]) > version:
+            app.logger.info('Snapshot %s is newer than %s, keeping it current' % (current_name, name))
+            return os.path.join(snapshot_dir, current_name)
+
+        # swap the current snapshot by renaming a new symlink over the old one
+        tmp_link = '%s.%d' % (link, os.getpid())
+        os.symlink(name, tmp_link)
+        os.replace(tmp_link, link)
+        app.logger.info('Current snapshot is %s' % path)
+
+        prune_snapshots(snapshot_dir, name)
+    return path
+
+
+def current_snapshot(snapshot_dir):
+    """The name of the current snapshot directory, None if there is none"""
+    try:
+        name = os.readlink(os.path.join(snapshot_dir, CURRENT))
+    except FileNotFoundError:
+        return None
+    return name if name.startswith('v') and name[1:].isdigit() else None
+
+
+@contextmanager
+def snapshot_lock(snapshot_dir):
+    """Holds an exclusive lock on the snapshot directory, shared by every process using it"""
+    with open(os.path.join(snapshot_dir, LOCK), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def render_snapshot(app, path):
+    client = app.test_client()
+    for url in snapshot_urls(app):
+        response = client.get(url)
+        if response.status_code != 200:
+            app.logger.warning('Skipping %s in snapshot, got status %d' % (url, response.status_code))
+            continue
+
+        file_path = os.path.join(path, snapshot_path(url))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.write(response.get_data())
+
+
+def prune_snapshots(snapshot_dir, current_name):
+    names = [name for name in os.listdir(snapshot_dir)
+             if name.startswith('v') and name[1:].isdigit() and name != current_name]
+    names.sort(key=lambda name: int(name[1:]), reverse=True)
+    for name in names[KEEP_SNAPSHOTS - 1:]:
+        shutil.rmtree(os.path.join(snapshot_dir, name), ignore_errors=True)
+
+
+# at most one snapshot is rendered at a time per process, and publishes during a snapshot are
+# coalesced into one more snapshot once it's done
+_snapshot_lock = threading.Lock()
+_snapshot_state = {'running': False, 'pending': False}
+
+
+def schedule_snapshot():
+    """Takes a snapshot in a background thread, if snapshots are enabled"""
+    app = current_app._get_current_object()
+    if not app.config.get('SNAPSHOT_DIR'):  # nothing to do without a snapshot directory
+        return None
+
+    with _snapshot_lock:
+        if _snapshot_state['running']:
+            _snapshot_state['pending'] = True
+            return None
+        _snapshot_state['running'] = True
+
+    thread = threading.Thread(target=_snapshot_worker, args=(app,), daemon=True)
+    thread.start()
+    return thread
+
+
+def _snapshot_worker(app):
+    while True:
+        with app.app_context():
+            try:
+                take_snapshot()
+            except Exception as e:
+                app.logger.error('Taking snapshot failed: %s' % str(e))
+
+        with _snapshot_lock:
+            if not _snapshot_state['pending']:
+                _snapshot_state['running'] = False
+                return
+            _snapshot_state['pending'] = False
+
+
+def snapshot_on_publish(func):
+    """Takes a snapshot of the public endpoints if the function it wraps is successful"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        value = func(*args, **kwargs)
+
+        # snapshot unless the response has a non-default status code and that status code is not successful
+        if not (type(value) == tuple and value[1] >= 300):
+            schedule_snapshot()
+
+        return value
+    return wrapper
@@ -0,0 +1,117 @@
+"""Measures where the time of each request goes, and reports it in a Server-Timing header and a log line.
+
+For each request this records:
+    sql: the number of SQL statements and the time spent executing them, from the queries recorded by
+        Flask-SQLAlchemy (requires ``SQLALCHEMY_RECORD_QUERIES``)
+    orm: the time spent turning query results into ORM objects, measured by `TimedQuery`
+    serialize: the rest of the time spent in the request handlers, i.e. converting and encoding the output
+    total: the time from the start of the request to the response
+    bytes: the size of the response body, unless it's streamed
+
+The ``SERVER_TIMING`` config turns the header and the log line on and off. It's off unless enabled, as the
+header exposes query timings to every client. Time spent while streaming a response body isn't included.
+"""
+from time import perf_counter
+
+from flask import g, has_request_context, json, request
+from flask_sqlalchemy import BaseQuery, get_debug_queries
+
+
+class TimedQuery(BaseQuery):
+    """A query measuring the time spent loading its results, outside of executing SQL statements"""
+
+    def __iter__(self):
+        if not has_request_context() or 'request_timing' not in g:
+            return super(TimedQuery, self).__iter__()
+
+        timing = g.request_timing
+        with timing.orm_segment():
+            rows = super(TimedQuery, self).__iter__()
+        return timing.timed_rows(rows)
+
+
+class RequestTiming(object):
+    """The timings of a single request"""
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.orm = 0.0
+
+    def orm_segment(self):
+        return _OrmSegment(self)
+
+    def timed_rows(self, rows):
+        while True:
+            with self.orm_segment():
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    return
+            yield row
+
+    def metrics(self, response):
+        total = perf_counter() - self.start
+        queries = get_debug_queries()
+        sql = sum(query.duration for query in queries)
+        metrics = {
+            'sqlCount': len(queries),
+            'sqlMs': sql * 1000,
+            'ormMs': self.orm * 1000,
+            'serializeMs': max(total - sql - self.orm, 0) * 1000,
+            'totalMs': total * 1000,
+        }
+        if not response.is_streamed:
+            metrics['bytes'] = response.calculate_content_length()
+        return metrics
+
+
+class _OrmSegment(object):
+    """Adds the time spent in the with block to the ORM time, minus the time of SQL statements executed in it"""
+
+    def __init__(self, timing):
+        self.timing = timing
+
+    def __enter__(self):
+        self.num_queries = len(get_debug_queries())
+        self.start = perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = perf_counter() - self.start
+        sql = sum(query.duration for query in get_debug_queries()[self.num_queries:])
+        self.timing.orm += max(elapsed - sql, 0)
+
+
+def server_timing_header(metrics):
+    header = [
+        'sql;dur=%.1f;desc="%d queries"' % (metrics['sqlMs'], metrics['sqlCount']),
+        'orm;dur=%.1f' % metrics['ormMs'],
+        'serialize;dur=%.1f' % metrics['serializeMs'],
+        'total;dur=%.1f' % metrics['totalMs'],
+    ]
+    if 'bytes' in metrics:
+        header.append('bytes;desc="%d"' % metrics['bytes'])
+    return ', '.join(header)
+
+
+def init_request_timing(app):
+    app.config.setdefault('SERVER_TIMING', False)
+
+    @app.before_request
+    def start_request_timing():
+        if app.config['SERVER_TIMING']:
+            g.request_timing = RequestTiming()
+
+    @app.after_request
+    def report_request_timing(response):
+        timing = g.pop('request_timing', None)
+        if timing is None:
+            return response
+
+        metrics = timing.metrics(response)
+        response.headers['Server-Timing'] = server_timing_header(metrics)
+
+        log_line = {'method': request.method, 'path': request.full_path.rstrip('?'),
+                    'status': response.status_code}
+        log_line.update({k: round(v, 1) if isinstance(v, float) else v for k, v in metrics.items()})
+        app.logger.info('request_timing %s' % json.dumps(log_line))
+        return response
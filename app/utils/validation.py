@@ -1,51 +1,102 @@
 """Validation module for various API methods. """
+import functools
 
 from app.models.data import *
 
 
-def validate_non_empty_fields(payload):
-    # check non-empty fields
-    core_data_dicts = payload['coreData']
-    required_fields = ['state', 'date']
-    for core_data_dict in core_data_dicts:
-        for field in required_fields:
-            # should fail if missing field or empty string
-            if not core_data_dict.get(field):
-                raise ValueError(f"Missing value for '{field}' in row: {core_data_dict}")
-
-
-def validate_numeric_fields(payload):
-    # validate data fields: check that all numeric fields, if not null, are numeric and non-negative
-    numeric_fields = CoreData.numeric_fields()
-    core_data_dicts = payload['coreData']
-    for core_data_dict in core_data_dicts:
-        for field in numeric_fields:
-            value = core_data_dict.get(field)
-            state = core_data_dict.get('state')
-            if value is not None:
-                # if not an integer, error out
-                try:
-                    int_value = int(value)
-                except ValueError:
-                    raise ValueError(f"Non-numeric value for field '{state} {field}': {value}")
-                # if negative integer, error out
-                if int_value < 0:
-                    raise ValueError(f"Negative value for field '{state} {field}': {value}")
-
-
-def validate_no_unknown_fields(payload):
-    core_data_dicts = payload['coreData']
-    for core_data_dict in core_data_dicts:
-        _, unknown = CoreData.valid_fields_checker(core_data_dict)
+class PayloadValidationError(ValueError):
+    """Raised by the payload validators when collecting all the errors of a payload.
+
+    ``errors`` is a list of ``(row, message)`` tuples, where ``row`` is the index of the coreData row with the
+    error, or None for errors in the rest of the payload.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(PayloadValidationError, self).__init__('\n'.join(
+            message if row is None else 'coreData[%d]: %s' % (row, message) for row, message in errors))
+
+
+class CoreDataValidator(object):
+    """Checks coreData rows in a single pass, with the CoreData fields looked up once.
+
+    Each row is checked for:
+        numeric fields: if not null, the value must be a non-negative integer
+        required fields: "state" and "date" must be present and not empty
+        unknown fields: every field must be a CoreData attribute (or the lastUpdateIsoUtc alias)
+    """
+    required_fields = ('state', 'date')
+
+    def __init__(self):
+        numeric_fields = CoreData.numeric_fields()
+        self.numeric_fields = frozenset(numeric_fields)
+        # errors within a row are reported in the order of the table columns
+        self.field_order = {field: i for i, field in enumerate(numeric_fields)}
+        mapper_fields, _ = CoreData.mapper_fields()
         # lastUpdateIsoUtc can come in as an argument, gets converted to lastUpdateTime internally;
         # we don't error on its presence
-        unknown.discard('lastUpdateIsoUtc')
-        if unknown:
-            raise ValueError("Unknown field(s) in CoreData: %s" % ', '.join(unknown))
-
+        self.known_fields = mapper_fields | {'lastUpdateIsoUtc'}
+
+    def row_errors(self, core_data_dict):
+        """Returns the error messages of a single row, in the order the checks are listed above"""
+        errors = []
+        state = core_data_dict.get('state')
+
+        bad_fields = []
+        numeric_fields = self.numeric_fields
+        for field, value in core_data_dict.items():
+            # non-negative integers are by far the most common, so check for those first
+            if value is None or field not in numeric_fields or (type(value) is int and value >= 0):
+                continue
+            # if not an integer, error out
+            try:
+                int_value = int(value)
+            except (TypeError, ValueError):
+                bad_fields.append((field, f"Non-numeric value for field '{state} {field}': {value}"))
+                continue
+            # if negative integer, error out
+            if int_value < 0:
+                bad_fields.append((field, f"Negative value for field '{state} {field}': {value}"))
+        if bad_fields:
+            bad_fields.sort(key=lambda bad_field: self.field_order[bad_field[0]])
+            errors.extend(message for _, message in bad_fields)
+
+        for field in self.required_fields:
+            # should fail if missing field or empty string
+            if not core_data_dict.get(field):
+                errors.append(f"Missing value for '{field}' in row: {core_data_dict}")
 
-# Returns a string with any errors if the payload is invalid, otherwise returns empty string.
-def validate_core_data_payload(payload):
+        unknown = core_data_dict.keys() - self.known_fields
+        if unknown:
+            errors.append("Unknown field(s) in CoreData: %s" % ', '.join(sorted(unknown)))
+        return errors
+
+    def validate(self, core_data_dicts, collect_all=False):
+        """Checks every row. Raises a ValueError with the first error found, or with `collect_all` a
+        `PayloadValidationError` with every error found"""
+        errors = []
+        row_errors = self.row_errors
+        for i, core_data_dict in enumerate(core_data_dicts):
+            if not isinstance(core_data_dict, dict):
+                messages = ['Expected an object, got: %r' % (core_data_dict,)]
+            else:
+                messages = row_errors(core_data_dict)
+            if messages:
+                if not collect_all:
+                    raise ValueError(messages[0])
+                errors.extend((i, message) for message in messages)
+        if errors:
+            raise PayloadValidationError(errors)
+
+
+@functools.lru_cache(maxsize=None)
+def core_data_validator():
+    return CoreDataValidator()
+
+
+# Raises a ValueError with the first error if the payload is invalid, or with `collect_all` a
+# PayloadValidationError with all the errors in the coreData rows.
+def validate_core_data_payload(payload, collect_all=False):
     # test the input data
     if 'context' not in payload:
         raise ValueError("Payload requires 'context' field")
@@ -55,13 +106,12 @@ def validate_core_data_payload(payload):
     if 'coreData' not in payload or not payload['coreData']:
         raise ValueError("Payload requires 'coreData' field with at least one entry")
 
-    validate_numeric_fields(payload)
-    validate_non_empty_fields(payload)
-    validate_no_unknown_fields(payload)
+    core_data_validator().validate(payload['coreData'], collect_all)
 
 
-# Returns a string with any errors if the payload is invalid, otherwise returns empty string.
-def validate_edit_data_payload(payload):
+# Raises a ValueError with the first error if the payload is invalid, or with `collect_all` a
+# PayloadValidationError with all the errors in the coreData rows.
+def validate_edit_data_payload(payload, collect_all=False):
     # check push context
     if 'context' not in payload:
         raise ValueError("Payload requires 'context' field")
@@ -78,9 +128,7 @@ def validate_edit_data_payload(payload):
     if 'coreData' not in payload or not payload['coreData']:
         raise ValueError("Payload requires 'coreData' field with at least one entry")
 
-    validate_numeric_fields(payload)
-    validate_non_empty_fields(payload)
-    validate_no_unknown_fields(payload)
+    core_data_validator().validate(payload['coreData'], collect_all)
 
     # check that the context state matches JSON data state, of which there should be only one
     context_state = context['state']
@@ -1,48 +1,153 @@
 """Used to call out to an external webhook (i.e. the public API build tool)
  when publishing new data to the database. The webhook URL is set in the
- environment with the `API_WEBHOOK_URL` variable"""
+ environment with the `API_WEBHOOK_URL` variable.
+
+ Notifications within the debounce window (`WEBHOOK_DEBOUNCE`, in seconds) are coalesced into one
+ webhook call. The webhook URL is called with a GET, or with `WEBHOOK_METHOD` set to "POST", POSTed a
+ JSON payload of the states, dates and batchIds that changed, e.g.
+ ``{"states": ["NY"], "dates": ["2020-05-24"], "batchIds": [12]}``.
+
+ Windows are per app process, so with several workers the webhook can be called once per window by
+ each of them. Pending notifications are sent when the process exits normally (e.g. a gunicorn worker
+ restarting), but are lost if it's killed."""
+import atexit
 import functools
+import threading
+
 import requests
-from flask import current_app
+from flask import current_app, g
 
+from app.utils.delivery import deliver_in_background, deliver_now
 from app.utils.slacknotifier import notify_slack_error
 
 
 def notify_webhook(func):
     """Notifies a webhook (defined in the config with "API_WEBHOOK_URL") if the function it wraps is successful.
-    Used to kick off the public API build after data changes."""
+    Used to kick off the public API build after data changes, with the changes the function recorded with
+    `record_webhook_changes`."""
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
+        g.webhook_changes = WebhookChanges()
         value = func(*args, **kwargs)
 
         # notify the webhook unless the response has a non-default status code and that status code is not successful
         if not (type(value) == tuple and value[1] >= 300):
-            do_notify_webhook()
+            do_notify_webhook(g.webhook_changes)
 
         return value
     return wrapper
 
 
-def do_notify_webhook():
+def record_webhook_changes(states=(), dates=(), batch_ids=()):
+    """Record data changes of the current request, to be sent with the webhook call by `notify_webhook`"""
+    changes = g.get('webhook_changes')
+    if changes is not None:
+        changes.update(states, dates, batch_ids)
+
+
+class WebhookChanges(object):
+    """The states, dates and batchIds changed by one or more requests"""
+
+    def __init__(self):
+        self.states = set()
+        self.dates = set()
+        self.batch_ids = set()
+
+    def update(self, states=(), dates=(), batch_ids=()):
+        self.states.update(states)
+        self.dates.update(dates)
+        self.batch_ids.update(batch_ids)
+
+    def to_payload(self):
+        return {
+            'states': sorted(self.states),
+            'dates': sorted(d.isoformat() for d in self.dates),
+            'batchIds': sorted(self.batch_ids),
+        }
+
+
+class WebhookDebouncer(object):
+    """Coalesces the webhook notifications within a debounce window into a single webhook call"""
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.pending = None
+        self.timer = None
+        # the window's timer thread doesn't keep the process alive, so don't lose the pending changes
+        atexit.register(self.flush, background=False)
+
+    def add(self, changes):
+        window = self.app.config['WEBHOOK_DEBOUNCE']
+        with self.lock:
+            if self.pending is None:
+                self.pending = WebhookChanges()
+            self.pending.update(changes.states, changes.dates, changes.batch_ids)
+
+            if window > 0:
+                # the window starts with the first notification, so a steady stream of them still
+                # calls the webhook once per window
+                if self.timer is None:
+                    self.timer = threading.Timer(window, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return True
+        return self.flush()
+
+    def flush(self, background=True):
+        """Queue the webhook call for the pending notifications now, returns False if there are none.
+        If not `background`, the webhook is called in the calling thread instead."""
+        with self.lock:
+            changes, self.pending = self.pending, None
+            timer, self.timer = self.timer, None
+        if timer is not None:
+            timer.cancel()
+        if changes is None:
+            return False
+
+        with self.app.app_context():
+            url = current_app.config['API_WEBHOOK_URL']
+            if not url:
+                return False
+            deliver = deliver_in_background if background else deliver_now
+            return deliver('webhook', call_webhook, url, changes.to_payload(), on_failure=report_webhook_failure)
+
+
+def webhook_debouncer():
+    app = current_app._get_current_object()
+    if 'webhook_debouncer' not in app.extensions:
+        app.extensions['webhook_debouncer'] = WebhookDebouncer(app)
+    return app.extensions['webhook_debouncer']
+
+
+class WebhookError(Exception):
+    pass
+
+
+def do_notify_webhook(changes=None):
+    """Queues a call to the webhook with `changes` at the end of the debounce window, returns False if there's
+    no webhook"""
     url = current_app.config['API_WEBHOOK_URL']
     if not url:  # nothing to do for dev environments without a url set
-        return
-
-    try:
-        response = requests.get(url)
-    except Exception as e:
-        current_app.logger.warning(
-            'Request to webhook %s failed returned an error: %s' % (url, str(e)))
-        notify_slack_error(f"notify_webhook failed: #{str(e)}", "do_notify_webhook")
         return False
 
-    if response.status_code != 200:
-        # log an error but do not raise an exception
-        # This method would usually run *after a commit*, as a best-effort
-        # method, it should not fail a response to the user
-        current_app.logger.error(
-            'Request to webhook %s finished unsuccessfully: %s, the response is:\n%s'
-            % (url, response.status_code, response.text))
-        notify_slack_error(f"notify_webhook failed (#{response.status_code}): #{response.text}", "do_notify_webhook")
+    return webhook_debouncer().add(changes or WebhookChanges())
+
 
+def call_webhook(url, payload):
+    timeout = current_app.config['DELIVERY_TIMEOUT']
+    if current_app.config['WEBHOOK_METHOD'].upper() == 'POST':
+        response = requests.post(url, json=payload, timeout=timeout)
+    else:
+        response = requests.get(url, timeout=timeout)
+    if response.status_code != 200:
+        raise WebhookError('(#%s): #%s' % (response.status_code, response.text))
     return response
+
+
+def report_webhook_failure(error):
+    # This runs *after a commit* and outside of the request, as a best-effort method, so the
+    # failure is only reported
+    url = current_app.config['API_WEBHOOK_URL']
+    current_app.logger.error('Request to webhook %s failed: %s' % (url, str(error)))
+    notify_slack_error(f"notify_webhook failed: {str(error)}", "do_notify_webhook")
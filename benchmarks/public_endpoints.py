@@ -0,0 +1,282 @@
+"""Times the public read endpoints, the CSV endpoints and edit_states_daily against a realistic amount of data
+in a throwaway testing.postgresql database, and writes the results as JSON.
+
+The dataset has a published daily batch for every day with a row for every state, and a number of
+published revision (edit) batches per day, each revising the last week of a state. The response cache
+is disabled, so every request is served from the database.
+
+Run from the repository root with::
+
+    python -m benchmarks.public_endpoints --output results.json
+    python -m benchmarks.public_endpoints --output new.json --compare results.json
+"""
+import argparse
+from datetime import datetime, timedelta
+import json
+import random
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+import pytz
+import testing.postgresql
+
+from app import create_app, db
+from app.api.common import RESEARCH_CUTOFF_DATE, update_latest_batches
+from app.auth.auth_cli import getToken
+from app.models.data import Batch, CoreData, State, population_lookup
+
+
+# the dataset ends on the last date served outside of "research" mode
+LAST_DATE = RESEARCH_CUTOFF_DATE
+# days revised by each revision batch
+REVISION_DAYS = 7
+
+# (name, method, url): the endpoints to time, {state} is replaced with the state to benchmark
+READ_ENDPOINTS = [
+    ('v1 states daily', 'GET', '/api/v1/public/states/daily'),
+    ('v1 states daily 4 fields', 'GET', '/api/v1/public/states/daily?fields=date,state,positive,totalTestResults'),
+    ('v1 state daily', 'GET', '/api/v1/public/states/{state}/daily'),
+    ('v1 us daily', 'GET', '/api/v1/public/us/daily'),
+    ('v2 states daily simple', 'GET', '/api/v2/public/states/daily/simple'),
+    ('v2 states daily full', 'GET', '/api/v2/public/states/daily'),
+    ('v2 states daily 30 days', 'GET', '/api/v2/public/states/daily?days=30'),
+    ('v2 us daily full', 'GET', '/api/v2/public/us/daily'),
+    ('csv states daily', 'GET', '/api/v1/public/states/daily.csv'),
+    ('csv states current', 'GET', '/api/v1/public/states/current.csv'),
+    ('csv us daily', 'GET', '/api/v1/public/us/daily.csv'),
+    ('csv internal states daily', 'GET', '/api/v1/internal/states/daily.csv'),
+]
+EDIT_ENDPOINT = ('edit states daily', 'POST', '/api/v1/batches/edit_states_daily')
+
+
+class BenchmarkConfig:
+    def __init__(self):
+        self.test_db = testing.postgresql.Postgresql()
+
+    @property
+    def SQLALCHEMY_DATABASE_URI(self):
+        return self.test_db.url()
+
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_RECORD_QUERIES = True
+
+    SECRET_KEY = '12345'
+    API_WEBHOOK_URL = ''
+    SLACK_API_TOKEN = ''
+    SLACK_CHANNEL = ''
+
+    # time the database and serialization work, not the cache
+    RESPONSE_CACHE_BYTES = 0
+    # the per request breakdown is read from the Server-Timing header
+    SERVER_TIMING = True
+
+    @staticmethod
+    def init_app(app):
+        pass
+
+
+def all_states():
+    population_lookup('US')  # loads the lookup table
+    from app.models.data import _POPULATION_MAP
+    return sorted(state for state in _POPULATION_MAP if state != 'US')
+
+
+def core_data_row(state, day, n, batch_id, scale):
+    """A CoreData row dict for the `n`th day, with cumulative values growing over time so the derived values
+    look realistic"""
+    positive = n * scale
+    return {
+        'state': state, 'date': day, 'batchId': batch_id,
+        'positive': positive, 'negative': positive * 9, 'totalTestsViral': positive * 10,
+        'hospitalizedCurrently': scale * 3, 'hospitalizedCumulative': n * scale // 10,
+        'inIcuCurrently': scale, 'onVentilatorCurrently': scale // 2,
+        'recovered': positive // 2, 'death': n * scale // 50,
+        'dateChecked': datetime(day.year, day.month, day.day, 20, tzinfo=pytz.utc),
+    }
+
+
+def new_batch(data_entry_type, created_at):
+    batch = Batch(dataEntryType=data_entry_type, createdAt=created_at, publishedAt=created_at,
+                  shiftLead='benchmark', batchNote='benchmark data', isPublished=True,
+                  isRevision=data_entry_type == 'edit')
+    db.session.add(batch)
+    db.session.flush()
+    return batch
+
+
+def load_dataset(states, num_days, revisions_per_day, seed=0):
+    """Loads the dataset in the current app context, returns the number of CoreData rows"""
+    rng = random.Random(seed)
+    scales = {state: rng.randint(10, 5000) for state in states}
+    db.session.add_all(State(state=state, name=state, totalTestResultsFieldDbColumn=rng.choice(
+        ['posNeg', 'totalTestsViral'])) for state in states)
+    db.session.flush()
+
+    num_rows = 0
+    first_date = LAST_DATE - timedelta(days=num_days - 1)
+    for i in range(num_days):
+        day = first_date + timedelta(days=i)
+        created_at = datetime(day.year, day.month, day.day, 22, tzinfo=pytz.utc) + timedelta(days=1)
+        batch = new_batch('daily', created_at)
+        num_rows += len(CoreData.insert_rows(
+            [core_data_row(state, day, i, batch.batchId, scales[state]) for state in states]))
+        update_latest_batches(batch.batchId)
+
+        for j in range(revisions_per_day):
+            state = rng.choice(states)
+            batch = new_batch('edit', created_at + timedelta(minutes=j + 1))
+            num_rows += len(CoreData.insert_rows(
+                [core_data_row(state, day - timedelta(days=k), i - k, batch.batchId, scales[state] + j + 1)
+                 for k in range(min(REVISION_DAYS, i + 1))]))
+            update_latest_batches(batch.batchId)
+
+    db.session.commit()
+    return num_rows
+
+
+def edit_payload(state, iteration):
+    """An edit of the last week of `state`, different for each iteration so it's never a no-op"""
+    return {
+        'context': {
+            'dataEntryType': 'edit', 'state': state, 'shiftLead': 'benchmark',
+            'batchNote': 'benchmark edit %d' % iteration, 'logCategory': 'State Updates',
+            'link': 'https://example.com',
+        },
+        'coreData': [{'state': state, 'date': (LAST_DATE - timedelta(days=k)).isoformat(),
+                      'positive': 1000000 + iteration, 'negative': 2000000 + iteration}
+                     for k in range(REVISION_DAYS)],
+    }
+
+
+def parse_sql_count(response):
+    for metric in response.headers.get('Server-Timing', '').split(', '):
+        name, *params = metric.split(';')
+        if name == 'sql':
+            return int(dict(param.split('=', 1) for param in params)['desc'].strip('"').split()[0])
+    return None
+
+
+def time_request(client, method, url, **kwargs):
+    start = perf_counter()
+    response = client.open(url, method=method, **kwargs)
+    # streamed bodies are only built when read
+    body = response.get_data()
+    elapsed = perf_counter() - start
+    return elapsed, response, body
+
+
+def summarize(url, method, times, response, body):
+    return {
+        'method': method,
+        'url': url,
+        'status': response.status_code,
+        'bytes': len(body),
+        'sqlCount': parse_sql_count(response),
+        'minMs': min(times) * 1000,
+        'medianMs': statistics.median(times) * 1000,
+        'meanMs': statistics.mean(times) * 1000,
+        'maxMs': max(times) * 1000,
+        'timesMs': [t * 1000 for t in times],
+    }
+
+
+def run_benchmarks(app, repeat, state):
+    """Times every endpoint `repeat` times after a warm-up request, returns the results by endpoint name"""
+    client = app.test_client()
+    results = {}
+    for name, method, url in READ_ENDPOINTS:
+        url = url.format(state=state.lower())
+        time_request(client, method, url)
+        times = []
+        for _ in range(repeat):
+            elapsed, response, body = time_request(client, method, url)
+            times.append(elapsed)
+        if response.status_code != 200:
+            raise RuntimeError('%s failed (%d): %s' % (name, response.status_code, body))
+        results[name] = summarize(url, method, times, response, body)
+
+    with app.app_context():
+        headers = {'Authorization': 'Bearer {}'.format(getToken('benchmark'))}
+    name, method, url = EDIT_ENDPOINT
+    times = []
+    for i in range(repeat + 1):
+        elapsed, response, body = time_request(
+            client, method, url, data=json.dumps(edit_payload(state, i)),
+            content_type='application/json', headers=headers)
+        if response.status_code != 201:
+            raise RuntimeError('%s failed (%d): %s' % (name, response.status_code, body))
+        if i > 0:  # warm-up
+            times.append(elapsed)
+    results[name] = summarize(url, method, times, response, body)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    for name, result in results.items():
+        line = '%-26s %8.1f ms median  %8.1f ms min  %10d bytes  %4s queries' % (
+            name, result['medianMs'], result['minMs'], result['bytes'], result['sqlCount'])
+        if baseline and name in baseline['results']:
+            before = baseline['results'][name]['medianMs']
+            line += '  %+6.1f%% vs baseline' % ((result['medianMs'] - before) / before * 100)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--states', type=int, default=56, help='number of states')
+    parser.add_argument('--days', type=int, default=420, help='days of history per state')
+    parser.add_argument('--revisions', type=int, default=3, help='revision batches per day')
+    parser.add_argument('--repeat', type=int, default=5, help='timed requests per endpoint')
+    parser.add_argument('--output', help='file to write the JSON results to, defaults to stdout')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+
+    config = BenchmarkConfig()
+    try:
+        app = create_app(config)
+        states = all_states()[:args.states]
+        with app.app_context():
+            db.create_all()
+            start = perf_counter()
+            num_rows = load_dataset(states, args.days, args.revisions)
+            print('Loaded %d rows in %.1fs' % (num_rows, perf_counter() - start), file=sys.stderr)
+
+        results = run_benchmarks(app, args.repeat, 'NY' if 'NY' in states else states[0])
+    finally:
+        config.test_db.stop()
+
+    output = {
+        'createdAt': datetime.now(pytz.utc).isoformat(),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'dataset': {'states': len(states), 'days': args.days, 'revisionsPerDay': args.revisions,
+                    'coreDataRows': num_rows},
+        'repeat': args.repeat,
+        'results': results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['dataset'] != output['dataset']:
+            print('Warning: the baseline used a different dataset: %s' % baseline['dataset'], file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+        print_results(results, baseline)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""Replays a JSONL access log against a running API server at a given concurrency and rate, and reports the
+throughput, latency percentiles and errors per endpoint.
+
+Each line of the log is a request, e.g.::
+
+    {"method": "GET", "path": "/api/v1/public/states/ny/daily", "query": "research=true",
+     "headers": {"Accept-Encoding": "gzip"}}
+
+``method`` defaults to GET, and ``query`` is either a query string or a dict of parameters. Requests are
+grouped by route (e.g. ``/api/v1/public/states/<string:state>/daily``) in the report, and by path for
+paths that aren't routes of the app.
+
+Run from the repository root with::
+
+    python -m benchmarks.replay access-log.jsonl --url http://localhost:8000 --concurrency 8 --rate 50
+
+With ``--rate``, latencies are measured from when each request was due to be sent, so requests queued
+behind a slow server count as slow instead of holding back the rate.
+"""
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import sys
+import threading
+from time import perf_counter, sleep
+
+import requests
+from werkzeug.exceptions import HTTPException
+
+
+class LogEntry(object):
+    """A request from the access log"""
+
+    def __init__(self, method, path, query=None, headers=None):
+        self.method = method.upper()
+        self.path = path
+        self.query = query
+        self.headers = headers or {}
+
+    @classmethod
+    def from_json(cls, line):
+        data = json.loads(line)
+        if 'path' not in data:
+            raise ValueError('Access log entry without a path: %s' % line.strip())
+        return cls(data.get('method', 'GET'), data['path'], data.get('query'), data.get('headers'))
+
+
+def read_log(lines):
+    return [LogEntry.from_json(line) for line in lines if line.strip()]
+
+
+class RouteMatcher(object):
+    """Maps request paths to the app's route rules"""
+
+    def __init__(self, app):
+        self.adapter = app.url_map.bind('localhost')
+
+    def __call__(self, method, path):
+        try:
+            rule, _ = self.adapter.match(path, method=method, return_rule=True)
+            return rule.rule
+        except HTTPException:
+            return path
+
+
+def percentile(sorted_values, p):
+    """The `p`th percentile of `sorted_values`, by the nearest-rank method"""
+    if not sorted_values:
+        return None
+    rank = max(int(math.ceil(p / 100.0 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+class ReplayStats(object):
+    """Latencies and errors of replayed requests, per endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint, latency, error=None):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            if error is not None:
+                self.errors[endpoint][error] += 1
+
+    def report(self, elapsed):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            endpoints[endpoint] = {
+                'requests': len(latencies),
+                'throughput': len(latencies) / elapsed if elapsed else None,
+                'p50Ms': percentile(latencies, 50) * 1000,
+                'p95Ms': percentile(latencies, 95) * 1000,
+                'p99Ms': percentile(latencies, 99) * 1000,
+                'maxMs': latencies[-1] * 1000,
+                'errors': dict(self.errors.get(endpoint, {})),
+            }
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            'requests': total,
+            'elapsedSeconds': elapsed,
+            'throughput': total / elapsed if elapsed else None,
+            'errors': sum(sum(errors.values()) for errors in self.errors.values()),
+            'endpoints': endpoints,
+        }
+
+
+def http_sender(base_url, timeout):
+    """Returns a function sending a log entry to `base_url`, with a requests session per thread"""
+    local = threading.local()
+
+    def send(entry):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        response = local.session.request(entry.method, base_url.rstrip('/') + entry.path, params=entry.query,
+                                         headers=entry.headers, timeout=timeout)
+        # read the whole body, like a client would
+        response.content
+        return response.status_code
+    return send
+
+
+def replay(entries, send, endpoint_of, concurrency=1, rate=None):
+    """Sends every entry with `send` from `concurrency` threads, at most `rate` requests per second.
+
+    `send` returns the status code of the response, `endpoint_of` maps a method and path to the endpoint
+    to report it under. Returns the report of `ReplayStats`.
+    """
+    stats = ReplayStats()
+    # bounds the requests waiting for a thread, so the schedule isn't run ahead of a slow server
+    slots = threading.Semaphore(concurrency * 2)
+
+    def run(entry, due):
+        try:
+            error = None
+            try:
+                status = send(entry)
+                if status >= 400:
+                    error = str(status)
+            except Exception as e:
+                error = type(e).__name__
+            stats.record(endpoint_of(entry.method, entry.path), perf_counter() - due, error)
+        finally:
+            slots.release()
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i, entry in enumerate(entries):
+            due = start + i / rate if rate else None
+            if due is not None and due > perf_counter():
+                sleep(due - perf_counter())
+            slots.acquire()
+            executor.submit(run, entry, due if due is not None else perf_counter())
+    return stats.report(perf_counter() - start)
+
+
+def print_report(report):
+    print('%d requests in %.1fs: %.1f requests/s, %d errors' % (
+        report['requests'], report['elapsedSeconds'], report['throughput'] or 0, report['errors']))
+    for endpoint, result in report['endpoints'].items():
+        errors = ', '.join('%s: %d' % error for error in sorted(result['errors'].items()))
+        print('%-55s %6d  %7.1f/s  p50 %7.1f ms  p95 %7.1f ms  p99 %7.1f ms  %s' % (
+            endpoint, result['requests'], result['throughput'] or 0, result['p50Ms'], result['p95Ms'],
+            result['p99Ms'], errors))
+
+
+def replay_app():
+    """An app to match paths to routes with, the database isn't used"""
+    from app import create_app
+
+    class ReplayConfig:
+        SQLALCHEMY_DATABASE_URI = 'postgresql://'
+        SQLALCHEMY_TRACK_MODIFICATIONS = False
+        SECRET_KEY = 'unused'
+        API_WEBHOOK_URL = ''
+        SLACK_API_TOKEN = ''
+        SLACK_CHANNEL = ''
+
+        @staticmethod
+        def init_app(app):
+            pass
+
+    return create_app(ReplayConfig())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('log', help='JSONL access log, - for stdin')
+    parser.add_argument('--url', default='http://localhost:8000', help='base URL of the server')
+    parser.add_argument('--concurrency', type=int, default=4, help='requests in flight at once')
+    parser.add_argument('--rate', type=float, help='requests per second, defaults to as fast as possible')
+    parser.add_argument('--repeat', type=int, default=1, help='times to replay the log')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for each response')
+    parser.add_argument('--output', help='file to also write the JSON report to')
+    args = parser.parse_args()
+
+    if args.log == '-':
+        entries = read_log(sys.stdin)
+    else:
+        with open(args.log) as f:
+            entries = read_log(f)
+
+    report = replay(entries * args.repeat, http_sender(args.url, args.timeout), RouteMatcher(replay_app()),
+                    args.concurrency, args.rate)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
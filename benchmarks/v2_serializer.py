@@ -0,0 +1,86 @@
+"""Compares the per-row cost of building v2 output with the recursive mapping walk and with the
+compiled mapping, on a synthetic full states history.
+
+Run from the repository root with::
+
+    python -m benchmarks.v2_serializer
+"""
+import argparse
+import copy
+from datetime import date, timedelta
+import random
+from time import perf_counter
+
+from app.api.mappings_v2 import _MAPPING
+from app.api.public_v2 import ArrayValuesCalculator, recursive_tree_to_output, \
+    convert_state_core_data_to_simple_output, convert_state_core_data_to_full_output
+from app.models.data import CoreData, State, population_lookup
+
+
+def states_history(num_days):
+    """Returns CoreData rows for every state for ``num_days`` days, newest first"""
+    random.seed(0)
+    population_lookup('US')  # loads the lookup table
+    from app.models.data import _POPULATION_MAP
+    states = [State(state=state, totalTestResultsFieldDbColumn='posNeg')
+              for state in sorted(_POPULATION_MAP) if state != 'US']
+    first_date = date(2020, 3, 7) + timedelta(days=num_days)
+    rows = []
+    for i in range(num_days):
+        for state in states:
+            values = {field: random.randint(0, 1000000) for field in CoreData.numeric_fields()}
+            row = CoreData(state=state.state, date=first_date - timedelta(days=i), **values)
+            row.state_obj = state
+            rows.append(row)
+    return rows
+
+
+def recursive_simple(row, calculator):
+    tree = copy.deepcopy(_MAPPING)
+    recursive_tree_to_output(tree, row)
+    return tree
+
+
+def recursive_full(row, calculator):
+    tree = copy.deepcopy(_MAPPING)
+    recursive_tree_to_output(tree, row, calculator)
+    return tree
+
+
+def compiled_simple(row, calculator):
+    return convert_state_core_data_to_simple_output(row)
+
+
+def compiled_full(row, calculator):
+    return convert_state_core_data_to_full_output(row, calculator)
+
+
+def time_per_row(convert, rows, calculator):
+    t1 = perf_counter()
+    for row in rows:
+        convert(row, calculator)
+    return (perf_counter() - t1) / len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=int, default=400, help='days of history per state')
+    args = parser.parse_args()
+
+    rows = states_history(args.days)
+    calculator = ArrayValuesCalculator(rows)
+    # compute all derived values up front so only the serialization is timed
+    for row in rows[:1]:
+        convert_state_core_data_to_full_output(row, calculator)
+
+    print('%d rows' % len(rows))
+    for mode, before, after in [('simple', recursive_simple, compiled_simple),
+                                ('full', recursive_full, compiled_full)]:
+        before_cost = time_per_row(before, rows, calculator)
+        after_cost = time_per_row(after, rows, calculator)
+        print('%-6s  recursive: %7.1f us/row  compiled: %7.1f us/row  (%.1fx)' % (
+            mode, before_cost * 1e6, after_cost * 1e6, before_cost / after_cost))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,4 +9,16 @@ while true; do
     sleep 5
 done
 
+# Gunicorn workers write their Prometheus metrics here, for /metrics to aggregate them. Metrics of
+# the previous run don't apply anymore
+export prometheus_multiproc_dir=${prometheus_multiproc_dir:-/tmp/prometheus-metrics}
+rm -rf "$prometheus_multiproc_dir"
+mkdir -p "$prometheus_multiproc_dir"
+
+# Responses too big for the in-process response cache are cached here, per data version. The data versions
+# of the previous run may not match the database anymore
+export RESPONSE_CACHE_DIR=${RESPONSE_CACHE_DIR:-/tmp/response-cache}
+rm -rf "$RESPONSE_CACHE_DIR"
+mkdir -p "$RESPONSE_CACHE_DIR"
+
 exec gunicorn -c gunicorn.ini flask_server:app
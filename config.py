@@ -28,9 +28,25 @@ class LocalPSQLConfig:
     JWT_ACCESS_TOKEN_EXPIRES = env_conf('JWT_ACCESS_TOKEN_EXPIRES', cast=int, default=False)
 
     API_WEBHOOK_URL = env_conf('API_WEBHOOK_URL', cast=str, default='')
+    # seconds to coalesce webhook notifications for, before calling the webhook once
+    WEBHOOK_DEBOUNCE = env_conf('WEBHOOK_DEBOUNCE', cast=float, default=30)
+    # GET the webhook URL, or POST it a JSON payload of the changes
+    WEBHOOK_METHOD = env_conf('WEBHOOK_METHOD', cast=str, default='GET')
     SLACK_API_TOKEN = env_conf('SLACK_API_TOKEN', cast=str, default='')
     SLACK_CHANNEL = env_conf('SLACK_CHANNEL', cast=str, default='')
 
+    # max bytes of public endpoint responses to cache per process, 0 to disable
+    RESPONSE_CACHE_BYTES = env_conf('RESPONSE_CACHE_BYTES', cast=int, default=128 * 1024 * 1024)
+    # bigger responses aren't cached, and streamed responses stop being buffered past this size
+    RESPONSE_CACHE_MAX_ENTRY_BYTES = env_conf(
+        'RESPONSE_CACHE_MAX_ENTRY_BYTES', cast=int, default=16 * 1024 * 1024)
+    # directory to cache bigger responses in, shared by the app processes, empty to not cache them
+    RESPONSE_CACHE_DIR = env_conf('RESPONSE_CACHE_DIR', cast=str, default='')
+    # directory to render static snapshots of the public endpoints into on publish, empty to disable
+    SNAPSHOT_DIR = env_conf('SNAPSHOT_DIR', cast=str, default='')
+    # report per request timings in a Server-Timing header and a log line
+    SERVER_TIMING = env_conf('SERVER_TIMING', cast=bool, default=True)
+
     @staticmethod
     def init_app(app):
         # The default Flask logger level is set at ERROR, so if you want to see
@@ -61,9 +77,26 @@ class Production:
     JWT_ACCESS_TOKEN_EXPIRES = env_conf('JWT_ACCESS_TOKEN_EXPIRES', cast=int, default=False)
 
     API_WEBHOOK_URL = env_conf('API_WEBHOOK_URL', cast=str, default='')
+    # seconds to coalesce webhook notifications for, before calling the webhook once
+    WEBHOOK_DEBOUNCE = env_conf('WEBHOOK_DEBOUNCE', cast=float, default=30)
+    # GET the webhook URL, or POST it a JSON payload of the changes
+    WEBHOOK_METHOD = env_conf('WEBHOOK_METHOD', cast=str, default='GET')
     SLACK_API_TOKEN = env_conf('SLACK_API_TOKEN', cast=str, default='')
     SLACK_CHANNEL = env_conf('SLACK_CHANNEL', cast=str, default='')
 
+    # max bytes of public endpoint responses to cache per process, 0 to disable
+    RESPONSE_CACHE_BYTES = env_conf('RESPONSE_CACHE_BYTES', cast=int, default=128 * 1024 * 1024)
+    # bigger responses aren't cached, and streamed responses stop being buffered past this size
+    RESPONSE_CACHE_MAX_ENTRY_BYTES = env_conf(
+        'RESPONSE_CACHE_MAX_ENTRY_BYTES', cast=int, default=16 * 1024 * 1024)
+    # directory to cache bigger responses in, shared by the app processes, empty to not cache them
+    RESPONSE_CACHE_DIR = env_conf('RESPONSE_CACHE_DIR', cast=str, default='')
+    # directory to render static snapshots of the public endpoints into on publish, empty to disable
+    SNAPSHOT_DIR = env_conf('SNAPSHOT_DIR', cast=str, default='')
+    # report per request timings in a Server-Timing header and a log line. Off in production, where
+    # the header would tell any client how long its queries take
+    SERVER_TIMING = env_conf('SERVER_TIMING', cast=bool, default=False)
+
     @staticmethod
     def init_app(app):
         # The default Flask logger level is set at ERROR, so if you want to see
@@ -99,9 +132,25 @@ class Testing:
     JWT_ACCESS_TOKEN_EXPIRES = env_conf('JWT_ACCESS_TOKEN_EXPIRES', cast=int, default=False)
 
     API_WEBHOOK_URL = env_conf('API_WEBHOOK_URL', cast=str, default='')
+    # seconds to coalesce webhook notifications for, before calling the webhook once
+    WEBHOOK_DEBOUNCE = env_conf('WEBHOOK_DEBOUNCE', cast=float, default=30)
+    # GET the webhook URL, or POST it a JSON payload of the changes
+    WEBHOOK_METHOD = env_conf('WEBHOOK_METHOD', cast=str, default='GET')
     SLACK_API_TOKEN = env_conf('SLACK_API_TOKEN', cast=str, default='')
     SLACK_CHANNEL = env_conf('SLACK_CHANNEL', cast=str, default='')
 
+    # max bytes of public endpoint responses to cache per process, 0 to disable
+    RESPONSE_CACHE_BYTES = env_conf('RESPONSE_CACHE_BYTES', cast=int, default=128 * 1024 * 1024)
+    # bigger responses aren't cached, and streamed responses stop being buffered past this size
+    RESPONSE_CACHE_MAX_ENTRY_BYTES = env_conf(
+        'RESPONSE_CACHE_MAX_ENTRY_BYTES', cast=int, default=16 * 1024 * 1024)
+    # directory to cache bigger responses in, shared by the app processes, empty to not cache them
+    RESPONSE_CACHE_DIR = env_conf('RESPONSE_CACHE_DIR', cast=str, default='')
+    # directory to render static snapshots of the public endpoints into on publish, empty to disable
+    SNAPSHOT_DIR = env_conf('SNAPSHOT_DIR', cast=str, default='')
+    # report per request timings in a Server-Timing header and a log line
+    SERVER_TIMING = env_conf('SERVER_TIMING', cast=bool, default=True)
+
     @staticmethod
     def init_app(app):
         # The default Flask logger level is set at ERROR, so if you want to see
@@ -130,9 +179,25 @@ class Develop:
     SQLALCHEMY_RECORD_QUERIES = True
 
     API_WEBHOOK_URL = env_conf('API_WEBHOOK_URL', cast=str, default='')
+    # seconds to coalesce webhook notifications for, before calling the webhook once
+    WEBHOOK_DEBOUNCE = env_conf('WEBHOOK_DEBOUNCE', cast=float, default=30)
+    # GET the webhook URL, or POST it a JSON payload of the changes
+    WEBHOOK_METHOD = env_conf('WEBHOOK_METHOD', cast=str, default='GET')
     SLACK_API_TOKEN = env_conf('SLACK_API_TOKEN', cast=str, default='')
     SLACK_CHANNEL = env_conf('SLACK_CHANNEL', cast=str, default='')
 
+    # max bytes of public endpoint responses to cache per process, 0 to disable
+    RESPONSE_CACHE_BYTES = env_conf('RESPONSE_CACHE_BYTES', cast=int, default=128 * 1024 * 1024)
+    # bigger responses aren't cached, and streamed responses stop being buffered past this size
+    RESPONSE_CACHE_MAX_ENTRY_BYTES = env_conf(
+        'RESPONSE_CACHE_MAX_ENTRY_BYTES', cast=int, default=16 * 1024 * 1024)
+    # directory to cache bigger responses in, shared by the app processes, empty to not cache them
+    RESPONSE_CACHE_DIR = env_conf('RESPONSE_CACHE_DIR', cast=str, default='')
+    # directory to render static snapshots of the public endpoints into on publish, empty to disable
+    SNAPSHOT_DIR = env_conf('SNAPSHOT_DIR', cast=str, default='')
+    # report per request timings in a Server-Timing header and a log line
+    SERVER_TIMING = env_conf('SERVER_TIMING', cast=bool, default=True)
+
     # DEBUG = True
     # API configurations
     SECRET_KEY = env_conf("SECRET_KEY", cast=str, default="12345")
@@ -10,6 +10,7 @@ import config as configs
 
 # Figure out which config we want based on the `ENV` env variable, default to local
 from app.utils.backfill import backfill
+from app.utils.snapshot import take_snapshot
 
 env_config = config("ENV", cast=str, default="localpsql")
 config_dict = {
@@ -49,4 +50,12 @@ def backfill_cli(input_file):
     backfill(input_file)
 
 
+@utils_cli.command("snapshot")
+@click.option('--output-dir', help='Snapshot directory, defaults to the SNAPSHOT_DIR config')
+def snapshot_cli(output_dir):
+    if not (output_dir or app.config['SNAPSHOT_DIR']):
+        raise click.UsageError('Set --output-dir or the SNAPSHOT_DIR config')
+    click.echo(take_snapshot(output_dir))
+
+
 app.cli.add_command(utils_cli)
@@ -0,0 +1,21 @@
+"""
+Runs the public endpoint benchmarks on a tiny dataset, so they keep working
+"""
+from benchmarks.public_endpoints import EDIT_ENDPOINT, READ_ENDPOINTS, load_dataset, \
+    run_benchmarks
+
+
+def test_public_endpoint_benchmarks(app):
+    with app.app_context():
+        num_rows = load_dataset(['CA', 'NY', 'WA'], num_days=10, revisions_per_day=2)
+        # a row per state and day, and a week of revisions of one state for each revision
+        assert num_rows == 3 * 10 + sum(min(7, day + 1) * 2 for day in range(10))
+
+    results = run_benchmarks(app, repeat=2, state='NY')
+    assert set(results) == {name for name, _, _ in READ_ENDPOINTS + [EDIT_ENDPOINT]}
+    assert results['v1 state daily']['url'] == '/api/v1/public/states/ny/daily'
+    for result in results.values():
+        assert result['status'] in (200, 201)
+        assert len(result['timesMs']) == 2
+        assert result['minMs'] <= result['medianMs'] <= result['maxMs']
+        assert result['bytes'] > 0
@@ -337,3 +337,8 @@ def edit_unknown_fields():
       "context": ctx,
       "coreData": [edit_data]
     }
+
+
+def drain_deliveries(app):
+    """Deliver the notifications queued by the app (Slack messages, webhook calls)"""
+    app.extensions['delivery_queue'].drain()
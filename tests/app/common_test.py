@@ -0,0 +1,243 @@
+"""
+Tests for the shared query helpers in ``app/api/common.py``
+"""
+from collections import defaultdict
+import threading
+import time
+
+from flask import json
+from sqlalchemy import event, func, and_
+
+from app import db
+from app.api.common import states_daily_query, states_daily_records, update_latest_batches, us_daily_query, \
+    RESEARCH_CUTOFF_DATE
+from app.models.data import *
+
+from common import *
+
+
+def aggregated_states_daily(preview=False, limit=None, research=False):
+    """States daily computed by aggregating over all batches, without using LatestBatch"""
+    batch_types = ['daily', 'edit'] + (['research', 'research-edit'] if research else [])
+    latest = db.session.query(
+        CoreData.state, CoreData.date, func.max(CoreData.batchId).label('maxBid'),
+        func.row_number().over(
+            partition_by=CoreData.state, order_by=CoreData.date.desc()).label('row')
+    ).join(Batch).filter(
+        Batch.dataEntryType.in_(batch_types), Batch.isPublished == (not preview)
+    ).group_by(CoreData.date, CoreData.state).subquery()
+
+    filter_list = [] if limit is None else [latest.c.row <= limit]
+    if not research:
+        filter_list.append(CoreData.date <= RESEARCH_CUTOFF_DATE)
+
+    return db.session.query(CoreData).join(latest, and_(
+        CoreData.batchId == latest.c.maxBid,
+        CoreData.state == latest.c.state,
+        CoreData.date == latest.c.date)).filter(*filter_list).order_by(
+            CoreData.date.desc()).order_by(CoreData.state).all()
+
+
+def test_latest_batches_match_aggregation(app, headers):
+    client = app.test_client()
+
+    def post(url, data):
+        resp = client.post(url, data=json.dumps(data), content_type='application/json',
+                           headers=headers)
+        assert resp.status_code == 201
+        return resp.json['batch']['batchId']
+
+    def check_all_views():
+        with app.app_context():
+            for preview in [False, True]:
+                for research in [False, True]:
+                    for limit in [None, 1, 2]:
+                        expected = aggregated_states_daily(preview, limit, research)
+                        actual = states_daily_query(
+                            preview=preview, limit=limit, research=research).all()
+                        assert [x.to_dict() for x in actual] == [x.to_dict() for x in expected]
+
+    # a published push, an unpublished push for the same dates, and a published edit
+    batch_id = post("/api/v1/batches", daily_push_ny_wa_two_days())
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+    preview_batch_id = post("/api/v1/batches", daily_push_ny_wa_yesterday())
+    check_all_views()
+
+    post("/api/v1/batches/edit_states_daily", edit_push_ny_yesterday_unchanged_today())
+    check_all_views()
+
+    # publishing the preview batch removes it from the preview view
+    client.post("/api/v1/batches/{}/publish".format(preview_batch_id), headers=headers)
+    check_all_views()
+    with app.app_context():
+        assert states_daily_query(preview=True).all() == []
+
+    # data past the research cutoff, and a research batch
+    batch_id = post("/api/v1/batches", daily_push_ny_wa_march_2021())
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+    research = daily_push_ny_wa_today()
+    research['context']['dataEntryType'] = 'research'
+    research['coreData'][0]['positive'] = 25
+    batch_id = post("/api/v1/batches", research)
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+    check_all_views()
+
+    with app.app_context():
+        assert LatestBatch.query.filter_by(isPublished=True, research=True, state='NY',
+                                           date=TODAY).one().batchId == batch_id
+        assert states_daily_query(state='NY', research=True, limit=3).all()[2].positive == 25
+
+
+def test_update_latest_batches_concurrently(app, headers):
+    client = app.test_client()
+    resp = client.post("/api/v1/batches", data=json.dumps(daily_push_ny_wa_two_days()),
+                       content_type='application/json', headers=headers)
+    assert resp.status_code == 201
+
+    first_updated = threading.Event()
+    errors = []
+    batch_ids = []
+
+    def push(wait_for=None, before_commit=None):
+        # a push of NY today in its own transaction, see post_core_data_json
+        try:
+            with app.app_context():
+                if wait_for is not None:
+                    wait_for.wait(10)
+                batch = Batch(createdAt=NOW, batchNote='concurrent', dataEntryType='daily',
+                              isPublished=False, isRevision=False)
+                db.session.add(batch)
+                db.session.flush()
+                db.session.add(CoreData(state='NY', date=TODAY, batchId=batch.batchId, positive=batch.batchId,
+                                        lastUpdateIsoUtc=NOW.isoformat(), dateChecked=NOW.isoformat()))
+                db.session.flush()
+                update_latest_batches(batch.batchId)
+                batch_ids.append(batch.batchId)
+                if before_commit is not None:
+                    before_commit()
+                db.session.commit()
+        except Exception as e:
+            errors.append(e)
+
+    def waiting_for_lock():
+        with db.engine.connect() as conn:
+            return conn.execute("SELECT count(*) FROM pg_stat_activity WHERE wait_event_type = 'Lock'").scalar()
+
+    def commit_once_second_is_blocked():
+        # the second transaction updates the same state and date before the first one commits
+        first_updated.set()
+        deadline = time.time() + 10
+        while not waiting_for_lock() and time.time() < deadline:
+            time.sleep(0.05)
+
+    threads = [threading.Thread(target=push, kwargs={'before_commit': commit_once_second_is_blocked}),
+               threading.Thread(target=push, kwargs={'wait_for': first_updated})]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with app.app_context():
+        latest = LatestBatch.query.filter_by(isPublished=False, research=False, state='NY', date=TODAY).one()
+        assert latest.batchId == max(batch_ids)
+        assert states_daily_query(state='NY', preview=True).first().positive == max(batch_ids)
+
+
+def test_us_daily_query_total_test_results(app, headers):
+    client = app.test_client()
+
+    # CA's totalTestResults come from totalTestsViral, NY and WA use positive + negative
+    test_data = daily_push_ny_ca_total_test_results_different_source()
+    test_data['coreData'][-1]['totalTestsViral'] = 100
+    test_data['coreData'][0].pop('negative')
+    resp = client.post("/api/v1/batches", data=json.dumps(test_data),
+                       content_type='application/json', headers=headers)
+    batch_id = resp.json['batch']['batchId']
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+
+    with app.app_context():
+        expected = defaultdict(int)
+        for core_data in states_daily_query().all():
+            if core_data.totalTestResults is not None:
+                expected[core_data.date.strftime('%Y-%m-%d')] += core_data.totalTestResults
+
+        # US daily should be computed with a single aggregate query
+        statements = []
+        count_statements = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', count_statements)
+        us_daily = us_daily_query()
+        event.remove(db.engine, 'before_cursor_execute', count_statements)
+        assert len(statements) == 1
+        assert {x['date']: x['totalTestResults'] for x in us_daily} == expected
+        assert us_daily[0]['totalTestResults'] == 20 + 20 + 100
+
+        # US current only aggregates the latest day
+        us_current = us_daily_query(limit=1)
+        assert len(us_current) == 1
+        assert us_current[0]['totalTestResults'] == 140
+
+
+def test_states_daily_records(app, headers):
+    client = app.test_client()
+    resp = client.post("/api/v1/batches", data=json.dumps(daily_push_ny_ca_total_test_results_different_source()),
+                       content_type='application/json', headers=headers)
+    client.post("/api/v1/batches/{}/publish".format(resp.json['batch']['batchId']), headers=headers)
+    client.post("/api/v1/batches", data=json.dumps(daily_push_ny_wa_two_days()),
+                content_type='application/json', headers=headers)
+
+    with app.app_context():
+        for kwargs in [{}, {'preview': True}, {'state': 'NY'}, {'preview': True, 'limit': 1},
+                       {'research': True}]:
+            rows = states_daily_query(**kwargs).all()
+            records = states_daily_records(**kwargs)
+            assert len(rows) > 0
+            assert [r.to_dict() for r in records] == [r.to_dict() for r in rows]
+            for row, record in zip(rows, records):
+                assert record.totalTestResultsSource == row.state_obj.totalTestResultsFieldDbColumn
+                assert record.totalTestResults == row.totalTestResults
+                assert record.lastUpdateEt == row.lastUpdateEt
+
+            streamed = states_daily_records(chunk_size=1, **kwargs)
+            assert not isinstance(streamed, list)
+            assert list(streamed) == records
+
+
+def test_states_daily_records_fields(app, headers):
+    client = app.test_client()
+    resp = client.post("/api/v1/batches", data=json.dumps(daily_push_ny_ca_total_test_results_different_source()),
+                       content_type='application/json', headers=headers)
+    client.post("/api/v1/batches/{}/publish".format(resp.json['batch']['batchId']), headers=headers)
+
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        full = [r.to_dict() for r in states_daily_query().all()]
+        for fields in [{'positive'}, {'state', 'totalTestResults'}, {'lastUpdateEt', 'notes'},
+                       {'date', 'totalTestResults', 'totalTestResultsSource'}]:
+            event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+            try:
+                records = states_daily_records(fields=fields)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+            assert [r.to_dict(fields) for r in records] == \
+                [{k: v for k, v in d.items() if k in fields} for d in full]
+
+            # only the needed columns are read
+            selected = statements[-1].split('FROM')[0]
+            assert '"coreData".state' in selected
+            assert ('"coreData"."privateNotes"' in selected) == False
+            assert ('"coreData".notes' in selected) == ('notes' in fields)
+            assert ('"coreData"."totalTestsViral"' in selected) == ('totalTestResults' in fields)
+            assert ('"coreData"."lastUpdateTime"' in selected) == ('lastUpdateEt' in fields)
+
+
+def test_columns_for_fields():
+    assert CoreData.columns_for_fields(['positive', 'notes']) == {'positive', 'notes'}
+    assert CoreData.columns_for_fields(['lastUpdateEt']) == {'lastUpdateTime'}
+    assert CoreData.columns_for_fields(['totalTestResults'], ['posNeg', 'totalTestsViral', None]) == \
+        {'positive', 'negative', 'totalTestsViral'}
+    assert {'totalTestResults', 'lastUpdateEt', 'totalTestResultsSource', 'privateNotes'} <= \
+        CoreData.output_fields()
@@ -16,15 +16,24 @@ class TestingPostgresqlConfig:
         return self.test_db.url()
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_RECORD_QUERIES = True
     
     SECRET_KEY = '12345'
 
     API_WEBHOOK_URL = None
+    WEBHOOK_DEBOUNCE = 0
+    WEBHOOK_METHOD = 'GET'
 
     # the actual Slack SDK is mocked out below, so these don't matter as long as they exist
     SLACK_API_TOKEN = 'dummy_token'
     SLACK_CHANNEL = 'some_channel'
 
+    # notifications are delivered when tests drain the delivery queue, without waiting for retries
+    DELIVERY_BACKGROUND = False
+    DELIVERY_BACKOFF = 0
+
+    SERVER_TIMING = True
+
     @staticmethod
     def init_app(app):
         pass
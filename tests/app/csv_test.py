@@ -1,7 +1,7 @@
 """
 Tests for CSV generation code (CSV endpoints are tested in ``public_test.py``
 """
-from app.api.csv import CSVColumn, make_csv_response
+from app.api.csv import CSVColumn, CSV_CHUNK_ROWS, make_csv_response
 
 from flask import json, jsonify
 
@@ -35,6 +35,21 @@ def test_make_csv_response(app):
         assert data[2] == "NV,,xyz,"
 
 
+def test_make_csv_response_stream(app):
+    columns = [CSVColumn(label="State", model_column="state"),
+               CSVColumn(label="Positive", model_column="positive")]
+    data = [{"state": "NY", "positive": i} for i in range(CSV_CHUNK_ROWS * 2 + 1)]
+
+    with app.test_request_context():
+        resp = make_csv_response(columns, iter(data), stream=True)
+        assert resp.is_streamed
+        assert resp.headers["Content-type"] == "text/csv"
+        chunks = list(resp.iter_encoded())
+        # the header and each full chunk of rows, then the remaining row
+        assert len(chunks) == 3
+        assert b"".join(chunks) == make_csv_response(columns, data).data
+
+
 def test_get_state_info_csv(app):
     client = app.test_client()
     with app.app_context():
@@ -259,3 +274,73 @@ def test_get_latest_states_daily_csv(app, headers):
     assert data[0]["Positive"] == "2177888"
     assert data[1]["Date"] == '20200617'
     assert data[1]["Positive"] == "2177944"
+
+
+def test_get_daily_csv_date_range(app, headers):
+    client = app.test_client()
+    resp = client.post(
+        "/api/v1/batches",
+        data=json.dumps(daily_push_ny_wa_two_days()),
+        content_type='application/json',
+        headers=headers)
+    batch_id = resp.json['batch']['batchId']
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+
+    resp = client.get("/api/v1/public/states/daily.csv?start=2020-05-24&end=2020-05-24")
+    assert resp.status_code == 200
+    data = list(csv.DictReader(resp.data.decode("utf-8").splitlines(), delimiter=','))
+    assert [(x["State"], x["Date"]) for x in data] == [("NY", "20200524"), ("WA", "20200524")]
+
+    # "current" is the latest date within the range
+    resp = client.get("/api/v1/public/states/current.csv?end=2020-05-24")
+    data = list(csv.DictReader(resp.data.decode("utf-8").splitlines(), delimiter=','))
+    assert [(x["State"], x["Positive"]) for x in data] == [("NY", "15"), ("WA", "9")]
+
+    resp = client.get("/api/v1/public/us/daily.csv?start=2020-05-25")
+    data = list(csv.DictReader(resp.data.decode("utf-8").splitlines(), delimiter=','))
+    assert len(data) == 1
+    assert data[0]["Date"] == '20200525'
+    assert data[0]["Positive"] == "30"
+
+    assert client.get("/api/v1/public/states/daily.csv?start=yesterday").status_code == 400
+    assert client.get("/api/v1/public/us/daily.csv?end=2020-5-32").status_code == 400
+
+
+def test_get_daily_csv_fields(app, headers):
+    client = app.test_client()
+    resp = client.post(
+        "/api/v1/batches",
+        data=json.dumps(daily_push_ny_wa_two_days()),
+        content_type='application/json',
+        headers=headers)
+    batch_id = resp.json['batch']['batchId']
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+
+    def get_csv(url):
+        resp = client.get(url)
+        assert resp.status_code == 200
+        return list(csv.DictReader(resp.data.decode("utf-8").splitlines(), delimiter=','))
+
+    # the columns keep their usual order
+    data = get_csv("/api/v1/public/states/daily.csv?fields=totalTestResults,date,state,lastUpdateEt")
+    assert list(data[0]) == ["Date", "State", "Last Update ET", "Total Test Results"]
+    full = get_csv("/api/v1/public/states/daily.csv")
+    assert data == [{k: x[k] for k in data[0]} for x in full]
+
+    data = get_csv("/api/v1/public/states/current.csv?fields=state,dateChecked")
+    assert [list(x.items()) for x in data] == [
+        [("State", x["State"]), ("Check Time (ET)", x["Check Time (ET)"])]
+        for x in get_csv("/api/v1/public/states/current.csv")]
+    assert data[0]["Check Time (ET)"]
+
+    data = get_csv("/api/v1/public/us/daily.csv?fields=date,positive,totalTestResults")
+    assert data == [{"Date": "20200525", "Positive": "30", "Total Test Results": "45"},
+                    {"Date": "20200524", "Positive": "24", "Total Test Results": "36"}]
+
+    data = get_csv("/api/v1/internal/states/daily.csv?fields=state,positive")
+    assert data == [{"state": "NY", "positive": "20"}, {"state": "WA", "positive": "10"}]
+
+    # only the columns of the endpoint are fields
+    assert client.get("/api/v1/public/states/daily.csv?fields=privateNotes").status_code == 400
+    assert client.get("/api/v1/public/us/current.csv?fields=date").status_code == 400
+    assert client.get("/api/v1/public/states/daily.csv?fields=,").status_code == 400
@@ -0,0 +1,111 @@
+"""
+Tests for the background notification delivery queue
+"""
+from unittest import mock
+
+from app.utils.delivery import CircuitBreaker, CircuitOpenError, deliver_in_background
+
+from common import drain_deliveries
+
+
+class Recorder(object):
+    """A delivery function failing the first `failures` calls"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = []
+
+    def __call__(self, *args):
+        self.calls.append(args)
+        if len(self.calls) <= self.failures:
+            raise ValueError('failure %d' % len(self.calls))
+
+
+def test_drain(app):
+    with app.app_context():
+        recorder = Recorder()
+        assert deliver_in_background('test', recorder, 1, 'a')
+        assert deliver_in_background('test', recorder, 2, 'b')
+        assert recorder.calls == []
+        drain_deliveries(app)
+        assert recorder.calls == [(1, 'a'), (2, 'b')]
+
+
+def test_bounded_queue(app):
+    with app.app_context():
+        recorder = Recorder()
+        for i in range(app.config['DELIVERY_QUEUE_SIZE']):
+            assert deliver_in_background('test', recorder, i)
+        assert not deliver_in_background('test', recorder, 'dropped')
+        drain_deliveries(app)
+        assert len(recorder.calls) == app.config['DELIVERY_QUEUE_SIZE']
+
+
+def test_retry_with_backoff(app):
+    app.config['DELIVERY_BACKOFF'] = 0.5
+    with app.app_context(), mock.patch('app.utils.delivery.time.sleep') as sleep:
+        recorder = Recorder(failures=2)
+        deliver_in_background('test', recorder)
+        drain_deliveries(app)
+        assert len(recorder.calls) == 3
+        assert [call[0][0] for call in sleep.call_args_list] == [0.5, 1.0]
+
+        # the failure handler is called with the last error once all attempts fail
+        errors = []
+        recorder = Recorder(failures=100)
+        deliver_in_background('test', recorder, on_failure=errors.append)
+        drain_deliveries(app)
+        assert len(recorder.calls) == app.config['DELIVERY_RETRIES'] + 1
+        assert str(errors[0]) == 'failure %d' % len(recorder.calls)
+
+
+def test_circuit_breaker():
+    now = [0]
+    breaker = CircuitBreaker(threshold=2, reset_timeout=10, clock=lambda: now[0])
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    now[0] = 10
+    assert breaker.allow()
+    # a failure after the reset timeout opens it again right away
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    now[0] = 20
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+
+
+def test_circuit_breaker_drops_deliveries(app):
+    app.config['DELIVERY_BREAKER_THRESHOLD'] = 3
+    with app.app_context():
+        failing = Recorder(failures=100)
+        deliver_in_background('webhook', failing)
+        drain_deliveries(app)
+        assert len(failing.calls) == 3
+
+        # the open breaker drops deliveries to the same destination only
+        dropped = Recorder()
+        other = Recorder()
+        errors = []
+        deliver_in_background('webhook', dropped, on_failure=errors.append)
+        deliver_in_background('slack', other)
+        drain_deliveries(app)
+        assert dropped.calls == []
+        assert isinstance(errors[0], CircuitOpenError)
+        assert len(other.calls) == 1
+
+
+def test_background_worker(app):
+    app.config['DELIVERY_BACKGROUND'] = True
+    delivery_queue = app.extensions['delivery_queue']
+    with app.app_context():
+        recorder = Recorder(failures=1)
+        deliver_in_background('test', recorder, 'x')
+        delivery_queue.queue.join()
+        assert recorder.calls == [('x',), ('x',)]
+        assert delivery_queue.worker.is_alive()
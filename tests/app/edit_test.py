@@ -2,6 +2,7 @@
 Edit testing for V1 of API
 """
 from flask import json, jsonify
+from sqlalchemy import event
 
 from app import db
 from app.api.data import any_existing_rows
@@ -51,6 +52,7 @@ def test_edit_state_metadata(app, headers, requests_mock):
     assert len(resp.json['states']) == 1
     assert resp.json['states'][0]['state'] == "AK"
     assert resp.json['states'][0]['twitter'] == "AlaskaNewTwitter"
+    drain_deliveries(app)
     assert requests_mock.call_count == 1
 
 
@@ -65,11 +67,13 @@ def test_edit_core_data_from_states_daily_empty(app, headers, slack_mock, reques
         headers=headers)
     assert resp.status_code == 201
     batch_id = resp.json['batch']['batchId']
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 1
 
     # Publish the new batch
     resp = client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
     assert resp.status_code == 201
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 2
 
     # make an empty edit batch for NY for yesterday containing no edits
@@ -84,6 +88,7 @@ def test_edit_core_data_from_states_daily_empty(app, headers, slack_mock, reques
         headers=headers)
 
     assert resp.status_code == 400
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 2  # logging unchanged edit to Slack
     assert requests_mock.call_count == 0  # should not call the webhook
     assert "no edits detected" in resp.data.decode("utf-8")
@@ -100,11 +105,13 @@ def test_edit_core_data_from_states_daily(app, headers, slack_mock, requests_moc
         headers=headers)
     assert resp.status_code == 201
     batch_id = resp.json['batch']['batchId']
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 1
 
     # Publish the new batch
     resp = client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
     assert resp.status_code == 201
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 2
     assert slack_mock.files_upload.call_count == 0
 
@@ -119,6 +126,7 @@ def test_edit_core_data_from_states_daily(app, headers, slack_mock, requests_moc
         content_type='application/json',
         headers=headers)
     assert resp.status_code == 201
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 3
     assert slack_mock.files_upload.call_count == 1
     assert requests_mock.call_count == 1
@@ -194,6 +202,7 @@ def test_edit_core_data_from_states_daily(app, headers, slack_mock, requests_moc
     assert found_new_date is True
 
     # the slack notification should note the addition of the new row
+    drain_deliveries(app)
     assert "New rows: 1" in slack_mock.files_upload.call_args[1]['content']
     assert "NY 2020-05-20" in slack_mock.files_upload.call_args[1]['content']
 
@@ -227,11 +236,13 @@ def test_edit_core_data_research(app, headers, slack_mock, requests_mock):
         headers=headers)
     assert resp.status_code == 201
     batch_id = resp.json['batch']['batchId']
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 1
 
     # Publish the new batch
     resp = client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
     assert resp.status_code == 201
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 2
     assert slack_mock.files_upload.call_count == 0
 
@@ -247,6 +258,7 @@ def test_edit_core_data_research(app, headers, slack_mock, requests_mock):
         content_type='application/json',
         headers=headers)
     assert resp.status_code == 201
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 3
     assert slack_mock.files_upload.call_count == 1
     assert requests_mock.call_count == 1
@@ -276,11 +288,13 @@ def test_edit_core_data_from_states_daily_timestamps_only(app, headers, slack_mo
         headers=headers)
     assert resp.status_code == 201
     batch_id = resp.json['batch']['batchId']
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 1
 
     # Publish the new batch
     resp = client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
     assert resp.status_code == 201
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 2
 
     # make an edit batch for NY for yesterday, and leave today alone
@@ -291,6 +305,7 @@ def test_edit_core_data_from_states_daily_timestamps_only(app, headers, slack_mo
         headers=headers)
 
     assert resp.status_code == 201
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 3
     assert "state: NY" in slack_mock.chat_postMessage.call_args[1]['text']
     batch_id = resp.json['batch']['batchId']
@@ -318,11 +333,13 @@ def test_edit_core_data_from_states_daily_partial_update(app, headers, slack_moc
         headers=headers)
     assert resp.status_code == 201
     batch_id = resp.json['batch']['batchId']
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 1
 
     # Publish the new batch
     resp = client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
     assert resp.status_code == 201
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 2
 
     # test
@@ -335,6 +352,7 @@ def test_edit_core_data_from_states_daily_partial_update(app, headers, slack_moc
 
     # verify
     assert resp.status_code == 201
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 3
     assert "state: NY" in slack_mock.chat_postMessage.call_args[1]['text']
     batch_id = resp.json['batch']['batchId']
@@ -362,6 +380,7 @@ def test_edit_core_data_from_states_daily_partial_update(app, headers, slack_moc
 
     # verify
     assert resp.status_code == 400
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 3
     assert "no edits detected" in resp.data.decode("utf-8")
 
@@ -383,11 +402,13 @@ def test_edit_with_valid_and_unknown_fields(app, headers, slack_mock):
         headers=headers)
     assert resp.status_code == 201
     batch_id = resp.json['batch']['batchId']
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 1
 
     # Publish the new batch
     resp = client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
     assert resp.status_code == 201
+    drain_deliveries(app)
     assert slack_mock.chat_postMessage.call_count == 2
 
     # test that an edit batch with unknown fields is rejected with error
@@ -397,5 +418,51 @@ def test_edit_with_valid_and_unknown_fields(app, headers, slack_mock):
         content_type='application/json',
         headers=headers)
     assert resp.status_code == 400
+    drain_deliveries(app)
     assert slack_mock.files_upload.call_count == 1
     assert 'Unknown field(s) in CoreData' in resp.data.decode("utf-8")
+
+
+def test_edit_many_dates(app, headers, slack_mock):
+    client = app.test_client()
+    resp = client.post("/api/v1/batches", data=json.dumps(daily_push_ny_wa_two_days()),
+                       content_type='application/json', headers=headers)
+    client.post("/api/v1/batches/{}/publish".format(resp.json['batch']['batchId']), headers=headers)
+    drain_deliveries(app)
+
+    # yesterday changes, today is the same, and there's a month of new dates
+    new_dates = [YESTERDAY - datetime.timedelta(days=i) for i in range(30, 0, -1)]
+    core_data = [dict(NY_YESTERDAY, positive=16), dict(NY_TODAY)]
+    core_data += [{'state': 'NY', 'date': d, 'positive': i, 'negative': 0} for i, d in enumerate(new_dates)]
+    payload = {'context': dict(edit_push_ny_yesterday_unchanged_today()['context']), 'coreData': core_data}
+
+    inserts = []
+    count_inserts = lambda *args: args[2].startswith('INSERT INTO "coreData"') and inserts.append(args[2])
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count_inserts)
+        try:
+            resp = client.post("/api/v1/batches/edit_states_daily", data=json.dumps(payload, default=str),
+                               content_type='application/json', headers=headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_inserts)
+    assert resp.status_code == 201
+    # all the edited rows are written in a single statement
+    assert len(inserts) == 1
+
+    assert resp.json['numRowsEdited'] == 31
+    assert resp.json['changedFields'] == ['positive']
+    assert resp.json['changedDates'] == '4/24/20 - 5/24/20'
+    # in the order of the edit
+    assert [row['date'] for row in resp.json['coreData']] == \
+        [YESTERDAY.isoformat()] + [d.isoformat() for d in new_dates]
+    assert resp.json['coreData'][0]['positive'] == 16
+    assert resp.json['coreData'][0]['inIcuCurrently'] == 37
+    assert resp.json['coreData'][0]['totalTestResults'] == 20
+
+    drain_deliveries(app)
+    content = slack_mock.files_upload.call_args[1]['content']
+    assert content.startswith('New rows: 30\n\n\nNY 2020-04-24\nNY 2020-04-25')
+    assert 'Rows edited: 1\n\nNY 2020-05-24\n    positive: 16 (was 15)' in content
+
+    resp = client.get("/api/v1/public/states/ny/daily")
+    assert len(resp.json) == 32
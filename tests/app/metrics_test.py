@@ -0,0 +1,97 @@
+"""
+Tests for the Prometheus metrics
+"""
+import os
+import subprocess
+import sys
+
+from flask import json
+from prometheus_client import REGISTRY
+
+from app.utils.metrics import metrics_registry
+
+from common import *
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_request_metrics(app, headers):
+    client = app.test_client()
+    resp = client.post("/api/v1/batches", data=json.dumps(daily_push_ny_wa_two_days()),
+                       content_type='application/json', headers=headers)
+    client.post("/api/v1/batches/{}/publish".format(resp.json['batch']['batchId']), headers=headers)
+
+    route = '/api/v1/public/states/<string:state>/daily'
+    before_count = sample('api_requests_total', method='GET', route=route, status='200')
+    before_latency = sample('api_request_duration_seconds_count', method='GET', route=route)
+    before_size = sample('api_response_size_bytes_sum', route=route)
+    before_unmatched = sample('api_requests_total', method='GET', route='<unmatched>', status='404')
+
+    resp = client.get("/api/v1/public/states/ny/daily")
+    assert resp.status_code == 200
+    size = len(resp.data) + len(client.get("/api/v1/public/states/wa/daily").data)
+    client.get("/no/such/path")
+
+    assert sample('api_requests_total', method='GET', route=route, status='200') == before_count + 2
+    assert sample('api_request_duration_seconds_count', method='GET', route=route) == before_latency + 2
+    assert sample('api_response_size_bytes_sum', route=route) == before_size + size
+    assert sample('api_requests_total', method='GET', route='<unmatched>', status='404') == before_unmatched + 1
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.content_type.startswith('text/plain')
+    body = resp.get_data(as_text=True)
+    for name in ['api_requests_total', 'api_request_duration_seconds_bucket', 'api_response_size_bytes_bucket',
+                 'api_db_pool_checkout_seconds_count', 'api_response_cache_total', 'api_ingested_rows_total']:
+        assert name in body
+
+    app.config['METRICS'] = False
+    before_count = sample('api_requests_total', method='GET', route=route, status='200')
+    client.get("/api/v1/public/states/ny/daily")
+    assert sample('api_requests_total', method='GET', route=route, status='200') == before_count
+    assert client.get("/metrics").status_code == 404
+
+
+def test_data_metrics(app, headers):
+    client = app.test_client()
+    before_push = sample('api_ingested_rows_total', kind='push')
+    before_edit = sample('api_ingested_rows_total', kind='edit')
+    before_checkouts = sample('api_db_pool_checkout_seconds_count')
+
+    resp = client.post("/api/v1/batches", data=json.dumps(daily_push_ny_wa_two_days()),
+                       content_type='application/json', headers=headers)
+    batch_id = resp.json['batch']['batchId']
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+    assert sample('api_ingested_rows_total', kind='push') == before_push + 4
+    assert sample('api_db_pool_checkout_seconds_count') > before_checkouts
+
+    client.post("/api/v1/batches/edit_states_daily", data=json.dumps(edit_push_ny_yesterday_unchanged_today()),
+                content_type='application/json', headers=headers)
+    assert sample('api_ingested_rows_total', kind='edit') == before_edit + 1
+
+    before = {result: sample('api_response_cache_total', result=result)
+              for result in ['hit', 'miss', 'not_modified']}
+    resp = client.get("/api/v1/public/states/daily")
+    client.get("/api/v1/public/states/daily")
+    client.get("/api/v1/public/states/daily", headers={'If-None-Match': resp.headers['ETag']})
+    for result in ['hit', 'miss', 'not_modified']:
+        assert sample('api_response_cache_total', result=result) == before[result] + 1
+
+
+def test_multiprocess_metrics(tmpdir, monkeypatch):
+    # each worker process writes its metrics to the shared directory
+    worker = ("from app.utils.metrics import record_ingested_rows, POOL_CHECKOUT; "
+              "record_ingested_rows('push', 3); POOL_CHECKOUT.observe(0.002)")
+    env = dict(os.environ, prometheus_multiproc_dir=str(tmpdir))
+    for _ in range(2):
+        subprocess.run([sys.executable, '-c', worker], env=env, check=True, cwd=REPO_ROOT)
+
+    monkeypatch.setenv('prometheus_multiproc_dir', str(tmpdir))
+    registry = metrics_registry()
+    assert registry is not REGISTRY
+    assert registry.get_sample_value('api_ingested_rows_total', {'kind': 'push'}) == 6
+    assert registry.get_sample_value('api_db_pool_checkout_seconds_count') == 2
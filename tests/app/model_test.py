@@ -150,3 +150,42 @@ def test_total_test_results(app):
         assert core_data_row.totalTestResults is None
         core_data_row.totalTestsViral = 75
         assert core_data_row.totalTestResults == 75
+
+
+def test_to_dict(app):
+    with app.app_context():
+        now_utc = datetime(2020, 5, 4, 20, 3, tzinfo=pytz.UTC)
+        nys = State(state='NY', name='New York', totalTestResultsFieldDbColumn='posNeg')
+        bat = Batch(batchNote='test', createdAt=now_utc, isPublished=False, isRevision=False)
+        db.session.add(nys)
+        db.session.add(bat)
+        db.session.flush()
+        core_data_row = CoreData(
+            lastUpdateIsoUtc=now_utc.isoformat(), dateChecked=now_utc.isoformat(),
+            date=datetime(2020, 5, 4), state='NY', batchId=bat.batchId, positive=20, negative=0)
+        db.session.add(core_data_row)
+        db.session.commit()
+
+        # the columns in table order, converted by their repr function and skipping nulls, then the derived
+        # fields. Batch.to_dict adds the coreData rows
+        wa = State(state='WA', totalTestResultsFieldDbColumn='posNeg')
+        for obj, expected in [
+                (nys, {'state': 'NY', 'name': 'New York', 'totalTestResultsFieldDbColumn': 'posNeg',
+                       'pum': False, 'fips': '36', 'population': 19572319}),
+                (bat, {'batchId': bat.batchId, 'createdAt': now_utc, 'batchNote': 'test', 'isPublished': False,
+                       'isRevision': False, 'changedDatesMin': '2020-05-04', 'changedDatesMax': '2020-05-04'}),
+                (core_data_row, {'state': 'NY', 'batchId': bat.batchId, 'date': '2020-05-04', 'positive': 20,
+                                 'negative': 0, 'lastUpdateTime': '2020-05-04T20:03:00Z',
+                                 'dateChecked': '2020-05-04T20:03:00Z', 'lastUpdateEt': '5/4/2020 16:03',
+                                 'totalTestResultsSource': 'posNeg', 'totalTestResults': 20}),
+                (wa, {'state': 'WA', 'totalTestResultsFieldDbColumn': 'posNeg', 'pum': False, 'fips': '53',
+                      'population': 7404107})]:
+            d = DataMixin.to_dict(obj)
+            assert list(d.items()) == list(expected.items())
+
+        d = core_data_row.to_dict()
+        assert d['date'] == '2020-05-04'
+        assert d['negative'] == 0
+        assert 'pending' not in d
+        assert d['totalTestResults'] == 20
+        assert bat.to_dict()['coreData'] == [d]
@@ -260,3 +260,88 @@ def test_get_states_us_daily_research(app, headers):
     resp = client.get("/api/v1/public/us/daily?research=true")
     assert resp.status_code == 200
     assert len(resp.json) == 2
+
+
+def test_get_daily_date_range(app, headers):
+    client = app.test_client()
+    resp = client.post(
+        "/api/v1/batches",
+        data=json.dumps(daily_push_ny_wa_two_days()),
+        content_type='application/json',
+        headers=headers)
+    batch_id = resp.json['batch']['batchId']
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+
+    resp = client.get("/api/v1/public/states/daily?start=2020-05-25")
+    assert resp.status_code == 200
+    assert [(x['state'], x['date']) for x in resp.json] == [('NY', '2020-05-25'), ('WA', '2020-05-25')]
+
+    resp = client.get("/api/v1/public/states/daily?end=2020-05-24")
+    assert [(x['state'], x['date']) for x in resp.json] == [('NY', '2020-05-24'), ('WA', '2020-05-24')]
+
+    resp = client.get("/api/v1/public/states/daily?start=2020-05-24&end=2020-05-25")
+    assert len(resp.json) == 4
+
+    resp = client.get("/api/v1/public/states/ny/daily?start=2020-05-24&end=2020-05-24")
+    assert resp.status_code == 200
+    assert len(resp.json) == 1
+    assert resp.json[0]['date'] == '2020-05-24'
+    assert resp.json[0]['positive'] == 15
+
+    # a range without data is empty, not a missing state
+    resp = client.get("/api/v1/public/states/ny/daily?start=2020-06-01")
+    assert resp.status_code == 200
+    assert resp.json == []
+    # but an unknown state still is
+    resp = client.get("/api/v1/public/states/zz/daily?start=2020-05-24")
+    assert resp.status_code == 404
+
+    resp = client.get("/api/v1/public/us/daily?start=2020-05-25&end=2020-05-25")
+    assert resp.status_code == 200
+    assert len(resp.json) == 1
+    assert resp.json[0]['date'] == '2020-05-25'
+    assert resp.json[0]['positive'] == 30
+
+    for query in ['start=2020-13-01', 'end=20200525', 'start=2020-05-25&end=2020-05-24']:
+        for path in ['/api/v1/public/states/daily', '/api/v1/public/states/ny/daily',
+                     '/api/v1/public/us/daily']:
+            resp = client.get('%s?%s' % (path, query))
+            assert resp.status_code == 400, (path, query)
+
+
+def test_get_daily_fields(app, headers):
+    client = app.test_client()
+    resp = client.post(
+        "/api/v1/batches",
+        data=json.dumps(daily_push_ny_ca_total_test_results_different_source()),
+        content_type='application/json',
+        headers=headers)
+    batch_id = resp.json['batch']['batchId']
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+
+    full = client.get("/api/v1/public/states/daily").json
+    fields = ['state', 'positive', 'totalTestResults', 'lastUpdateEt']
+    resp = client.get("/api/v1/public/states/daily?fields=" + ','.join(fields))
+    assert resp.status_code == 200
+    assert resp.json == [{k: v for k, v in x.items() if k in fields} for x in full]
+    # the derived fields are computed from columns that weren't requested
+    assert {x['state']: x['totalTestResults'] for x in resp.json} == {
+        x['state']: x['totalTestResults'] for x in full}
+    assert all(x['lastUpdateEt'] for x in resp.json)
+
+    resp = client.get("/api/v1/public/states/ca/daily?fields=date, totalTestResults")
+    assert resp.json == [{'date': x['date'], 'totalTestResults': x['totalTestResults']}
+                         for x in full if x['state'] == 'CA']
+
+    full = client.get("/api/v1/public/us/daily").json
+    resp = client.get("/api/v1/public/us/daily?fields=date,states,positive,totalTestResults")
+    assert resp.json == [{k: x[k] for k in ['date', 'states', 'positive', 'totalTestResults']} for x in full]
+
+    for path in ['/api/v1/public/states/daily', '/api/v1/public/states/ny/daily', '/api/v1/public/us/daily']:
+        resp = client.get(path + '?fields=positive,moonBase')
+        assert resp.status_code == 400
+        assert 'moonBase' in resp.get_data(as_text=True)
+        # fields have to be given if the argument is
+        assert client.get(path + '?fields=,').status_code == 400
+    # US daily doesn't have the states' text fields
+    assert client.get('/api/v1/public/us/daily?fields=notes').status_code == 400
@@ -2,13 +2,18 @@
 Tests for public API v2 endpoints
 """
 
+from datetime import date, timedelta
 from flask import json
 import os
 import pytest
+import random
 
 from common import daily_push_ny_wa_two_days
 
-from app.api.public_v2 import ValuesCalculator, CoreData, datetime, State, Batch, db, pytz
+from app.api.mappings_v2 import _MAPPING, _US_MAPPING, _STATE_INFO_MAPPING
+from app.api.public_v2 import CompiledMapping, recursive_tree_to_output, copy
+from app.api.public_v2 import lookback_window, rows_in_window
+from app.api.public_v2 import ValuesCalculator, ArrayValuesCalculator, CoreData, datetime, State, Batch, db, pytz
 
 
 def write_and_publish_data(client, headers, data_json_str):
@@ -133,6 +138,62 @@ def test_values_calculator(app):
         assert calculator.calculate_values(core_data_row, 'dataQualityGrade') == None
 
 
+def test_array_values_calculator(app):
+    # two "states" of US-style dict rows, with gaps in the dates, empty values, zeros and drops
+    random.seed(42)
+    fields = ['positive', 'death', 'hospitalizedCurrently']
+    daily_data = []
+    for state in ['NY', 'US']:
+        for i in range(60):
+            if random.random() < 0.15:
+                continue  # missing date
+            row = {'state': state if state != 'US' else None,
+                   'date': (date(2020, 4, 1) + timedelta(days=i)).strftime('%Y-%m-%d')}
+            for field in fields:
+                value = random.choice([None, 0, random.randint(0, 5000), random.randint(0, 50)])
+                if value is not None:
+                    row[field] = value
+            daily_data.append(row)
+
+    calculator = ValuesCalculator(daily_data)
+    array_calculator = ArrayValuesCalculator(daily_data)
+    for row in daily_data:
+        for field in fields:
+            for method in ['population_percent', 'change_from_prior_day',
+                           'seven_day_change_percent', 'seven_day_average']:
+                expected = getattr(calculator, method)(row, field)
+                actual = getattr(array_calculator, method)(row, field)
+                assert (actual, type(actual)) == (expected, type(expected)), (method, field, row)
+            # rows are found by state and date, so copies of the rows work too
+            for array_row in [row, dict(row)]:
+                assert array_calculator.calculate_values(array_row, field) == \
+                    calculator.calculate_values(row, field)
+
+
+def test_compiled_mapping(app):
+    with app.app_context():
+        state = State(state='NY', name='New York', totalTestResultsFieldDbColumn='posNeg',
+                      covid19Site='example.com', covid19SiteTertiary='example.org')
+        core_data_row = CoreData(date=datetime.today(), state='NY', positive=20, negative=5,
+                                 probableCases=0, dataQualityGrade='A')
+        core_data_row.state_obj = state
+        us_row = {'date': '2020-05-25', 'positive': 30, 'death': 2}
+
+        calculator = ValuesCalculator([core_data_row])
+        us_calculator = ValuesCalculator([us_row])
+        for mapping, data, calc in [(_MAPPING, core_data_row, None),
+                                    (_MAPPING, core_data_row, calculator),
+                                    (_US_MAPPING, us_row, None),
+                                    (_US_MAPPING, us_row, us_calculator),
+                                    (_STATE_INFO_MAPPING, state, None),
+                                    ([_US_MAPPING, {'label': 'x', 'y': 'death'}], us_row, None)]:
+            expected = copy.deepcopy(mapping)
+            recursive_tree_to_output(expected, data, calc)
+            actual = CompiledMapping(mapping).to_output(data, calc)
+            # compare the serialized form, which also checks that the key order matches
+            assert json.dumps(actual, sort_keys=False) == json.dumps(expected, sort_keys=False)
+
+
 def test_get_state_info_v2(app):
     client = app.test_client()
     with app.app_context():
@@ -192,3 +253,84 @@ def test_get_us_daily(app, headers):
     assert second_data['date'] == '2020-05-24'
     assert second_data['states'] == 2
     assert second_data['testing']['total']['value'] == 36
+
+
+def test_get_daily_window(app, headers):
+    # three weeks of NY and WA, WA with gaps and stopping two days earlier
+    rng = random.Random(7)
+    first_day = date(2020, 5, 1)
+    core_data = []
+    for i in range(21):
+        for state in ['NY', 'WA']:
+            if state == 'WA' and (i % 4 == 3 or i > 18):
+                continue
+            core_data.append({
+                'state': state, 'date': (first_day + timedelta(days=i)).isoformat(),
+                'positive': i * 100 + rng.randint(0, 99), 'negative': i * 300 + rng.randint(0, 99),
+                'hospitalizedCurrently': rng.randint(0, 50), 'death': i * 2,
+            })
+    payload = {
+        'context': {'dataEntryType': 'daily', 'shiftLead': 'test', 'batchNote': 'test'},
+        'states': [{'state': 'NY', 'totalTestResultsFieldDbColumn': 'posNeg'},
+                   {'state': 'WA', 'totalTestResultsFieldDbColumn': 'posNeg'}],
+        'coreData': core_data,
+    }
+    client = app.test_client()
+    # without any data, a window is unavailable rather than empty
+    assert client.get('/api/v2/public/us/daily?days=5').data == b'US Daily data unavailable'
+    write_and_publish_data(client, headers, json.dumps(payload))
+
+    def get_data(url):
+        resp = client.get(url)
+        assert resp.status_code == 200
+        return resp.json['data']
+
+    for path in ['/api/v2/public/states/daily', '/api/v2/public/states/wa/daily',
+                 '/api/v2/public/states/daily/simple', '/api/v2/public/us/daily']:
+        full = get_data(path)
+        key = lambda x: x.get('state', 'US')
+
+        # the derived values in the window match the full history's
+        window = get_data(path + '?days=5')
+        expected = []
+        for row in full:
+            if len([x for x in expected if key(x) == key(row)]) < 5:
+                expected.append(row)
+        assert window == expected
+
+        window = get_data(path + '?start=2020-05-10&end=2020-05-17')
+        assert window == [x for x in full if '2020-05-10' <= x['date'] <= '2020-05-17']
+        assert window
+
+        window = get_data(path + '?start=2020-05-12&days=3')
+        expected = []
+        for row in full:
+            if row['date'] >= '2020-05-12' and len([x for x in expected if key(x) == key(row)]) < 3:
+                expected.append(row)
+        assert window == expected
+
+        assert get_data(path + '?start=2020-06-01') == []
+        assert client.get(path + '?end=2020-05-40').status_code == 400
+
+    # an unknown state is unavailable, with or without a window
+    for query in ['', '?days=5', '?start=2020-05-10']:
+        resp = client.get('/api/v2/public/states/zz/daily' + query)
+        assert resp.data == b'States Daily data unavailable for state zz'
+
+
+def test_window_helpers(app):
+    cutoff = date(2021, 3, 7)
+    assert lookback_window(None, None, None, 7) == (None, None, None)
+    assert lookback_window(None, date(2020, 5, 10), date(2020, 5, 20), 7) == \
+        (None, date(2020, 5, 3), date(2020, 5, 20))
+    assert lookback_window(30, None, None, 0) == (30, None, cutoff)
+    assert lookback_window(30, None, date(2022, 1, 1), 7) == (37, None, cutoff)
+
+    rows = [{'state': state, 'date': '2020-05-%02d' % day} for day in [12, 11, 10] for state in ['NY', 'WA']]
+    assert rows_in_window(rows, None, None) is rows
+    assert rows_in_window(rows, 1, None) == rows[:2]
+    assert rows_in_window(rows, None, date(2020, 5, 11)) == rows[:4]
+    assert rows_in_window(rows[1:], 2, date(2020, 5, 10)) == rows[1:5]
+    # US rows have no state
+    us_rows = [{'date': '2020-05-%02d' % day} for day in [12, 11, 10]]
+    assert rows_in_window(us_rows, 2, None) == us_rows[:2]
@@ -0,0 +1,141 @@
+"""
+Query plan regression tests: check that the hot read queries can use the coreData/batches indexes
+"""
+from contextlib import contextmanager
+import os
+
+from flask import json
+from sqlalchemy import event
+
+from app import db
+from app.api.common import states_daily_query, update_latest_batches
+from app.api.data import any_existing_rows
+from app.models.data import *
+
+from common import *
+
+# the tables are tiny, so the planner may pick either index for the same query
+LATEST_BATCHES_INDEXES = {'latestBatches_pkey', 'ix_latestBatches_date'}
+
+
+@contextmanager
+def captured_queries():
+    """Collects the (statement, parameters) of every SQL query executed inside the block"""
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        queries.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def plan_nodes(plan):
+    yield plan
+    for subplan in plan.get('Plans', []):
+        yield from plan_nodes(subplan)
+
+
+def explain(statement, parameters):
+    """Returns the plan nodes for the statement, with sequential scans disabled.
+
+    Disabling sequential scans makes the planner pick an index whenever one is usable, regardless
+    of how small the test tables are, so a query that falls back to a sequential scan can't use
+    any of the indexes.
+    """
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SET enable_seqscan = off')
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+        plan = cursor.fetchone()[0][0]['Plan']
+    finally:
+        connection.close()
+    return list(plan_nodes(plan))
+
+
+def used_indexes(queries):
+    indexes = set()
+    for statement, parameters in queries:
+        for node in explain(statement, parameters):
+            assert node['Node Type'] != 'Seq Scan', \
+                'Sequential scan on %s in:\n%s' % (node.get('Relation Name'), statement)
+            if 'Index Name' in node:
+                indexes.add(node['Index Name'])
+    return indexes
+
+
+def populate(app, headers):
+    client = app.test_client()
+    example_filename = os.path.join(os.path.dirname(__file__), 'data.json')
+    with open(example_filename) as f:
+        client.post("/api/v1/batches", data=f.read(), content_type='application/json',
+                    headers=headers)
+    client.post('/api/v1/batches/1/publish', headers=headers)
+    for push in [daily_push_ny_wa_two_days(), daily_push_ny_wa_today()]:
+        resp = client.post("/api/v1/batches", data=json.dumps(push),
+                           content_type='application/json', headers=headers)
+        assert resp.status_code == 201
+    client.post('/api/v1/batches/2/publish', headers=headers)
+    resp = client.post("/api/v1/batches/edit_states_daily",
+                       data=json.dumps(edit_push_ny_yesterday_unchanged_today()),
+                       content_type='application/json', headers=headers)
+    assert resp.status_code == 201
+
+    with app.app_context():
+        db.session.execute('ANALYZE')
+        db.session.commit()
+
+
+def test_states_daily_query_plans(app, headers):
+    populate(app, headers)
+    with app.app_context():
+        for kwargs in [{}, {'preview': True}, {'research': True}, {'limit': 1},
+                       {'state': 'NY'}, {'state': 'NY', 'limit': 2}]:
+            with captured_queries() as queries:
+                states_daily_query(**kwargs).all()
+            assert used_indexes(queries) & LATEST_BATCHES_INDEXES, kwargs
+
+
+def test_states_daily_date_range_plans(app, headers):
+    populate(app, headers)
+    with app.app_context():
+        for kwargs in [{'start': YESTERDAY}, {'start': YESTERDAY, 'end': TODAY, 'limit': 1}]:
+            with captured_queries() as queries:
+                states_daily_query(**kwargs).all()
+            assert 'ix_latestBatches_date' in used_indexes(queries), kwargs
+
+        with captured_queries() as queries:
+            states_daily_query(state='NY', start=YESTERDAY, end=TODAY).all()
+        assert used_indexes(queries) & LATEST_BATCHES_INDEXES
+
+
+def test_state_date_lookup_plans(app, headers):
+    populate(app, headers)
+    with app.app_context():
+        with captured_queries() as queries:
+            any_existing_rows('NY', '20200524')
+        assert 'ix_coreData_state_date_batchId' in used_indexes(queries)
+
+        with captured_queries() as queries:
+            app.test_client().get('/api/v1/state-date-history/NY/2020-05-24')
+        assert 'ix_coreData_state_date_batchId' in used_indexes(queries)
+
+
+def test_update_latest_batches_plans(app, headers):
+    populate(app, headers)
+    with app.app_context():
+        with captured_queries() as queries:
+            update_latest_batches(3)
+        assert {'ix_coreData_batchId', 'ix_coreData_state_date_batchId'} <= used_indexes(queries)
+
+
+def test_batches_listing_plans(app, headers):
+    populate(app, headers)
+    with app.app_context():
+        with captured_queries() as queries:
+            app.test_client().get('/api/v1/batches?state=NY&limit=2')
+        assert {'batches_pkey', 'ix_coreData_state_date_batchId'} <= used_indexes(queries)
@@ -0,0 +1,72 @@
+"""
+Tests for the access log replay load tester
+"""
+from flask import json
+
+from benchmarks.replay import LogEntry, RouteMatcher, percentile, read_log, replay
+
+from common import *
+
+
+def test_read_log():
+    entries = read_log([
+        '{"method": "get", "path": "/api/v1/public/states/daily", "query": "research=true"}\n',
+        '\n',
+        '{"path": "/api/v2/public/us/daily", "headers": {"Accept-Encoding": "gzip"}}\n',
+    ])
+    assert [(e.method, e.path, e.query) for e in entries] == [
+        ('GET', '/api/v1/public/states/daily', 'research=true'),
+        ('GET', '/api/v2/public/us/daily', None),
+    ]
+    assert entries[1].headers == {'Accept-Encoding': 'gzip'}
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([7], 99) == 7
+    assert percentile([], 50) is None
+
+
+def test_replay(app, headers):
+    client = app.test_client()
+    resp = client.post("/api/v1/batches", data=json.dumps(daily_push_ny_wa_two_days()),
+                       content_type='application/json', headers=headers)
+    client.post("/api/v1/batches/{}/publish".format(resp.json['batch']['batchId']), headers=headers)
+
+    def send(entry):
+        response = client.open(entry.path, method=entry.method, query_string=entry.query, headers=entry.headers)
+        response.get_data()
+        return response.status_code
+
+    entries = [LogEntry('GET', '/api/v1/public/states/ny/daily'),
+               LogEntry('GET', '/api/v1/public/states/wa/daily', headers={'Accept-Encoding': 'gzip'}),
+               LogEntry('GET', '/api/v1/public/states/daily.csv', query={'research': 'true'}),
+               LogEntry('GET', '/api/v1/public/states/zz/daily'),
+               LogEntry('GET', '/no/such/path')]
+    report = replay(entries * 2, send, RouteMatcher(app), rate=1000)
+
+    assert report['requests'] == 10
+    assert report['errors'] == 4
+    endpoints = report['endpoints']
+    assert set(endpoints) == {'/api/v1/public/states/<string:state>/daily', '/api/v1/public/states/daily.csv',
+                              '/no/such/path'}
+    state_daily = endpoints['/api/v1/public/states/<string:state>/daily']
+    assert state_daily['requests'] == 6
+    assert state_daily['errors'] == {'404': 2}
+    assert 0 < state_daily['p50Ms'] <= state_daily['p95Ms'] <= state_daily['p99Ms'] <= state_daily['maxMs']
+    assert endpoints['/api/v1/public/states/daily.csv']['errors'] == {}
+    assert endpoints['/no/such/path']['errors'] == {'404': 2}
+    # 10 requests at 1000/s take at least 9ms
+    assert report['elapsedSeconds'] >= 0.009
+
+
+def test_replay_concurrency():
+    def failing_send(entry):
+        raise ConnectionError()
+
+    report = replay([LogEntry('POST', '/a')] * 20, failing_send, lambda method, path: path, concurrency=4)
+    assert report['requests'] == 20
+    assert report['endpoints']['/a']['errors'] == {'ConnectionError': 20}
@@ -0,0 +1,386 @@
+"""
+Tests for the public endpoint response cache
+"""
+import gzip
+from unittest import mock
+
+from flask import json
+from sqlalchemy import event
+
+from app import db
+from app.models.data import *
+from app.utils.responsecache import bump_data_version, get_data_version, ENTRY_OVERHEAD, PREVIEW, \
+    PUBLISHED
+
+from common import *
+
+
+def count_queries(app, client, url):
+    """Returns the response for url, and the number of SQL statements executed to build it"""
+    statements = []
+    count_statements = lambda *args: statements.append(args[2])
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count_statements)
+    try:
+        resp = client.get(url)
+        resp.get_data()  # streamed responses are built while they're read
+    finally:
+        with app.app_context():
+            event.remove(db.engine, 'before_cursor_execute', count_statements)
+    return resp, len(statements)
+
+
+def post(client, headers, data):
+    resp = client.post("/api/v1/batches", data=json.dumps(data),
+                       content_type='application/json', headers=headers)
+    assert resp.status_code == 201
+    return resp.json['batch']['batchId']
+
+
+def test_bump_data_version(app):
+    with app.app_context():
+        assert get_data_version(PUBLISHED) == (0, None)
+        bump_data_version(PUBLISHED)
+        bump_data_version(PUBLISHED)
+        bump_data_version()
+        db.session.commit()
+        version, updated_at = get_data_version(PUBLISHED)
+        assert version == 3
+        assert updated_at is not None
+        assert get_data_version(PREVIEW)[0] == 1
+
+
+def test_cache_hits(app, headers):
+    client = app.test_client()
+    batch_id = post(client, headers, daily_push_ny_wa_two_days())
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+
+    for url in ["/api/v1/public/states/daily", "/api/v1/public/us/daily",
+                "/api/v1/public/states/daily.csv", "/api/v2/public/states/NY/daily"]:
+        first, num_queries = count_queries(app, client, url)
+        assert num_queries > 2
+        # a cache hit only looks up the data version
+        second, num_queries = count_queries(app, client, url)
+        assert num_queries == 1
+        assert second.status_code == 200
+        assert second.data == first.data
+        assert second.headers['Content-Type'] == first.headers['Content-Type']
+
+    # different arguments are cached separately
+    resp, num_queries = count_queries(app, client, "/api/v1/public/states/daily.csv?days=1")
+    assert num_queries > 1
+    assert len(resp.data.decode("utf-8").splitlines()) == 3
+
+    # errors aren't cached
+    for i in range(2):
+        resp, num_queries = count_queries(app, client, "/api/v1/public/states/ZZ/daily")
+        assert resp.status_code == 404
+        assert num_queries > 1
+
+
+def test_cache_invalidation(app, headers):
+    client = app.test_client()
+    batch_id = post(client, headers, daily_push_ny_wa_yesterday())
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+
+    assert len(client.get("/api/v1/public/states/daily").json) == 2
+    assert client.get("/api/v1/public/states/daily?preview=true").json == []
+
+    # a new preview batch invalidates the preview responses
+    post(client, headers, daily_push_ny_wa_today())
+    assert len(client.get("/api/v1/public/states/daily?preview=true").json) == 2
+    assert len(client.get("/api/v1/public/states/daily").json) == 2
+
+    # and so does the next one
+    edited = daily_push_ny_wa_today()
+    edited['coreData'][0]['positive'] = 21
+    batch_id = post(client, headers, edited)
+    resp = client.get("/api/v1/public/states/NY/daily?preview=true")
+    assert resp.json[0]['positive'] == 21
+
+    # publishing invalidates both: the older preview batch is served again in preview
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+    assert client.get("/api/v1/public/states/NY/daily?preview=true").json[0]['positive'] == 20
+    resp = client.get("/api/v1/public/states/NY/daily")
+    assert len(resp.json) == 2
+    assert resp.json[0]['positive'] == 21
+
+    # as do edits
+    resp = client.post("/api/v1/batches/edit_states_daily",
+                       data=json.dumps(edit_push_ny_yesterday_unchanged_today()),
+                       content_type='application/json', headers=headers)
+    assert resp.status_code == 201
+    resp = client.get("/api/v1/public/states/NY/daily")
+    assert resp.json[1]['positive'] == 16
+
+    # and state metadata edits
+    assert 'twitter' not in client.get("/api/v1/public/states/info").json[0]
+    resp = client.post("/api/v1/states/edit",
+                       data=json.dumps({'states': [{'state': 'NY', 'twitter': '@NY'}]}),
+                       content_type='application/json', headers=headers)
+    assert resp.status_code == 201
+    assert client.get("/api/v1/public/states/info").json[0]['twitter'] == '@NY'
+
+
+def test_push_data_versions(app, headers):
+    client = app.test_client()
+    # state changes are published right away
+    post(client, headers, daily_push_ny_wa_today())
+    with app.app_context():
+        assert get_data_version(PUBLISHED)[0] == 1
+        assert get_data_version(PREVIEW)[0] == 1
+
+    # a push without state changes only changes the preview data
+    payload = daily_push_ny_wa_today()
+    payload['states'] = []
+    payload['context']['dataEntryType'] = 'research'
+    post(client, headers, payload)
+    with app.app_context():
+        assert get_data_version(PUBLISHED)[0] == 1
+        assert get_data_version(PREVIEW)[0] == 2
+
+
+def test_cache_disabled(app, headers):
+    app.extensions['response_cache'].max_bytes = 0
+    client = app.test_client()
+    post(client, headers, daily_push_ny_wa_two_days())
+    client.get("/api/v1/public/states/daily?preview=true")
+    resp, num_queries = count_queries(app, client, "/api/v1/public/states/daily?preview=true")
+    assert num_queries > 1
+    assert len(app.extensions['response_cache'].entries) == 0
+
+
+def test_cache_size_bound(app, headers):
+    client = app.test_client()
+    post(client, headers, daily_push_ny_wa_two_days())
+    cache = app.extensions['response_cache']
+    urls = ["/api/v1/public/states/daily?preview=true", "/api/v1/public/states/daily.csv?preview=true"]
+    sizes = []
+    for url in urls:
+        cache.clear()
+        body = client.get(url).data
+        assert cache.size == ENTRY_OVERHEAD + len(body)
+        sizes.append(cache.size)
+
+    # the least recently used responses are evicted to stay within the size bound
+    cache.clear()
+    cache.max_bytes = max(sizes)
+    for url in urls:
+        client.get(url)
+    assert cache.size <= cache.max_bytes
+    assert len(cache.entries) == 1
+
+    # the bodies of responses bigger than the max entry size aren't cached, streamed or not
+    cache.clear()
+    cache.max_bytes = 1024 * 1024
+    cache.max_entry_bytes = min(sizes) - 1
+    for url in urls:
+        assert client.get(url).data
+        assert client.get(url, headers={'Accept-Encoding': 'gzip'}).data
+    assert [entry for entry, _ in cache.entries.values() if 'body' in entry] == []
+    assert cache.size == len(urls) * ENTRY_OVERHEAD
+
+
+def test_conditional_get_too_big_to_cache(app, headers):
+    client = app.test_client()
+    batch_id = post(client, headers, daily_push_ny_wa_two_days())
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+    cache = app.extensions['response_cache']
+    cache.max_entry_bytes = ENTRY_OVERHEAD + 10
+
+    for url, view_query in [("/api/v1/public/states/daily", 'app.api.public.states_daily_records'),
+                            ("/api/v1/public/states/daily.csv", 'app.api.csv.states_daily_records')]:
+        resp = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert resp.status_code == 200
+        resp.get_data()
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+
+        # the body isn't cached, but a conditional GET doesn't build the response again
+        with mock.patch(view_query, side_effect=AssertionError('the view was called')):
+            for request_headers in [{'If-None-Match': etag}, {'If-Modified-Since': last_modified}]:
+                request_headers['Accept-Encoding'] = 'gzip'
+                resp = client.get(url, headers=request_headers)
+                assert resp.status_code == 304
+                assert resp.headers['ETag'] == etag
+
+        # and an unconditional GET does
+        resp = client.get(url)
+        assert resp.status_code == 200
+        assert resp.data
+
+
+def test_cache_directory(app, headers, tmp_path):
+    client = app.test_client()
+    batch_id = post(client, headers, daily_push_ny_wa_two_days())
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+    cache = app.extensions['response_cache']
+    cache.max_entry_bytes = ENTRY_OVERHEAD + 10
+    cache.directory = str(tmp_path)
+
+    for url, view_query in [("/api/v1/public/states/daily", 'app.api.public.states_daily_records'),
+                            ("/api/v1/public/states/daily.csv", 'app.api.csv.states_daily_records')]:
+        plain = client.get(url).data
+        gzipped = client.get(url, headers={'Accept-Encoding': 'gzip'}).data
+        assert gzip.decompress(gzipped) == plain
+
+        # any process serves the files, without building or compressing the response again
+        cache.clear()
+        with mock.patch(view_query, side_effect=AssertionError('the view was called')), \
+                mock.patch('app.utils.responsecache.gzip_compressor', side_effect=AssertionError('compressed')):
+            for request_headers, body in [({}, plain), ({'Accept-Encoding': 'gzip'}, gzipped)]:
+                resp = client.get(url, headers=request_headers)
+                assert resp.status_code == 200
+                assert resp.data == body
+                assert int(resp.headers['Content-Length']) == len(body)
+                assert resp.headers['Content-Type'] == client.get(url).headers['Content-Type']
+
+    # a gzipped stream is kept compressed as it was sent
+    gzipped = client.get("/api/v1/public/us/daily.csv", headers={'Accept-Encoding': 'gzip'}).data
+    with app.app_context():
+        version = get_data_version(PUBLISHED)[0]
+    gzip_files = [path for path in tmp_path.iterdir() if path.name.endswith('.gz')]
+    assert len(gzip_files) == 3
+    assert gzipped in [path.read_bytes() for path in gzip_files]
+    assert len([path for path in tmp_path.iterdir() if path.name.endswith('.json')]) == 3
+    # without leftover temporary files
+    assert all(path.name.startswith('published-%d-' % version) for path in tmp_path.iterdir())
+
+    # the files of older data versions are removed once newer ones are stored
+    batch_id = post(client, headers, daily_push_ny_wa_today())
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+    with app.app_context():
+        version = get_data_version(PUBLISHED)[0]
+    assert client.get("/api/v1/public/states/daily").data
+    names = [path.name for path in tmp_path.iterdir()]
+    assert len(names) == 2
+    assert all(name.startswith('published-%d-' % version) for name in names)
+
+    # the files can be gone
+    cache.clear()
+    client.get("/api/v1/public/states/daily")
+    for path in tmp_path.iterdir():
+        path.unlink()
+    assert client.get("/api/v1/public/states/daily").data
+
+
+def test_conditional_get(app, headers):
+    client = app.test_client()
+    batch_id = post(client, headers, daily_push_ny_wa_two_days())
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+
+    url = "/api/v1/public/states/daily"
+    resp = client.get(url)
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+    last_modified = resp.headers['Last-Modified']
+    with app.app_context():
+        published_version = get_data_version(PUBLISHED)[0]
+        preview_version = get_data_version(PREVIEW)[0]
+    assert etag.startswith('"published-%d-' % published_version)
+    # the etag is the same whether or not the response was cached
+    assert client.get(url).headers['ETag'] == etag
+    preview_etag = client.get(url + "?preview=true").headers['ETag']
+    assert preview_etag.startswith('"preview-%d-' % preview_version)
+    # and different for every URL
+    assert client.get(url + "?research=true").headers['ETag'] != etag
+    assert client.get("/api/v1/public/states/ny/daily").headers['ETag'] != \
+        client.get("/api/v1/public/states/wa/daily").headers['ETag']
+
+    # matching validators of a cached response get a 304 after only looking up the data version
+    for request_headers in [{'If-None-Match': etag}, {'If-Modified-Since': last_modified}]:
+        client.get(url)
+        statements = []
+        count_statements = lambda *args: statements.append(args[2])
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', count_statements)
+        try:
+            resp = client.get(url, headers=request_headers)
+        finally:
+            with app.app_context():
+                event.remove(db.engine, 'before_cursor_execute', count_statements)
+        assert resp.status_code == 304
+        assert resp.data == b''
+        assert resp.headers['ETag'] == etag
+        assert len(statements) == 1
+
+        # otherwise once the response has been built
+        app.extensions['response_cache'].clear()
+        resp = client.get(url, headers=request_headers)
+        assert resp.status_code == 304
+        assert resp.headers['ETag'] == etag
+
+    assert client.get(url, headers={'If-None-Match': '"published-0"'}).status_code == 200
+    # another URL's validator doesn't match
+    assert client.get("/api/v1/public/states/daily.csv",
+                      headers={'If-None-Match': etag}).status_code == 200
+
+    # a data change invalidates the validators of its scope only
+    with app.app_context():
+        bump_data_version(PREVIEW)
+        db.session.commit()
+    resp = client.get(url + "?preview=true", headers={'If-None-Match': preview_etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'].startswith('"preview-%d-' % (preview_version + 1))
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    post(client, headers, daily_push_ny_wa_today())
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 200
+
+    # errors don't get validators, and never get a 304
+    resp = client.get("/api/v1/public/states/ZZ/daily")
+    assert resp.status_code == 404
+    assert 'ETag' not in resp.headers
+    last_modified = client.get(url).headers['Last-Modified']
+    for error_url in ["/api/v1/public/states/ZZ/daily", url + "?start=yesterday"]:
+        resp = client.get(error_url, headers={'If-Modified-Since': last_modified})
+        assert resp.status_code in (400, 404)
+
+
+def test_gzip(app, headers):
+    client = app.test_client()
+    batch_id = post(client, headers, daily_push_ny_wa_two_days())
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+
+    for url in ["/api/v1/public/states/daily", "/api/v1/public/states/daily.csv",
+                "/api/v1/public/us/daily.csv", "/api/v2/public/states/daily"]:
+        plain = client.get(url)
+        plain_body = plain.data
+        assert 'Content-Encoding' not in plain.headers
+        assert plain.headers['Vary'] == 'Accept-Encoding'
+
+        # compressed while the response is built (and streamed, for the CSV), then from the cache
+        app.extensions['response_cache'].clear()
+        built = client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+        built_body = built.data
+        cached = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        # the v2 body has its build time, so compare with the body cached when it was rebuilt
+        (entry, _), = app.extensions['response_cache'].entries.values()
+        assert len(entry['body']) == len(plain_body)
+        for resp in [built, cached]:
+            assert resp.status_code == 200
+            assert resp.headers['Content-Encoding'] == 'gzip'
+            assert resp.headers['Content-Type'] == plain.headers['Content-Type']
+            assert resp.headers['Vary'] == 'Accept-Encoding'
+            assert gzip.decompress(resp.data) == entry['body']
+            # the gzip body has its own etag
+            assert resp.headers['ETag'] == plain.headers['ETag'][:-1] + '-gzip"'
+        assert cached.data == built_body
+        assert int(cached.headers['Content-Length']) == len(cached.data)
+
+        resp = client.get(url, headers={'Accept-Encoding': 'gzip',
+                                        'If-None-Match': cached.headers['ETag']})
+        assert resp.status_code == 304
+        resp = client.get(url, headers={'Accept-Encoding': 'gzip',
+                                        'If-None-Match': plain.headers['ETag']})
+        assert resp.status_code == 200
+        resp.get_data()
+
+    cache = app.extensions['response_cache']
+    assert all('gzip' in entry for entry, _ in cache.entries.values())
+    assert cache.size == sum(ENTRY_OVERHEAD + len(entry['body']) + len(entry['gzip'])
+                             for entry, _ in cache.entries.values())
+
+    # gzip can be refused
+    resp = client.get("/api/v1/public/states/daily", headers={'Accept-Encoding': 'gzip;q=0'})
+    assert 'Content-Encoding' not in resp.headers
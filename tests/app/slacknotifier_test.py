@@ -1,6 +1,11 @@
 import pytest
+from unittest.mock import MagicMock
+from slack.errors import SlackApiError
+
 from app.utils.slacknotifier import *
 
+from common import drain_deliveries
+
 
 def test_slack_noop(app, slack_mock):
     with app.app_context():
@@ -19,11 +24,15 @@ def test_notify_slack(app, slack_mock):
         app.config["SLACK_API_TOKEN"] = "token"
         app.config["SLACK_CHANNEL"] = "channel"
         notify_slack("test")
+        # messages are delivered in the background
+        assert slack_mock.chat_postMessage.call_count == 0
+        drain_deliveries(app)
         assert slack_mock.chat_postMessage.call_count == 1
         assert slack_mock.files_upload.call_count == 0  # no file specified, so no file should be uploaded
 
         # test notify_slack with a file attachment
         notify_slack("test2", "this is a file")
+        drain_deliveries(app)
         assert slack_mock.chat_postMessage.call_count == 2
         assert slack_mock.files_upload.call_count == 1
         assert "this is a file" == slack_mock.files_upload.call_args[1]['content']
@@ -32,6 +41,7 @@ def test_notify_slack(app, slack_mock):
 def test_notify_slack_error(app, slack_mock):
     with app.app_context():
         notify_slack_error("missing context", "post_core_data")
+        drain_deliveries(app)
         assert slack_mock.files_upload.call_count == 1
         assert "missing context" == slack_mock.files_upload.call_args[1]['content']
 
@@ -44,5 +54,18 @@ def test_slack_exceptions(app, slack_mock):
             return 42 / 0
         with pytest.raises(ZeroDivisionError):
             error_function()
+        drain_deliveries(app)
         assert slack_mock.files_upload.call_count == 1
         assert "ZeroDivisionError" in slack_mock.files_upload.call_args[1]['content']
+
+
+def test_notify_slack_retries(app, slack_mock):
+    with app.app_context():
+        error = SlackApiError("ratelimited", {"ok": False, "error": "ratelimited"})
+        slack_mock.chat_postMessage.side_effect = [error, error, MagicMock()]
+        slack_mock.files_upload.side_effect = [error, MagicMock()]
+        notify_slack("test", "this is a file")
+        drain_deliveries(app)
+        assert slack_mock.chat_postMessage.call_count == 3
+        # retrying the attachment doesn't repeat the message
+        assert slack_mock.files_upload.call_count == 2
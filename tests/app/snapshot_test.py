@@ -0,0 +1,96 @@
+"""
+Tests for the static snapshots of the public endpoints
+"""
+import os
+
+from flask import json
+
+from app.utils.snapshot import schedule_snapshot, snapshot_urls, take_snapshot
+
+from common import *
+
+
+def post_and_publish(client, headers, data):
+    resp = client.post("/api/v1/batches", data=json.dumps(data),
+                       content_type='application/json', headers=headers)
+    assert resp.status_code == 201
+    batch_id = resp.json['batch']['batchId']
+    resp = client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+    assert resp.status_code == 201
+
+
+def test_snapshot_urls(app, headers):
+    client = app.test_client()
+    post_and_publish(client, headers, daily_push_ny_wa_two_days())
+
+    with app.app_context():
+        urls = snapshot_urls(app)
+    assert "/api/v1/public/states/daily" in urls
+    assert "/api/v1/public/states/daily.csv" in urls
+    assert "/api/v1/public/states/ny/daily" in urls
+    assert "/api/v1/public/states/wa/daily" in urls
+    assert "/api/v2/public/states/ny/daily/simple" in urls
+    assert "/api/v2/public/us/daily" in urls
+    # only public endpoints
+    assert not [url for url in urls if '/internal/' in url or '<' in url]
+    assert "/api/v1/batches" not in urls
+
+
+def test_take_snapshot(app, headers, tmp_path):
+    client = app.test_client()
+    post_and_publish(client, headers, daily_push_ny_wa_two_days())
+
+    with app.app_context():
+        path = take_snapshot(str(tmp_path))
+    current = tmp_path / 'current'
+    assert os.path.islink(str(current))
+    assert os.path.realpath(str(current)) == os.path.realpath(path)
+
+    for url, file_path in [("/api/v1/public/states/daily", "v1/public/states/daily.json"),
+                           ("/api/v1/public/states/ny/daily", "v1/public/states/ny/daily.json"),
+                           ("/api/v1/public/states/daily.csv", "v1/public/states/daily.csv"),
+                           ("/api/v1/public/us/daily.csv", "v1/public/us/daily.csv")]:
+        assert (current / file_path).read_bytes() == client.get(url).data
+    for file_path in ["v2/public/states/daily.json", "v2/public/states/wa/daily/simple.json",
+                      "v2/public/us/daily.json", "v2/public/us/daily/simple.json"]:
+        assert json.loads((current / file_path).read_text())['data']
+
+    # the same data version isn't rendered again
+    with app.app_context():
+        assert take_snapshot(str(tmp_path)) == path
+
+    # newer data is rendered into a new directory, and only the latest snapshots are kept
+    for i in range(3):
+        post_and_publish(client, headers, daily_push_ny_wa_two_days())
+        with app.app_context():
+            new_path = take_snapshot(str(tmp_path))
+        assert new_path != path
+        assert os.path.realpath(str(current)) == os.path.realpath(new_path)
+    names = os.listdir(str(tmp_path))
+    assert 'current' in names
+    assert len([name for name in names if name.startswith('v')]) == 3
+    assert not os.path.exists(path)
+
+    # a snapshot of older data never replaces a newer current snapshot
+    newer = tmp_path / 'v1000'
+    newer.mkdir()
+    os.remove(str(current))
+    os.symlink('v1000', str(current))
+    with app.app_context():
+        assert take_snapshot(str(tmp_path)) == str(newer)
+    assert os.readlink(str(current)) == 'v1000'
+
+
+def test_schedule_snapshot(app, headers, tmp_path):
+    client = app.test_client()
+    post_and_publish(client, headers, daily_push_ny_wa_two_days())
+
+    # disabled without a snapshot directory
+    with app.app_context():
+        assert schedule_snapshot() is None
+
+    app.config['SNAPSHOT_DIR'] = str(tmp_path)
+    with app.app_context():
+        thread = schedule_snapshot()
+    thread.join()
+    assert (tmp_path / 'current' / 'v1/public/states/daily.json').exists()
@@ -0,0 +1,66 @@
+"""
+Tests for the per-request Server-Timing instrumentation
+"""
+import logging
+
+from flask import json
+
+from common import *
+
+
+def parse_server_timing(header):
+    metrics = {}
+    for metric in header.split(', '):
+        name, *params = metric.split(';')
+        metrics[name] = dict(param.split('=', 1) for param in params)
+    return metrics
+
+
+def post_and_publish(client, headers):
+    resp = client.post("/api/v1/batches", data=json.dumps(daily_push_ny_wa_two_days()),
+                       content_type='application/json', headers=headers)
+    batch_id = resp.json['batch']['batchId']
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+
+
+def test_server_timing(app, headers, caplog):
+    client = app.test_client()
+    post_and_publish(client, headers)
+
+    with caplog.at_level(logging.INFO, logger=app.logger.name):
+        resp = client.get("/api/v2/public/states/daily")
+    assert resp.status_code == 200
+    metrics = parse_server_timing(resp.headers['Server-Timing'])
+    assert set(metrics) == {'sql', 'orm', 'serialize', 'total', 'bytes'}
+    # the data version, states daily and the states selectin load
+    assert metrics['sql']['desc'] == '"3 queries"'
+    assert float(metrics['sql']['dur']) > 0
+    assert float(metrics['orm']['dur']) > 0
+    assert float(metrics['total']['dur']) >= float(metrics['sql']['dur']) + float(metrics['orm']['dur'])
+    assert metrics['bytes']['desc'] == '"%d"' % len(resp.data)
+
+    log_lines = [record.getMessage() for record in caplog.records
+                 if record.getMessage().startswith('request_timing ')]
+    log_line = json.loads(log_lines[-1][len('request_timing '):])
+    assert log_line['path'] == '/api/v2/public/states/daily'
+    assert log_line['status'] == 200
+    assert log_line['sqlCount'] == 3
+    assert log_line['bytes'] == len(resp.data)
+    assert set(log_line) >= {'sqlMs', 'ormMs', 'serializeMs', 'totalMs'}
+
+    # a cached response only looks up the data version
+    resp = client.get("/api/v2/public/states/daily")
+    metrics = parse_server_timing(resp.headers['Server-Timing'])
+    assert metrics['sql']['desc'] == '"1 queries"'
+
+    # streamed responses have no size
+    resp = client.get("/api/v1/public/states/daily.csv")
+    assert 'bytes' not in parse_server_timing(resp.headers['Server-Timing'])
+    resp.get_data()
+
+
+def test_server_timing_disabled(app):
+    app.config['SERVER_TIMING'] = False
+    resp = app.test_client().get("/api/v1/public/states/info")
+    assert resp.status_code == 200
+    assert 'Server-Timing' not in resp.headers
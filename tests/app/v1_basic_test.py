@@ -47,7 +47,7 @@ def test_post_core_data(app, headers):
     assert resp.json[0]['state'] == "AK"
     assert resp.json[0]['twitter'] == "@Alaska_DHSS"
 
-    resp = client.get('/api/v1/batches')
+    resp = client.get('/api/v1/batches?include=coreData')
     assert len(resp.json['batches']) == 1
     assert resp.json['batches'][0]['batchId'] == 1
     assert resp.json['batches'][0]['user'] == 'testing'
@@ -66,6 +66,37 @@ def test_post_core_data(app, headers):
     assert resp.json['batches'][0]['coreData'][1]['lastUpdateTime'] == '2020-06-18T15:00:00Z'
 
 
+def test_post_core_data_response(app, headers):
+    client = app.test_client()
+    example_filename = os.path.join(os.path.dirname(__file__), 'data.json')
+    payload = json.load(open(example_filename))
+    # rows are returned in the pushed order, not the table order
+    payload['coreData'].reverse()
+    payload['coreData'][0]['notes'] = ''
+    payload['coreData'][0]['positive'] = '12'
+
+    resp = client.post("/api/v1/batches", data=json.dumps(payload),
+                       content_type='application/json', headers=headers)
+    assert resp.status_code == 201
+    core_data = resp.json['coreData']
+    assert len(core_data) == 56 * 2
+    assert [(row['state'], row['date']) for row in core_data] == [
+        (row['state'], CoreData.parse_str_to_date(row['date']).strftime('%Y-%m-%d'))
+        for row in payload['coreData']]
+    assert all(row['batchId'] == 1 for row in core_data)
+    # empty strings are stripped
+    assert 'notes' not in core_data[0]
+    assert core_data[0]['positive'] == 12
+    assert core_data[0]['totalTestResults'] == 12 + core_data[0]['negative']
+
+    ak = next(row for row in core_data if row['state'] == 'AK' and row['date'] == '2020-06-18')
+    assert ak['lastUpdateTime'] == '2020-06-18T04:00:00Z'
+    assert ak['lastUpdateEt'] == '6/18/2020 00:00'
+
+    resp = client.get('/api/v1/batches/1')
+    assert len(resp.json['coreData']) == 56 * 2
+
+
 def test_post_core_data_unknown_field(app, headers, slack_mock):
     client = app.test_client()
 
@@ -81,6 +112,7 @@ def test_post_core_data_unknown_field(app, headers, slack_mock):
     assert resp.status_code == 400
     resp_data = resp.data.decode("utf-8")
     assert resp_data == "Unknown field(s) in CoreData: 311"
+    drain_deliveries(app)
     assert slack_mock.files_upload.call_count == 1
 
 
@@ -161,15 +193,15 @@ def test_post_core_data_without_states(app, headers):
     assert resp.status_code == 201
 
     # we should've written 56 states times 3 days overall, some core data rows, 2 batch
-    resp = client.get('/api/v1/batches')
+    resp = client.get('/api/v1/batches?include=coreData')
     assert len(resp.json['batches']) == 2
 
-    # check the 2nd batch, that updated core data without states
-    assert resp.json['batches'][1]['batchId'] == 2
-    assert len(resp.json['batches'][1]['coreData']) == 2
+    # check the 2nd batch, that updated core data without states, listed first as the newest
+    assert resp.json['batches'][0]['batchId'] == 2
+    assert len(resp.json['batches'][0]['coreData']) == 2
     # spot-check a few values
-    assert resp.json['batches'][1]['coreData'][0]['state'] == 'AK'
-    assert resp.json['batches'][1]['coreData'][0]['positive'] == 709
+    assert resp.json['batches'][0]['coreData'][0]['state'] == 'AK'
+    assert resp.json['batches'][0]['coreData'][0]['positive'] == 709
 
     # try inserting unknown states
     payload['coreData'][0]['state'] = 'FOO'
@@ -206,6 +238,62 @@ def test_get_batches(app):
     assert resp.json['batchNote'] == 'test1'
 
 
+def test_get_batches_pages_and_filters(app, headers):
+    client = app.test_client()
+    for payload in [daily_push_ny_wa_two_days(), daily_push_ny_wa_yesterday()]:
+        resp = client.post("/api/v1/batches", data=json.dumps(payload),
+                           content_type='application/json', headers=headers)
+        assert resp.status_code == 201
+    client.post('/api/v1/batches/1/publish', headers=headers)
+    resp = client.post("/api/v1/batches/edit_states_daily",
+                       data=json.dumps(edit_push_ny_yesterday_unchanged_today()),
+                       content_type='application/json', headers=headers)
+    assert resp.status_code == 201
+    with app.app_context():
+        for batch_id, day in [(1, 10), (2, 11), (3, 12)]:
+            Batch.query.get(batch_id).createdAt = datetime.datetime(2020, 6, day, 12, tzinfo=pytz.utc)
+        db.session.commit()
+
+    def batch_ids(url):
+        resp = client.get(url)
+        assert resp.status_code == 200
+        return [x['batchId'] for x in resp.json['batches']]
+
+    # newest first. The rows aren't embedded, the changed dates are still there
+    resp = client.get('/api/v1/batches')
+    assert [x['batchId'] for x in resp.json['batches']] == [3, 2, 1]
+    assert resp.json['nextCursor'] is None
+    assert 'coreData' not in resp.json['batches'][2]
+    assert resp.json['batches'][2]['changedDatesMin'] == '2020-05-24'
+    assert resp.json['batches'][2]['changedDatesMax'] == '2020-05-25'
+    with_rows = client.get('/api/v1/batches?include=coreData').json['batches']
+    assert len(with_rows[2]['coreData']) == 4
+    assert [{k: v for k, v in x.items() if k != 'coreData'} for x in with_rows] == resp.json['batches']
+
+    # pages of older batches
+    resp = client.get('/api/v1/batches?limit=2')
+    assert [x['batchId'] for x in resp.json['batches']] == [3, 2]
+    assert resp.json['nextCursor'] == 2
+    resp = client.get('/api/v1/batches?limit=2&cursor=2')
+    assert [x['batchId'] for x in resp.json['batches']] == [1]
+    assert resp.json['nextCursor'] is None
+    assert batch_ids('/api/v1/batches?cursor=1') == []
+
+    # filters
+    assert batch_ids('/api/v1/batches?dataEntryType=edit') == [3]
+    assert batch_ids('/api/v1/batches?dataEntryType=daily,edit') == [3, 2, 1]
+    assert batch_ids('/api/v1/batches?isPublished=false') == [2]
+    assert batch_ids('/api/v1/batches?isPublished=true&limit=1&cursor=3') == [1]
+    assert batch_ids('/api/v1/batches?state=wa') == [2, 1]
+    assert batch_ids('/api/v1/batches?state=CA') == []
+    assert batch_ids('/api/v1/batches?createdAfter=2020-06-11') == [3, 2]
+    assert batch_ids('/api/v1/batches?createdBefore=2020-06-11T12:00:00Z') == [1]
+    assert batch_ids('/api/v1/batches?createdAfter=2020-06-11T08:00:00-04:00&createdBefore=2020-06-12') == [2]
+
+    for query in ['limit=0', 'limit=abc', 'cursor=x', 'isPublished=maybe', 'createdAfter=June']:
+        assert client.get('/api/v1/batches?' + query).status_code == 400, query
+
+
 def test_publish_batch(app, headers, requests_mock):
     with app.app_context():
         # write 2 batches
@@ -236,6 +324,7 @@ def test_publish_batch(app, headers, requests_mock):
     # this should've returned the published batch
     assert resp.json['batchId'] == 2
     assert resp.json['isPublished'] == True
+    drain_deliveries(app)
     assert requests_mock.call_count == 1
 
     # check that the GET requests correctly reflect published status
@@ -303,6 +392,7 @@ def test_push_with_validation_error(app, headers, slack_mock):
     resp_data = resp.data.decode("utf-8")
     assert "Non-numeric value for field" in resp_data
     assert 'NY ' in resp_data
+    drain_deliveries(app)
     assert slack_mock.files_upload.call_count == 1
 
     # negative number in a numeric field
@@ -317,6 +407,7 @@ def test_push_with_validation_error(app, headers, slack_mock):
     resp_data = resp.data.decode("utf-8")
     assert "Negative value for field" in resp_data
     assert 'NY ' in resp_data
+    drain_deliveries(app)
     assert slack_mock.files_upload.call_count == 2
 
     # empty value for non-nullable field
@@ -330,6 +421,7 @@ def test_push_with_validation_error(app, headers, slack_mock):
     assert resp.status_code == 400
     resp_data = resp.data.decode("utf-8")
     assert "Missing value for 'state' in row" in resp_data
+    drain_deliveries(app)
     assert slack_mock.files_upload.call_count == 3
 
 
@@ -345,6 +437,7 @@ def test_push_missing_context(app, headers, slack_mock):
         headers=headers)
     assert resp.status_code == 400
     assert "Payload requires 'context' field" in resp.data.decode("utf-8")
+    drain_deliveries(app)
     assert slack_mock.files_upload.call_count == 1
 
 
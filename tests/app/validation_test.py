@@ -0,0 +1,60 @@
+"""
+Tests for the core data and edit payload validation
+"""
+import pytest
+
+from app.utils.validation import PayloadValidationError, validate_core_data_payload, \
+    validate_edit_data_payload
+
+from common import *
+
+
+def push_payload(core_data):
+    return {'context': {'dataEntryType': 'daily'}, 'states': [NY], 'coreData': core_data}
+
+
+def test_validate_core_data_payload():
+    validate_core_data_payload(daily_push_ny_wa_two_days())
+
+    # the first error is raised
+    bad_rows = [dict(NY_TODAY), dict(NY_YESTERDAY, negative='many', positive=-1), dict(WA_TODAY, moonBase=1)]
+    with pytest.raises(ValueError) as e:
+        validate_core_data_payload(push_payload(bad_rows))
+    assert not isinstance(e.value, PayloadValidationError)
+    # numeric errors of a row are in column order
+    assert str(e.value) == "Negative value for field 'NY positive': -1"
+
+    with pytest.raises(ValueError, match="Missing value for 'date' in row"):
+        validate_core_data_payload(push_payload([dict(NY_TODAY, date='')]))
+    with pytest.raises(ValueError, match="Unknown field\\(s\\) in CoreData: kuiperBelt, moonBase"):
+        validate_core_data_payload(push_payload([dict(NY_TODAY, moonBase=1, kuiperBelt=2)]))
+    # lastUpdateIsoUtc is an alias of lastUpdateTime, numeric strings and nulls are fine
+    validate_core_data_payload(push_payload([dict(NY_TODAY, positive='12', pending=None)]))
+
+
+def test_validate_collect_all():
+    bad_rows = [dict(NY_TODAY), dict(NY_YESTERDAY, negative='many', positive=-1), dict(WA_TODAY, moonBase=1),
+                dict(WA_YESTERDAY, state=None), 'not a row']
+    with pytest.raises(PayloadValidationError) as e:
+        validate_core_data_payload(push_payload(bad_rows), collect_all=True)
+    errors = e.value.errors
+    assert [row for row, _ in errors] == [1, 1, 2, 3, 4]
+    assert errors[0][1] == "Negative value for field 'NY positive': -1"
+    assert errors[1][1] == "Non-numeric value for field 'NY negative': many"
+    assert errors[2][1] == "Unknown field(s) in CoreData: moonBase"
+    assert errors[3][1].startswith("Missing value for 'state' in row")
+    assert str(e.value).splitlines()[0] == "coreData[1]: Negative value for field 'NY positive': -1"
+    # it's still a ValueError, like the first error only mode
+    assert isinstance(e.value, ValueError)
+
+    # errors outside of the rows are raised right away
+    with pytest.raises(ValueError, match="No state specified in batch edit context"):
+        payload = edit_push_ny_yesterday_unchanged_today()
+        payload['context']['state'] = ''
+        validate_edit_data_payload(payload, collect_all=True)
+
+    with pytest.raises(PayloadValidationError) as e:
+        payload = edit_push_ny_yesterday_unchanged_today()
+        payload['coreData'][1]['positive'] = -5
+        validate_edit_data_payload(payload, collect_all=True)
+    assert e.value.errors == [(1, "Negative value for field 'NY positive': -5")]
@@ -1,37 +1,68 @@
 import pytest
 import requests_mock
-from flask import Response
+from flask import Response, json
 from requests import HTTPError
 
 from app.api import api
-from app.utils.webhook import do_notify_webhook, notify_webhook
+from app.utils.webhook import do_notify_webhook, notify_webhook, record_webhook_changes, \
+    webhook_debouncer, WebhookChanges
+
+from common import *
 
 
 def test_do_notify_webhook(app, requests_mock, slack_mock):
+    app.config['DELIVERY_BREAKER_THRESHOLD'] = 10
     with app.app_context():
         url = 'http://example.com/web/hook'
         app.config['API_WEBHOOK_URL'] = url
         requests_mock.get(url, json= {'it': 'worked'})
-        resp = do_notify_webhook()
+        assert do_notify_webhook()
+        # the webhook is called in the background
+        assert requests_mock.call_count == 0
+        drain_deliveries(app)
         assert requests_mock.call_count == 1
-        assert resp.json() == {'it': 'worked'}
         # nothing should be posted to slack for a successful operation
         assert slack_mock.chat_postMessage.call_count == 0
         assert slack_mock.files_upload.call_count == 0
 
+        # failed requests are retried, then the error is reported to slack
         requests_mock.get(url, status_code=500)
-        resp = do_notify_webhook()
-        assert requests_mock.call_count == 2
-        # error should be reported to slack
+        do_notify_webhook()
+        drain_deliveries(app)
+        assert requests_mock.call_count == 1 + 1 + app.config['DELIVERY_RETRIES']
+        assert slack_mock.files_upload.call_count == 1
+        assert "#500" in slack_mock.files_upload.call_args[1]['content']
+
+        # a request that fails once succeeds on retry
+        requests_mock.get(url, [{'status_code': 500}, {'json': {'it': 'worked'}}])
+        do_notify_webhook()
+        drain_deliveries(app)
         assert slack_mock.files_upload.call_count == 1
 
         # try with a bad url/error in request
         requests_mock.register_uri('GET', url, exc=HTTPError),
-        resp = do_notify_webhook()
-        assert resp is False
+        do_notify_webhook()
+        drain_deliveries(app)
         # error should be reported to slack
         assert slack_mock.files_upload.call_count == 2
 
+        # nothing to do without a url
+        app.config['API_WEBHOOK_URL'] = ''
+        assert do_notify_webhook() is False
+
+
+def test_webhook_timeout(app, requests_mock):
+    with app.app_context():
+        url = 'http://example.com/web/hook'
+        app.config['API_WEBHOOK_URL'] = url
+        requests_mock.get(url, json= {'it': 'worked'})
+        do_notify_webhook()
+        drain_deliveries(app)
+        assert requests_mock.last_request.timeout == app.config['DELIVERY_TIMEOUT']
+        # the webhook is called with a GET and no payload, unless it's configured to be POSTed one
+        assert requests_mock.last_request.method == 'GET'
+        assert not requests_mock.last_request.body
+
 
 def test_webhook_decorator(app, requests_mock, slack_mock):
     with app.app_context():
@@ -45,6 +76,7 @@ def test_webhook_decorator(app, requests_mock, slack_mock):
             return "blah blah", 201
         assert requests_mock.call_count == 0
         successful_function()
+        drain_deliveries(app)
         assert requests_mock.call_count == 1
         assert slack_mock.files_upload.call_count == 0
 
@@ -53,6 +85,94 @@ def test_webhook_decorator(app, requests_mock, slack_mock):
             return "blah blah", 500
         assert requests_mock.call_count == 1
         unsuccessful_function()
+        drain_deliveries(app)
         # webhook should not be called because the operation failed
         assert requests_mock.call_count == 1
         assert slack_mock.files_upload.call_count == 0
+
+
+def changes(states=(), dates=(), batch_ids=()):
+    changes = WebhookChanges()
+    changes.update(states, dates, batch_ids)
+    return changes
+
+
+def test_webhook_debounce(app, requests_mock):
+    url = 'http://example.com/web/hook'
+    app.config['API_WEBHOOK_URL'] = url
+    app.config['WEBHOOK_DEBOUNCE'] = 60
+    app.config['WEBHOOK_METHOD'] = 'POST'
+    requests_mock.post(url, json={'it': 'worked'})
+    with app.app_context():
+        assert do_notify_webhook(changes(['NY'], [date(2020, 5, 24)], [1]))
+        assert do_notify_webhook(changes(['WA', 'NY'], [date(2020, 5, 20)], [2]))
+        assert do_notify_webhook()
+        drain_deliveries(app)
+        # nothing is called until the end of the window
+        assert requests_mock.call_count == 0
+
+        assert webhook_debouncer().flush()
+        drain_deliveries(app)
+        assert requests_mock.call_count == 1
+        assert requests_mock.last_request.json() == {
+            'states': ['NY', 'WA'],
+            'dates': ['2020-05-20', '2020-05-24'],
+            'batchIds': [1, 2],
+        }
+        # and the window starts over
+        assert not webhook_debouncer().flush()
+
+        # the window's timer calls the webhook without a flush
+        app.config['WEBHOOK_DEBOUNCE'] = 0.01
+        do_notify_webhook(changes(['CA']))
+        webhook_debouncer().timer.join()
+        drain_deliveries(app)
+        assert requests_mock.call_count == 2
+        assert requests_mock.last_request.json()['states'] == ['CA']
+
+        # pending changes are sent right away when the process exits
+        app.config['WEBHOOK_DEBOUNCE'] = 60
+        do_notify_webhook(changes(['WA']))
+        assert webhook_debouncer().flush(background=False)
+        assert requests_mock.call_count == 3
+        assert requests_mock.last_request.json()['states'] == ['WA']
+        assert webhook_debouncer().timer is None
+
+
+def test_webhook_payload(app, headers, requests_mock):
+    url = 'http://example.com/web/hook'
+    app.config['API_WEBHOOK_URL'] = url
+    app.config['WEBHOOK_METHOD'] = 'POST'
+    requests_mock.post(url, json={'it': 'worked'})
+    client = app.test_client()
+
+    resp = client.post("/api/v1/batches", data=json.dumps(daily_push_ny_wa_two_days()),
+                       content_type='application/json', headers=headers)
+    batch_id = resp.json['batch']['batchId']
+    drain_deliveries(app)
+    # pushing isn't publishing
+    assert requests_mock.call_count == 0
+
+    client.post("/api/v1/batches/{}/publish".format(batch_id), headers=headers)
+    drain_deliveries(app)
+    assert requests_mock.last_request.json() == {
+        'states': ['NY', 'WA'],
+        'dates': ['2020-05-24', '2020-05-25'],
+        'batchIds': [batch_id],
+    }
+
+    resp = client.post("/api/v1/batches/edit_states_daily",
+                       data=json.dumps(edit_push_ny_yesterday_unchanged_today()),
+                       content_type='application/json', headers=headers)
+    drain_deliveries(app)
+    assert requests_mock.last_request.json() == {
+        'states': ['NY'],
+        'dates': ['2020-05-24'],
+        'batchIds': [resp.json['batch']['batchId']],
+    }
+
+    client.post("/api/v1/states/edit", data=json.dumps({'states': [{'state': 'NY', 'twitter': '@NY'}]}),
+                content_type='application/json', headers=headers)
+    drain_deliveries(app)
+    assert requests_mock.last_request.json() == {'states': ['NY'], 'dates': [], 'batchIds': []}
+    assert requests_mock.call_count == 3